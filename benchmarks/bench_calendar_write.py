@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Benchmark of ``calendar.event.write`` on many events
+
+Creates a set of events, writes them in one call then record by record
+and reports the wall time and the number of SQL queries of each run.
+Everything is rolled back at the end.
+
+Usage::
+
+    python benchmarks/bench_calendar_write.py -c odoo.cfg -d db --count 1000
+
+The database must have ``connector_exchange`` installed.
+"""
+
+import argparse
+import time
+
+import odoo
+
+
+def create_events(env, count):
+    values = {'start': '2017-06-01 10:00:00',
+              'stop': '2017-06-01 11:00:00',
+              'user_id': env.uid,
+              }
+    events = env['calendar.event'].with_context(connector_no_export=True)
+    for idx in range(count):
+        values['name'] = 'Benchmark %d' % idx
+        events |= events.create(values)
+    return events
+
+
+def measure(env, func):
+    cr = env.cr
+    env.invalidate_all()
+    queries = cr.sql_log_count
+    start = time.time()
+    func()
+    return time.time() - start, cr.sql_log_count - queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-c', '--config', required=True)
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--count', type=int, default=1000)
+    args = parser.parse_args()
+
+    odoo.tools.config.parse_config(['-c', args.config, '-d', args.database])
+    registry = odoo.registry(args.database)
+    with odoo.api.Environment.manage(), registry.cursor() as cr:
+        env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+        events = create_events(env, args.count)
+        events = events.with_context(connector_no_export=True)
+
+        runs = [
+            ('multi', lambda: events.write({'location': 'Room A'})),
+            ('per record',
+             lambda: [event.write({'location': 'Room B'})
+                      for event in events]),
+        ]
+        for name, func in runs:
+            duration, queries = measure(env, func)
+            print('%-10s %6d events  %8.3f s  %8d queries  %8.1f events/s' %
+                  (name, len(events), duration, queries,
+                   len(events) / duration))
+        cr.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Micro-benchmark of the compiled mappings of the partners and events
+
+Maps exchangelib items built in memory to Odoo values (import) and Odoo
+records to exchangelib items (export, all the fields then only one), and
+prints the items mapped per second. No request is sent to Exchange.
+
+Usage::
+
+    python benchmarks/bench_mapper.py -c odoo.cfg -d db --items 20000
+
+The database must have ``connector_exchange`` installed, the Odoo records
+exported are the first ones found. Nothing is written.
+"""
+
+import argparse
+import time
+
+import odoo
+from exchangelib import CalendarItem, Contact, EWSDateTime, UTC
+
+from odoo.addons.connector_exchange.models.calendar_event.mapping import (
+    EVENT_MAPPING
+)
+from odoo.addons.connector_exchange.models.res_partner.mapping import (
+    PARTNER_MAPPING
+)
+
+
+def contacts(count):
+    return [Contact(given_name='Given %d' % idx,
+                    surname='Surname %d' % idx,
+                    display_name='Given %d Surname %d' % (idx, idx),
+                    business_homepage='http://example.com/%d' % idx,
+                    company_name='Company %d' % (idx % 10),
+                    job_title='Job %d' % (idx % 5))
+            for idx in range(count)]
+
+
+def calendar_items(count):
+    start = UTC.localize(EWSDateTime(2017, 1, 2, 8))
+    return [CalendarItem(subject='Event %d' % idx,
+                         location='Room %d' % (idx % 10),
+                         body='Description of the event %d' % idx,
+                         start=start, end=start)
+            for idx in range(count)]
+
+
+def measure(name, func, items):
+    start = time.time()
+    for item in items:
+        func(item)
+    duration = time.time() - start
+    print('%-28s %8d items %9.3f s %12.1f items/s' % (
+        name, len(items), duration,
+        len(items) / duration if duration else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-c', '--config', required=True)
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--items', type=int, default=10000)
+    args = parser.parse_args()
+
+    odoo.tools.config.parse_config(['-c', args.config, '-d', args.database])
+    registry = odoo.registry(args.database)
+    with odoo.api.Environment.manage(), registry.cursor() as cr:
+        env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+        measure('import contacts',
+                lambda item: PARTNER_MAPPING.map_import(item, env),
+                contacts(args.items))
+        measure('import calendar items',
+                lambda item: EVENT_MAPPING.map_import(item, env),
+                calendar_items(args.items))
+
+        partners = env['res.partner'].search([], limit=args.items)
+        # read once, only the mapping is measured
+        partners.read(['name', 'firstname', 'lastname', 'website',
+                       'function', 'parent_id', 'title'])
+        measure('export partners',
+                lambda partner: PARTNER_MAPPING.map_export(partner,
+                                                           Contact()),
+                partners)
+        measure('export partners (name)',
+                lambda partner: PARTNER_MAPPING.map_export(
+                    partner, Contact(), fields=['name']),
+                partners)
+        events = env['calendar.event'].search([], limit=args.items)
+        events.read(['name', 'location', 'description'])
+        measure('export events',
+                lambda event: EVENT_MAPPING.map_export(event,
+                                                       CalendarItem()),
+                events)
+        cr.rollback()
+
+
+if __name__ == '__main__':
+    main()
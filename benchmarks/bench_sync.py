@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Benchmark of the synchronization entry points against a mock Exchange
+
+Generates users, partners and events in Odoo and their mailboxes on the
+mock EWS server (``connector_exchange/tests/mock_ews.py``), then runs
+``import_contact_partners``, ``import_user_calendar``,
+``export_contact_partners`` and ``export_user_calendar`` twice:
+
+* full: on the new dataset, everything is imported and exported
+* incremental: after a part of the Exchange items has been modified
+
+The jobs are run immediately (``test_queue_job_no_delay``). For each run,
+it reports the items per second, the EWS calls and the SQL queries per
+item, the peak memory of the run and the wall time, and writes them in a
+JSON file to compare with ``compare_sync.py``. The peak memory of a run is
+the highest resident memory sampled during the run, above the resident
+memory at its start.
+
+Usage::
+
+    python benchmarks/bench_sync.py -c odoo.cfg -d db --users 200 \\
+        --events 2000 --contacts 5000 -o results.json
+
+The database must have ``connector_exchange`` installed. The runs
+commit, use a database dedicated to the benchmark.
+"""
+
+import argparse
+import json
+import subprocess
+import threading
+import time
+from datetime import datetime, timedelta
+
+import psutil
+
+import odoo
+
+from odoo.addons.connector_exchange.tests.mock_ews import MockEWSServer
+
+ENTRY_POINTS = ['import_contact_partners',
+                'import_user_calendar',
+                'export_contact_partners',
+                'export_user_calendar',
+                ]
+
+
+def create_dataset(env, server, args):
+    """ Create the backend, the users and their records in Odoo, and the
+    mailboxes of the users on the mock server
+    """
+    backend = env['exchange.backend'].create({
+        'name': 'Benchmark',
+        'version': 'exchange_2010',
+        'location': server.url,
+        'disable_autodiscover': True,
+        'username': 'benchmark',
+        'password': 'benchmark',
+        # enumerate the folders in one run
+        'enumeration_time_budget': 24 * 3600,
+    })
+    users = env['res.users'].with_context(no_reset_password=True)
+    partners = env['res.partner'].with_context(connector_no_export=True)
+    events = env['calendar.event'].with_context(connector_no_export=True)
+    start = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    for idx in range(args.users):
+        user = users.create({
+            'name': 'Benchmark %d' % idx,
+            'login': 'benchmark%d' % idx,
+            'email': 'user%d@example.com' % idx,
+            'exchange_synch': True,
+            'exchange_calendar_sync': True,
+        })
+        for number in range(args.odoo_contacts):
+            partners.create({'name': 'Contact %d-%d' % (idx, number),
+                             'email': 'contact%d-%d@example.com' % (
+                                 idx, number),
+                             'user_id': user.id})
+        for number in range(args.odoo_events):
+            event_start = start + timedelta(days=number % 300,
+                                            hours=number % 9)
+            events.create({
+                'name': 'Event %d-%d' % (idx, number),
+                'start': odoo.fields.Datetime.to_string(event_start),
+                'stop': odoo.fields.Datetime.to_string(
+                    event_start + timedelta(hours=1)),
+                'user_id': user.id,
+                'partner_ids': [(6, 0, [user.partner_id.id])],
+            })
+        # the items are generated in the synchronized window
+        server.populate([user.email], contacts=args.contacts,
+                        events=args.events, attendees=args.attendees,
+                        recurring=args.recurring,
+                        attachments=args.attachments,
+                        start=start - timedelta(days=20), days=300)
+    env['exchange.sync.membership']._rebuild()
+    env.cr.commit()
+    return backend
+
+
+def count_items(env, server, backend, entry_point):
+    """ Number of items processed by an entry point """
+    if entry_point.startswith('import'):
+        element = ('Contact' if entry_point == 'import_contact_partners'
+                   else 'CalendarItem')
+        return sum(1 for mailbox in server.mailboxes.values()
+                   for item in mailbox.items.values()
+                   if item.element == element)
+    if entry_point == 'export_contact_partners':
+        users = backend._get_sync_users('export_contact')
+        return sum(len(ids) for ids in
+                   users._get_contacts_by_user().values())
+    users = backend._get_sync_users('export_calendar')
+    return sum(len(user.find_exchange_calendar_events()) for user in users)
+
+
+def modify_items(server, ratio):
+    """ Modify a part of the items of the mailboxes """
+    for mailbox in server.mailboxes.values():
+        items = list(mailbox.items.values())
+        for item in items[:int(len(items) * ratio)]:
+            subject = item.fields['Subject']
+            subject.text = '%s (modified)' % subject.text
+            mailbox.update_item(item)
+
+
+class MemoryPeak(object):
+    """ Peak of the resident memory of the process during a run, above the
+    resident memory at its start
+
+    ``ru_maxrss`` is the peak of the whole process: it never goes down, so
+    the runs after the largest one would all report the same peak. The
+    memory is sampled by a thread instead.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.start = self.peak = 0
+
+    def _rss(self):
+        return self.process.memory_info().rss
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self._rss())
+
+    def __enter__(self):
+        self.start = self.peak = self._rss()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self._rss())
+
+    @property
+    def megabytes(self):
+        return (self.peak - self.start) / 1024. / 1024.
+
+
+def measure(env, server, backend, entry_point):
+    env.invalidate_all()
+    items = count_items(env, server, backend, entry_point)
+    queries = env.cr.sql_log_count
+    requests = server.request_count
+    start = time.time()
+    with MemoryPeak() as memory:
+        getattr(backend, entry_point)()
+        env.cr.commit()
+    duration = time.time() - start
+    queries = env.cr.sql_log_count - queries
+    requests = server.request_count - requests
+    peak_memory = memory.megabytes
+    return {
+        'items': items,
+        'wall_time': round(duration, 3),
+        'items_per_second': round(items / duration, 2) if duration else 0,
+        'ews_calls': requests,
+        'ews_calls_per_item': round(float(requests) / items, 3)
+        if items else 0,
+        'ews_calls_by_operation': dict(server.requests),
+        'sql_queries': queries,
+        'sql_queries_per_item': round(float(queries) / items, 3)
+        if items else 0,
+        'peak_memory_mb': round(peak_memory, 1),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-c', '--config', required=True)
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('-o', '--output', default='bench_sync.json')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--contacts', type=int, default=500,
+                        help="contacts by mailbox")
+    parser.add_argument('--events', type=int, default=200,
+                        help="calendar events by mailbox")
+    parser.add_argument('--attendees', type=int, default=2)
+    parser.add_argument('--recurring', type=float, default=0.1)
+    parser.add_argument('--attachments', type=float, default=0.1)
+    parser.add_argument('--odoo-contacts', type=int, default=50,
+                        help="partners to export by user")
+    parser.add_argument('--odoo-events', type=int, default=50,
+                        help="events to export by user")
+    parser.add_argument('--change-ratio', type=float, default=0.05,
+                        help="ratio of the items modified before the "
+                             "incremental run")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to each EWS response")
+    args = parser.parse_args()
+
+    odoo.tools.config.parse_config(['-c', args.config, '-d', args.database])
+    registry = odoo.registry(args.database)
+    server = MockEWSServer(latency=args.latency).start()
+    results = {
+        'revision': git_revision(),
+        'date': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'dataset': dict((key, value) for key, value in vars(args).items()
+                        if key not in ('config', 'database', 'output')),
+        'runs': {},
+    }
+    try:
+        with odoo.api.Environment.manage(), registry.cursor() as cr:
+            env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+            backend = create_dataset(env, server, args)
+            backend = backend.with_context(test_queue_job_no_delay=True)
+            for run in ('full', 'incremental'):
+                if run == 'incremental':
+                    modify_items(server, args.change_ratio)
+                results['runs'][run] = {}
+                for entry_point in ENTRY_POINTS:
+                    server.reset_counters()
+                    metrics = measure(env, server, backend, entry_point)
+                    results['runs'][run][entry_point] = metrics
+                    print('%-12s %-24s %7d items %9.3f s %8.1f items/s '
+                          '%6.2f EWS/item %7.1f SQL/item %7.1f MB' % (
+                              run, entry_point, metrics['items'],
+                              metrics['wall_time'],
+                              metrics['items_per_second'],
+                              metrics['ews_calls_per_item'],
+                              metrics['sql_queries_per_item'],
+                              metrics['peak_memory_mb']))
+    finally:
+        server.stop()
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print('Results written in %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
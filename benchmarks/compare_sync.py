@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+"""Compare two results of ``bench_sync.py``
+
+Prints the metrics of each run and entry point side by side, with the
+change in percent.
+
+Usage::
+
+    python benchmarks/compare_sync.py before.json after.json
+"""
+
+import argparse
+import json
+
+METRICS = ['items_per_second',
+           'ews_calls_per_item',
+           'sql_queries_per_item',
+           'peak_memory_mb',
+           'wall_time',
+           ]
+
+
+def load(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    before, after = load(args.before), load(args.after)
+    if before['dataset'] != after['dataset']:
+        print('Warning: the datasets differ')
+    print('%s (%s) -> %s (%s)' % (before['revision'], before['date'],
+                                  after['revision'], after['date']))
+    for run in sorted(after['runs']):
+        for entry_point in sorted(after['runs'][run]):
+            old = before['runs'].get(run, {}).get(entry_point)
+            new = after['runs'][run][entry_point]
+            print('\n%s %s' % (run, entry_point))
+            for metric in METRICS:
+                if not old:
+                    print('  %-22s %12s %12.3f' % (metric, '-', new[metric]))
+                    continue
+                change = ''
+                if old[metric]:
+                    change = '%+.1f%%' % (
+                        (new[metric] - old[metric]) * 100. / old[metric])
+                print('  %-22s %12.3f %12.3f %9s' % (
+                    metric, old[metric], new[metric], change))
+
+
+if __name__ == '__main__':
+    main()
@@ -30,10 +30,12 @@
           'views/users_views.xml',
           'views/res_company_view.xml',
           'views/userbackendfolder_views.xml',
+          'views/sync_run_views.xml',
           'data/cron.xml',
           'data/generic_partner.xml',
           'data/changeset_field_rule.xml',
           'data/ir_config_parameter.xml',
+          'data/queue_job_channel.xml',
           ],
  'demo': [
      'demo/backend.xml',
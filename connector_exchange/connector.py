@@ -3,11 +3,23 @@
 # Copyright 2016-2017 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import models, fields, api
+import hashlib
+import logging
+import time
+
+import psycopg2
+
+from odoo import models, fields, api, _
 from odoo.addons.queue_job.job import job
 
 from .unit.exporter import ExchangeExporter, ExchangeDisabler
 from .unit.importer import ExchangeImporter
+from .unit.instrumentation import instrumented_job
+from .unit.snapshot import (content_hash, dump_snapshot, load_snapshot,
+                            record_values)
+from .unit.throttle import is_postponed, retry_when_throttled
+
+_logger = logging.getLogger(__name__)
 
 
 class ExchangeBinding(models.AbstractModel):
@@ -28,6 +40,21 @@ class ExchangeBinding(models.AbstractModel):
                               required=True,
                               ondelete='cascade')
     change_key = fields.Char("Change Key")
+    content_hash = fields.Char(
+        string='Hash of the Exchange Values',
+        readonly=True,
+        copy=False,
+        help="Hash of the values of the last import, an import is skipped "
+             "when they did not change",
+    )
+    odoo_hash = fields.Char(
+        string='Hash of the Odoo Values',
+        readonly=True,
+        copy=False,
+        help="Hash of the synchronized values of the record after its "
+             "last import or export, an export is skipped when they did "
+             "not change",
+    )
     current_folder = fields.Char(compute='_compute_folder_create_id',
                                  readonly=True)
     delete_folder = fields.Char(compute='_compute_folder_delete_id',
@@ -37,60 +64,361 @@ class ExchangeBinding(models.AbstractModel):
     calendar_folder = fields.Char(compute='_compute_folder_calendar_id',
                                   readonly=True)
 
+    # Odoo fields synchronized with Exchange
+    _exchange_fields = []
+
     _sql_constraints = [('exchange_uniq',
                          'unique(backend_id, external_id, user_id)',
                          'A binding already exists with the same '
                          'Exchange ID for the same record.')]
 
+    @api.multi
+    def _compute_folder(self, field_name, folder_type, binding_user=False):
+        """ Set the Exchange ID of the folders of the bindings
+
+        The folders are resolved once by backend for all the bindings.
+
+        :param binding_user: use the folder of the user of the binding
+                             instead of the folder of the current user
+        """
+        for binding in self:
+            binding[field_name] = False
+        for backend in self.mapped('backend_id'):
+            bindings = self.filtered(lambda b: b.backend_id == backend)
+            if binding_user:
+                users = bindings.mapped('user_id')
+            else:
+                users = self.env.user
+            folders = users.find_folders(backend.id, folder_type)
+            for binding in bindings:
+                user = binding.user_id if binding_user else self.env.user
+                binding[field_name] = folders[user.id].folder_id
+
     @api.depends()
     def _compute_folder_create_id(self):
-        for binding in self:
-            binding.current_folder = self.env.user.find_folder(
-                binding.backend_id.id,
-                create=False,
-                folder_type='create',
-            )
+        self._compute_folder('current_folder', 'create')
 
     @api.depends()
     def _compute_folder_delete_id(self):
-        for binding in self:
-            binding.delete_folder = self.env.user.find_folder(
-                binding.backend_id.id,
-                create=False,
-                folder_type='delete',
-            )
+        self._compute_folder('delete_folder', 'delete')
 
     @api.depends()
     def _compute_folder_contact_id(self):
-        for binding in self:
-            binding.contact_folder = self.env.user.find_folder(
-                binding.backend_id.id,
-                create=False,
-                folder_type='contact',
-            )
+        self._compute_folder('contact_folder', 'contact')
 
     @api.depends()
     def _compute_folder_calendar_id(self):
-        for binding in self:
-            binding.calendar_folder = self.env.user.find_folder(
-                binding.backend_id.id,
-                create=False,
-                folder_type='calendar',
-            ).folder_id
+        self._compute_folder('calendar_folder', 'calendar')
+
+    @api.multi
+    def _get_sync_values(self):
+        """ Current values of the synchronized fields """
+        self.ensure_one()
+        return record_values(self, self._exchange_fields)
+
+    @api.multi
+    def _get_odoo_hash(self):
+        """ Hash of the current values of the synchronized fields """
+        return content_hash(self._get_sync_values())
+
+    @api.multi
+    def _set_synced(self, change_key=None, external_id=None):
+        """ Keep the state of the binding after an import or an export
+
+        The hash and the snapshot of the synchronized values are written,
+        with the changekey and the ID of the Exchange item when given.
+        """
+        self.ensure_one()
+        values = self._get_sync_values()
+        vals = {'odoo_hash': content_hash(values)}
+        if change_key:
+            vals['change_key'] = change_key
+        if external_id:
+            vals['external_id'] = external_id
+        self.with_context(connector_no_export=True).write(vals)
+        self.env.cr.execute("""
+            INSERT INTO exchange_binding_snapshot (model, binding_id, data)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (model, binding_id) DO UPDATE SET data = EXCLUDED.data
+        """, (self._name, self.id, psycopg2.Binary(dump_snapshot(values))))
+
+    @api.multi
+    def _get_snapshot(self):
+        """ Synchronized values after the last import or export
+
+        :returns: dict of values, None when the binding has no snapshot
+        """
+        self.ensure_one()
+        self.env.cr.execute("""
+            SELECT data FROM exchange_binding_snapshot
+            WHERE model = %s AND binding_id = %s
+        """, (self._name, self.id))
+        row = self.env.cr.fetchone()
+        return load_snapshot(row[0]) if row else None
+
+    @api.multi
+    def unlink(self):
+        if self.ids:
+            self.env.cr.execute("""
+                DELETE FROM exchange_binding_snapshot
+                WHERE model = %s AND binding_id IN %s
+            """, (self._name, tuple(self.ids)))
+        return super(ExchangeBinding, self).unlink()
+
+    @api.model
+    def _create_binding(self, vals):
+        """ Create a binding, or get the one with the same Exchange ID
+
+        The binding is inserted with ``ON CONFLICT DO NOTHING`` on its
+        unique constraint, so the concurrent imports of an item do not need
+        a lock: the first one creates the binding. The Odoo record created
+        by the others is rolled back. When the binding of the winner is not
+        committed yet, PostgreSQL waits for it, then raises a serialization
+        failure and the job is retried.
+
+        :returns: tuple (binding, True if it has been created)
+        """
+        parent_model, parent_field = list(self._inherits.items())[0]
+        parent_vals = {}
+        binding_vals = {}
+        for name, value in vals.iteritems():
+            field = self._fields.get(name)
+            if field is not None and field.inherited:
+                parent_vals[name] = value
+            else:
+                binding_vals[name] = value
+        key = [binding_vals.pop('backend_id'),
+               binding_vals.pop('external_id'),
+               binding_vals.pop('user_id')]
+        cr = self.env.cr
+        cr.execute('SAVEPOINT exchange_create_binding')
+        parent = self.env[parent_model].create(parent_vals)
+        cr.execute("""
+            INSERT INTO %s (backend_id, external_id, user_id, %s,
+                            create_uid, create_date, write_uid, write_date)
+            VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)
+            ON CONFLICT (backend_id, external_id, user_id) DO NOTHING
+            RETURNING id
+        """ % (self._table, parent_field),
+            key + [parent.id, self.env.uid, fields.Datetime.now(),
+                   self.env.uid, fields.Datetime.now()])
+        row = cr.fetchone()
+        if row:
+            cr.execute('RELEASE SAVEPOINT exchange_create_binding')
+            binding = self.browse(row[0])
+            if binding_vals:
+                binding.write(binding_vals)
+            return binding, True
+        cr.execute('ROLLBACK TO SAVEPOINT exchange_create_binding')
+        self.invalidate_cache()
+        binding = self.search([('backend_id', '=', key[0]),
+                               ('external_id', '=', key[1]),
+                               ('user_id', '=', key[2])])
+        return binding, False
+
+    @api.model
+    def _get_synced_change_keys(self, backend, user, external_ids=None):
+        """ Changekeys of the items as they were last imported or exported
+
+        :returns: dict {external id: changekey}
+        """
+        query = ("SELECT external_id, change_key FROM %s "
+                 "WHERE backend_id = %%s AND user_id = %%s "
+                 "AND change_key IS NOT NULL" % self._table)
+        params = [backend.id, user.id]
+        if external_ids is not None:
+            query += " AND external_id IN %s"
+            params.append(tuple(external_ids) or (None,))
+        self.env.cr.execute(query, params)
+        return dict(self.env.cr.fetchall())
 
     @api.multi
     def get_backend(self):
         self.ensure_one()
         return self.backend_id
 
+    @api.model
+    def _import_identity_key(self, backend, user, item_id=''):
+        """ Identity key of the job importing an item for a user
+
+        Without ``item_id``, returns the prefix shared by the keys of all
+        the items of the user.
+        """
+        return 'exchange-import-%s-%d-%d-%s' % (self._name, backend.id,
+                                                user.id, item_id)
+
+    @api.model
+    def _import_batch_identity_key(self, backend, user, item_ids=None):
+        """ Identity key of the job importing a batch of items for a user
+
+        Without ``item_ids``, returns the prefix shared by the keys of all
+        the batches of the user.
+        """
+        digest = ''
+        if item_ids:
+            digest = hashlib.sha1(
+                ','.join(sorted(item_ids)).encode('utf-8')).hexdigest()
+        return 'exchange-import-batch-%s-%d-%d-%s' % (
+            self._name, backend.id, user.id, digest)
+
+    @api.multi
+    def _export_identity_key(self, fields=None):
+        self.ensure_one()
+        return 'exchange-export-%s-%d-%s' % (self._name, self.id,
+                                             ','.join(sorted(fields or [])))
+
+    @api.multi
+    def _delete_identity_key(self, external_id):
+        self.ensure_one()
+        return 'exchange-delete-%s-%d-%s' % (self._name, self.id, external_id)
+
+    @api.model
+    def _get_pending_import_keys(self, backend, user):
+        """ Identity keys of the import jobs of a user not started yet
+
+        The items of the pending batches are included, with the key of
+        the job which would import them alone.
+        """
+        prefix = self._import_identity_key(backend, user)
+        jobs = self.env['queue.job'].sudo().search_read(
+            [('identity_key', '=like', prefix + '%'),
+             ('state', 'in', ('pending', 'enqueued'))],
+            ['identity_key'],
+        )
+        keys = set(job_['identity_key'] for job_ in jobs)
+        batch_prefix = self._import_batch_identity_key(backend, user)
+        batches = self.env['queue.job'].sudo().search(
+            [('identity_key', '=like', batch_prefix + '%'),
+             ('state', 'in', ('pending', 'enqueued'))],
+        )
+        for batch in batches:
+            # arguments of import_batch: backend, user, item_ids
+            keys.update(self._import_identity_key(backend, user, item_id)
+                        for item_id in batch.args[2])
+        return keys
+
+    @api.model
+    def _delay_import_record(self, backend, user, item_id,
+                             pending_keys=None, delayed_jobs=None,
+                             **job_kwargs):
+        """ Delay the import of an item, unless it is already pending
+
+        :param pending_keys: keys returned by ``_get_pending_import_keys``,
+                             given to avoid a query by item
+        :param delayed_jobs: list to which the delayed job is appended
+        :returns: True if a job has been delayed
+        """
+        key = self._import_identity_key(backend, user, item_id)
+        if pending_keys is not None:
+            if key in pending_keys:
+                return False
+            pending_keys.add(key)
+        job_ = self.with_delay(identity_key=key, **job_kwargs).import_record(
+            backend, user, item_id)
+        if delayed_jobs is not None:
+            delayed_jobs.append(job_)
+        return True
+
+    @api.model
+    def _delay_import_batch(self, backend, user, item_ids,
+                            pending_keys=None, delayed_jobs=None,
+                            **job_kwargs):
+        """ Delay the import of items by a single job, for the backends
+        in bulk import mode
+
+        :param pending_keys: keys returned by ``_get_pending_import_keys``,
+                             the items already pending are left out
+        :param delayed_jobs: list to which the delayed job is appended
+        :returns: number of items delayed
+        """
+        if pending_keys is not None:
+            keys = [self._import_identity_key(backend, user, item_id)
+                    for item_id in item_ids]
+            item_ids = [item_id for key, item_id in zip(keys, item_ids)
+                        if key not in pending_keys]
+            pending_keys.update(keys)
+        if item_ids:
+            key = self._import_batch_identity_key(backend, user, item_ids)
+            job_ = self.with_delay(
+                identity_key=key, **job_kwargs
+            ).import_batch(backend, user, item_ids)
+            if delayed_jobs is not None:
+                delayed_jobs.append(job_)
+        return len(item_ids)
+
+    @api.model
+    def _remove_exchange_items(self, backend, user, external_ids):
+        """ Called when items of a user have been deleted in Exchange
+
+        The bindings are removed, the Odoo records are kept.
+
+        :returns: number of bindings removed
+        """
+        bindings = self.search([('backend_id', '=', backend.id),
+                                ('user_id', '=', user.id),
+                                ('external_id', 'in', list(external_ids))])
+        # without external ID, the deletion is not exported to Exchange
+        bindings.with_context(connector_no_export=True).write(
+            {'external_id': False})
+        bindings.unlink()
+        return len(bindings)
+
     @job
+    @retry_when_throttled
+    @instrumented_job
     def import_record(self, backend, user, item_id):
         """ Import a record from Exchange """
         with backend.get_environment(self._name) as connector_env:
             importer = connector_env.get_connector_unit(ExchangeImporter)
-            importer.run(item_id, user)
+            return importer.run(item_id, user)
+
+    @job
+    @retry_when_throttled
+    @instrumented_job
+    def import_batch(self, backend, user, item_ids):
+        """ Import a batch of records from Exchange
+
+        The computed fields are recomputed once, at the end of the batch.
+        Each item is imported in a savepoint: the items which fail are
+        delayed again, one job by item, so they do not fail the batch.
+        The errors which are not caused by an item (throttling, server
+        unavailable, concurrent update) postpone the whole batch.
+        """
+        start = time.time()
+        failed = []
+        with backend.get_environment(self._name) as connector_env:
+            with self.env.norecompute():
+                for item_id in item_ids:
+                    importer = connector_env.get_connector_unit(
+                        ExchangeImporter)
+                    try:
+                        with self.env.cr.savepoint():
+                            importer.run(item_id, user)
+                    except psycopg2.OperationalError:
+                        raise
+                    except Exception as err:
+                        if is_postponed(err):
+                            raise
+                        _logger.exception('Import of %s %s of %s failed, '
+                                          'delayed alone', self._name,
+                                          item_id, user.login)
+                        self.invalidate_cache()
+                        failed.append(item_id)
+            self.recompute()
+        for item_id in failed:
+            self._delay_import_record(backend, user, item_id, priority=30)
+        imported = len(item_ids) - len(failed)
+        seconds = time.time() - start
+        rate = imported / seconds if seconds else 0
+        _logger.info('%d %s of %s imported in %.1f s (%.1f items/s), '
+                     '%d failed', imported, self._name, user.login, seconds,
+                     rate, len(failed))
+        return _('%d records imported in %.1f seconds (%.1f by second), '
+                 '%d delayed again') % (imported, seconds, rate, len(failed))
 
     @job
+    @retry_when_throttled
+    @instrumented_job
     def export_record(self, fields=None):
         """ Export a record from Exchange """
         self.ensure_one()
@@ -99,6 +427,8 @@ class ExchangeBinding(models.AbstractModel):
             return exporter.run(self, fields=fields)
 
     @job
+    @retry_when_throttled
+    @instrumented_job
     def export_delete_record(self, external_id, user):
         """ Delete a record on Exchange """
         self.ensure_one()
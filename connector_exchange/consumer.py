@@ -8,7 +8,9 @@ def delay_export(record, vals):
     if record.env.context.get('connector_no_export'):
         return
     fields = vals.keys()
-    record.with_delay().export_record(fields=fields)
+    record.with_delay(
+        identity_key=record._export_identity_key(fields),
+    ).export_record(fields=fields)
 
 
 def delay_export_all_bindings(record, vals):
@@ -20,11 +22,15 @@ def delay_export_all_bindings(record, vals):
         return
     fields = vals.keys()
     for binding in record.exchange_bind_ids:
-        binding.with_delay().export_record(fields=fields)
+        binding.with_delay(
+            identity_key=binding._export_identity_key(fields),
+        ).export_record(fields=fields)
 
 
 def delay_disable_all_bindings(record):
     for binding in record.exchange_bind_ids:
-        binding.with_delay().export_delete_record(
+        binding.with_delay(
+            identity_key=binding._delete_identity_key(binding.external_id),
+        ).export_delete_record(
             binding.external_id,
             binding.user_id)
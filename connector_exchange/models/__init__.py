@@ -5,3 +5,7 @@ from . import exchange_backend
 from . import res_partner
 from . import calendar_event
 from . import res_users
+from . import sync_membership
+from . import sync_lease
+from . import sync_run
+from . import sync_window
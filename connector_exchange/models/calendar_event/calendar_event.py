@@ -8,6 +8,8 @@ import logging
 from odoo import models, fields, api
 from odoo import tools
 from odoo.addons.calendar.models.calendar import calendar_id2real_id
+
+from .exporter import EXPORTED_FIELDS
 _logger = logging.getLogger(__name__)
 
 
@@ -38,30 +40,42 @@ class CalendarEvent(models.Model):
     send_calendar_invitations = fields.Boolean('Send invitations on my behalf',
                                                default=False)
 
+    @api.multi
+    def _exchange_real_ids(self):
+        """ Return the ids of the events stored in database """
+        return list(set([calendar_id2real_id(calendar_id=cal.id)
+                         for cal in self]))
+
+    @api.multi
+    def _exchange_bind(self, user, backend):
+        """ Return the bindings of the events for ``user`` on ``backend``
+
+        Missing bindings are created but not exported.
+        """
+        bindings = self.env['exchange.calendar.event']
+        for calendar in self.browse(self._exchange_real_ids()):
+            calendar_bindings = calendar.exchange_bind_ids.filtered(
+                lambda a: a.backend_id == backend and a.user_id == user and
+                a['privacy'] != 'private')
+            if not calendar_bindings:
+                calendar_bindings = bindings.sudo().with_context(
+                    connector_no_export=True,
+                ).create({'backend_id': backend.id,
+                          'user_id': user.id,
+                          'openerp_id': calendar.id})
+            bindings |= calendar_bindings
+        return bindings
+
     @api.multi
     def try_autobind(self, user, backend):
         """
             Try to find a binding with provided backend and user.
             If not found, create a new one.
         """
-        real_calendars = (
-            list(set([calendar_id2real_id(calendar_id=cal.id) for cal in self])
-                 )
-        )
         if self.env.context.get('connector_no_export', False):
             return True
-        else:
-            for calendar in self.browse(real_calendars):
-                bindings = calendar.exchange_bind_ids.filtered(
-                    lambda a: a.backend_id == backend and a.user_id == user and
-                    a['privacy'] != 'private')
-                if not bindings:
-                    bindings = self.env['exchange.calendar.event'].sudo(
-                    ).create({'backend_id': backend.id,
-                              'user_id': user.id,
-                              'openerp_id': calendar.id})
-                for b in bindings:
-                    b.export_record()
+        for b in self._exchange_bind(user, backend):
+            b.export_record()
         return True
 
     @api.model
@@ -75,9 +89,14 @@ class CalendarEvent(models.Model):
             no_mail = True
         new_event = super(CalendarEvent, self.with_context(
             no_mail_to_attendees=no_mail)).create(values)
-        if not self.env.context.get('connector_no_export'):
-            new_event.try_autobind(new_event.user_id,
-                                   new_event.user_id.default_backend)
+        self.env['exchange.sync.membership']._refresh_events(
+            new_event._exchange_real_ids())
+        backend = new_event.user_id.default_backend
+        if not self.env.context.get('connector_no_export') and backend:
+            # only register the binding, the export is done by a batched
+            # job once the transaction is committed
+            new_event._exchange_bind(new_event.user_id, backend)
+            backend.delay_export_calendar_batch(new_event.user_id)
         return new_event
 
     @api.multi
@@ -87,47 +106,39 @@ class CalendarEvent(models.Model):
                 if binding.external_id:
                     binding.export_delete_record(
                         binding.external_id, rec.user_id)
+        real_ids = self._exchange_real_ids()
         super(CalendarEvent, self).unlink()
+        self.env['exchange.sync.membership']._refresh_events(real_ids)
 
     @api.multi
     def write(self, values):
         """Overload write method to trigger connector events"""
         # FIXME: manage alteration of recurrent events
-        for rec in self:
-            user = values.get('user_id')
-            if not user:
-                user = rec.user_id.id
-            no_mail = False
-            if rec.send_calendar_invitations:
-                no_mail = True
-            super(CalendarEvent, rec.sudo().with_context(
+        with_invitations = self.filtered('send_calendar_invitations')
+        groups = [(with_invitations, True),
+                  (self - with_invitations, False)]
+        for records, no_mail in groups:
+            if not records:
+                continue
+            super(CalendarEvent, records.sudo().with_context(
                 no_mail_to_attendees=no_mail)).write(values)
-            if isinstance(rec.id, basestring):
-                if '-' in rec.id:
-                    # we have a virtual recurrent event linked
-                    # to a real on stored in database
-                    if not values.get('active', True):
-                        # an event has been deactivated
-                        # 1. find real id behind the one we are on
-                        real_id = calendar_id2real_id(calendar_id=rec.id)
-
-                        # 2. create a delete event on the real id
-                        # previously found
-                        self.browse(real_id).with_context(
-                            connector_no_export=True,
-                            no_mail_to_attendees=no_mail).unlink()
-
-            else:
-                # we are dealing with a real event
-                # (single or detached from a recurrency)
-                if rec.recurrent_id:
-                    # we have to update or delete an occurrence
-                    # of the original event
-                    pass
-                else:
-                    # single event
-                    # nothing to do. Already managed by connector
-                    pass
+        if 'user_id' in values or 'active' in values:
+            self.env['exchange.sync.membership']._refresh_events(
+                self._exchange_real_ids())
+
+        if not values.get('active', True):
+            # virtual recurrent events linked to a real one stored in
+            # database have been deactivated: delete the real events
+            for records, no_mail in groups:
+                real_ids = list(set(
+                    calendar_id2real_id(calendar_id=rec_id)
+                    for rec_id in records.ids
+                    if isinstance(rec_id, basestring) and '-' in rec_id
+                ))
+                if real_ids:
+                    self.browse(real_ids).with_context(
+                        connector_no_export=True,
+                        no_mail_to_attendees=no_mail).unlink()
         return True
 
     @api.multi
@@ -212,6 +223,8 @@ class ExchangeCalendarEvent(models.Model):
     _inherits = {'calendar.event': 'openerp_id'}
     _description = 'Exchange Calendar Event'
 
+    _exchange_fields = sorted(EXPORTED_FIELDS)
+
     openerp_id = fields.Many2one(comodel_name='calendar.event',
                                  string='Calendar Event',
                                  required=True,
@@ -223,12 +236,57 @@ class ExchangeCalendarEvent(models.Model):
     calendar_folder = fields.Char(compute='_compute_folder_calendar_id',
                                   readonly=True)
 
+    @api.model_cr
+    def init(self):
+        self.env.cr.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE indexname = 'exchange_calendar_event_backend_user_idx'
+        """)
+        if not self.env.cr.fetchone():
+            self.env.cr.execute("""
+                CREATE INDEX exchange_calendar_event_backend_user_idx
+                ON exchange_calendar_event (backend_id, user_id)
+            """)
+
+    @api.model
+    def _get_unseen_events(self, backend, user, folder, date_from, date_to):
+        """ Return the events of a user in a period not seen in Exchange
+
+        The Exchange IDs seen during the enumeration of the folder are read
+        from the ``exchange_seen_item`` table.
+
+        :returns: dict {Exchange ID: calendar.event id}
+        """
+        self.env.cr.execute("""
+            SELECT b.external_id, b.openerp_id
+            FROM exchange_calendar_event b
+            JOIN calendar_event e ON e.id = b.openerp_id
+            WHERE b.backend_id = %s
+            AND b.user_id = %s
+            AND b.external_id IS NOT NULL
+            AND e.start <= %s
+            AND e.stop >= %s
+            AND NOT EXISTS (
+                SELECT 1 FROM exchange_seen_item s
+                WHERE s.folder_id = %s
+                AND s.external_id = b.external_id
+            )
+        """, (backend.id, user.id, date_to, date_from, folder.id))
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _remove_exchange_items(self, backend, user, external_ids):
+        """ The events deleted in Exchange are deleted in Odoo
+
+        Same as the events not found anymore by the enumeration.
+        """
+        bindings = self.search([('backend_id', '=', backend.id),
+                                ('user_id', '=', user.id),
+                                ('external_id', 'in', list(external_ids))])
+        bindings.mapped('openerp_id').with_context(
+            connector_no_export=True).unlink()
+        return len(bindings)
+
     @api.depends()
     def _compute_folder_calendar_id(self):
-        for binding in self:
-            binding.calendar_folder = self.env.user.find_folder(
-                binding.backend_id.id,
-                create=False,
-                folder_type='calendar',
-                user=binding.user_id,
-            ).folder_id
+        self._compute_folder('calendar_folder', 'calendar', binding_user=True)
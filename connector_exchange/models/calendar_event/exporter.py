@@ -12,6 +12,7 @@ from odoo.tools import (DEFAULT_SERVER_DATE_FORMAT,
 from ...unit.exporter import (ExchangeExporter,
                               ExchangeDisabler)
 from ...backend import exchange_2010
+from .mapping import EVENT_MAPPING
 
 _logger = logging.getLogger(__name__)
 
@@ -25,6 +26,14 @@ except (ImportError, IOError) as err:
 EXCHANGE_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 EXCHANGE_REC_DATE_FORMAT = '%Y-%m-%d'
 
+EXPORTED_FIELDS = frozenset(
+    [field.odoo for field in EVENT_MAPPING.fields
+     if field.direction != 'import'] +
+    ['start', 'stop', 'allday', 'privacy', 'show_as', 'alarm_ids',
+     'partner_ids', 'attendee_ids', 'recurrency', 'rrule',
+     'send_calendar_invitations']
+)
+
 
 # UTILITY FUNTIONS
 def get_exchange_month_from_date(month):
@@ -58,13 +67,6 @@ def convert_to_exchange(date, time=False, rec=False, add_day=False):
     return odoo_dt.strftime(EXCHANGE_DATETIME_FORMAT)
 
 
-# MAPPINGS DECLARATION
-SIMPLE_VALUE_FIELDS = {'name': 'subject',
-                       'location': 'location',
-                       'description': 'body',
-                       }
-
-
 @exchange_2010
 class CalendarEventExporter(ExchangeExporter):
     _model_name = ['exchange.calendar.event']
@@ -290,17 +292,7 @@ class CalendarEventExporter(ExchangeExporter):
         """
 
         """
-        if fields is None:
-            fields = SIMPLE_VALUE_FIELDS.keys()
-
-        for f, v in SIMPLE_VALUE_FIELDS.iteritems():
-            if fields is not None and f not in fields:
-                continue
-            odoo_value = getattr(self.binding, f)
-            if not odoo_value:
-                continue
-            event.__setattr__(v, odoo_value)
-
+        EVENT_MAPPING.map_export(self.binding, event, fields=fields)
         self.fill_start_end(event)
         self.fill_privacy(event)
         self.fill_free_busy_status(event)
@@ -352,7 +344,7 @@ class CalendarEventExporter(ExchangeExporter):
             run a delayed job for the exchange record
         """
         user = self.env['res.users'].browse(user_id)
-        return self.env['exchange.calendar.event'].with_delay().import_record(
+        return self.env['exchange.calendar.event']._delay_import_record(
             self.backend_record,
             user,
             calendar_event_instance.item_id,
@@ -374,10 +366,8 @@ class CalendarEventExporter(ExchangeExporter):
         if not record:
             return _('Nothing to export.')
         response = self._update(record)
-        self.binding.with_context(
-            connector_no_export=True).write(
-            {'external_id': response.item_id,  # in case of convertId
-             'change_key': response.changekey})
+        # the ID changes in case of convertId
+        self._set_synced(response)
 
     def change_key_equals(self, exchange_record):
         return (
@@ -393,8 +383,7 @@ class CalendarEventExporter(ExchangeExporter):
 
         if not external_id:
             exchange_record = self.create_exchange_calendar_event(fields)
-            self.binding.external_id = exchange_record.id
-            self.binding.change_key = exchange_record.changekey
+            self._set_synced(exchange_record)
         else:
             adapter = self.backend_adapter
             account = adapter.get_account(self.openerp_user)
@@ -408,7 +397,9 @@ class CalendarEventExporter(ExchangeExporter):
                     # update contact
                     self.update_existing(exchange_record, fields)
                 else:
-                    # run a delayed import of this Exchange contact
+                    # the recurrence, attendees and attachments of an
+                    # event cannot be merged, run a delayed import of
+                    # this Exchange event
                     self.run_delayed_import_of_exchange_calendar_event(
                         user.id,
                         exchange_record)
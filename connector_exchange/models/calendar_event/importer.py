@@ -9,9 +9,9 @@ import logging
 
 import datetime
 from ...backend import exchange_2010
-from ...unit.importer import (ExchangeImporter,
-                              RETRY_ON_ADVISORY_LOCK,
-                              )
+from ...unit.importer import ExchangeImporter
+from .mapping import EVENT_MAPPING
+from odoo import _
 from odoo.tools import (DEFAULT_SERVER_DATETIME_FORMAT,
                         DEFAULT_SERVER_DATE_FORMAT,
                         )
@@ -26,11 +26,6 @@ except (ImportError, IOError) as err:
 EXCHANGE_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 EXCHANGE_REC_DATE_FORMAT = '%Y-%m-%d'
 
-SIMPLE_VALUE_FIELDS = {'subject': 'name',
-                       'location': 'location',
-                       'body': 'description',
-                       }
-
 FREE_LIST = ['Free', 'Busy']
 
 
@@ -273,12 +268,7 @@ class CalendarEventImporter(ExchangeImporter):
         return vals
 
     def map_exchange_instance(self, event_instance):
-        vals = {}
-
-        for ex_field, odoo_mapping in SIMPLE_VALUE_FIELDS.iteritems():
-            if isinstance(odoo_mapping, basestring):
-                vals[odoo_mapping] = getattr(event_instance, ex_field)
-
+        vals = EVENT_MAPPING.map_import(event_instance, self.env)
         vals.update(self.fill_start_end(event_instance))
         vals.update(self.fill_privacy(event_instance))
         vals.update(self.fill_free_busy_status(event_instance))
@@ -296,13 +286,35 @@ class CalendarEventImporter(ExchangeImporter):
             from exchange record, create an odoo dict than can be user
             both in write and create methods
         """
-        event_id = self.external_id
-        adapter = self.backend_adapter
-        account = adapter.get_account(self.openerp_user)
+        return self.map_exchange_instance(self.external_record)
 
-        event = account.calendar.get(id=event_id)
-        vals = self.map_exchange_instance(event)
-        return vals
+    def _get_exchange_record(self):
+        account = self.backend_adapter.get_account(self.openerp_user)
+        return account.calendar.get(id=self.external_id)
+
+    def _content_hash(self, data):
+        """ Stable hash of the values mapped from Exchange
+
+        The attachments and the modified or deleted occurrences are
+        imported after the mapped values, by ``bind_attachments`` and
+        ``manage_modified_deleted_occurrences``: their IDs and starts are
+        part of the hash, so a change of only these is imported.
+        """
+        event = self.external_record
+        values = dict(data)
+        values['attachments'] = sorted(
+            attachment.attachment_id.id
+            for attachment in event.attachments or []
+        )
+        values['modified_occurrences'] = sorted(
+            (occurrence.item_id, occurrence.start, occurrence.end)
+            for occurrence in event.modified_occurrences or []
+        )
+        values['deleted_occurrences'] = sorted(
+            occurrence.start
+            for occurrence in event.deleted_occurrences or []
+        )
+        return super(CalendarEventImporter, self)._content_hash(values)
 
     def bind_attachments(self, binding, event_id):
         """
@@ -534,27 +546,14 @@ class CalendarEventImporter(ExchangeImporter):
     def _run(self, item_id, user_id):
         """ Beginning of the synchronization
 
-        The first thing we do is to try to acquire an advisory lock
-        on Postgresql. If it can't be acquired it means that another job
-        does the same import at the same moment.
-        The goal is to prevent 2 jobs to create the same binding because
-        they each job is not aware of the other binding.
-        It happens easily when 2 jobs import the same dependencies (such
-        as partner categories for an import of partners).
+        The jobs importing the same event at the same moment are not
+        locked: the first one creates the binding, the others update it
+        (see ``exchange.binding._create_binding``).
 
         :param item_id: item_id
         """
         self.openerp_user = user_id
         self.external_id = item_id
-        lock_name = 'import({}, {}, {}, {})'.format(
-            self.backend_record._name,
-            self.backend_record.id,
-            self.model._name,
-            self.external_id,
-        )
-        # Keep a lock on this import until the transaction is committed
-        self.advisory_lock_or_retry(lock_name,
-                                    retry_seconds=RETRY_ON_ADVISORY_LOCK)
 
         skip = self._must_skip()
         if skip:
@@ -578,12 +577,20 @@ class CalendarEventImporter(ExchangeImporter):
                 ('external_id', '=', event_id)]
         exchange_events = self.env['exchange.calendar.event'].search(args)
         self.exchange_events = exchange_events
+        self.external_record = self._get_exchange_record()
+        if exchange_events and self._is_echo(exchange_events[0]):
+            return _('Already up-to-date.')
+
         data = self._map_data()
         data.update(user_id=self.openerp_user.id,
                     backend_id=self.backend_record.id)
 
+        if exchange_events and self._is_unchanged(exchange_events[0], data):
+            return _('Already up-to-date.')
+
         if not exchange_events:
             _logger.debug('does not exist --> CREATE')
+            data['content_hash'] = self._content_hash(data)
             binding = self._create(data)
             binding.openerp_id.user_id = self.openerp_user.id
         else:
@@ -594,6 +601,7 @@ class CalendarEventImporter(ExchangeImporter):
         self.bind_attachments(binding, event_id)
 
         self.manage_modified_deleted_occurrences(binding, event_id)
+        self._set_synced(binding)
 
     def _update(self, binding, data, context_keys=None):
         """ Update an Odoo record """
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+""" Mapping of the events and the Exchange calendar items
+
+The dates, the attendees, the reminder and the recurrence are mapped by
+the ``fill_*`` methods of the importer and the exporter.
+"""
+
+from ...unit.mapper import MappedField, MappingSpec
+
+EVENT_MAPPING = MappingSpec([
+    MappedField('name', 'subject'),
+    MappedField('location', 'location'),
+    MappedField('description', 'body'),
+])
@@ -4,18 +4,33 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import logging
-from odoo import models, fields, api
+import time
+from datetime import datetime, timedelta
+
+from odoo import models, fields, api, tools, _
+from odoo.exceptions import ValidationError
 
 from odoo.addons.connector.connector import ConnectorEnvironment
+from odoo.addons.queue_job.job import job, identity_exact
 from odoo.addons.base.res.res_partner import _tz_get
 
 from ..res_partner.adapter import PartnerBackendAdapter
 from ..calendar_event.adapter import EventBackendAdapter
+from ...unit.backend_adapter import ExchangeAdapter
+from ...unit.instrumentation import (collect_ews_stats, instrumented_job,
+                                     store_job_stats)
+from ...unit.throttle import retry_when_throttled
 
 _logger = logging.getLogger(__name__)
 
 try:
-    from exchangelib import EWSDateTime, EWSTimeZone
+    from exchangelib import EWSDateTime, EWSTimeZone, Q
+    from exchangelib.errors import (ErrorExpiredSubscription,
+                                    ErrorInvalidPullSubscriptionId,
+                                    ErrorItemNotFound,
+                                    ErrorInvalidSubscription,
+                                    ErrorInvalidWatermark,
+                                    ErrorSubscriptionNotFound)
 except (ImportError, IOError) as err:
     _logger.debug(err)
 
@@ -25,6 +40,78 @@ try:
 except (ImportError, IOError) as err:
     _logger.debug(err)
 
+SYNC_KINDS = [('import_contact', 'Import Contacts'),
+              ('export_contact', 'Export Contacts'),
+              ('import_calendar', 'Import Calendars'),
+              ('export_calendar', 'Export Calendars'),
+              ('listen', 'Listen to Notifications'),
+              ]
+
+# minutes after which a pull subscription not polled expires on Exchange
+SUBSCRIPTION_TIMEOUT = 10
+
+SEEN_ITEMS_PAGE_SIZE = 1000
+
+SENSITIVITIES = ['Normal', 'Personal', 'Private', 'Confidential']
+
+
+def _split_list(value):
+    """ Values of a comma-separated list """
+    return [part.strip() for part in (value or '').split(',')
+            if part.strip()]
+
+
+class SeenItems(object):
+    """ Exchange IDs seen during the enumeration of a folder
+
+    The IDs are inserted by pages in the ``exchange_seen_item`` table, so
+    they can be compared to the bindings in SQL once the folder has been
+    fully enumerated, possibly over several runs. The table is unlogged:
+    it is emptied by a crash of PostgreSQL, and the enumeration has to
+    start over (see ``is_lost``).
+    """
+
+    def __init__(self, cr, folder, page_size=SEEN_ITEMS_PAGE_SIZE):
+        self.cr = cr
+        self.folder_id = folder.id
+        self.page_size = page_size
+        self.count = 0
+        self._page = []
+
+    def add(self, external_id):
+        self.count += 1
+        self._page.append(external_id)
+        if len(self._page) >= self.page_size:
+            self.flush()
+
+    def flush(self):
+        if self._page:
+            self.cr.execute("""
+                INSERT INTO exchange_seen_item (folder_id, external_id)
+                SELECT %s, unnest(%s)
+            """, (self.folder_id, self._page))
+            self._page = []
+
+    def clear(self):
+        self._page = []
+        self.cr.execute("DELETE FROM exchange_seen_item WHERE folder_id = %s",
+                        (self.folder_id,))
+        # marks the enumeration as started, even if no item is seen
+        self.cr.execute("""
+            INSERT INTO exchange_seen_item (folder_id, external_id)
+            VALUES (%s, '')
+        """, (self.folder_id,))
+
+    def is_lost(self):
+        """ True when the IDs of the pages already enumerated are missing """
+        self.cr.execute("""
+            SELECT 1 FROM exchange_seen_item WHERE folder_id = %s LIMIT 1
+        """, (self.folder_id,))
+        return not self.cr.fetchone()
+
+    def analyze(self):
+        self.cr.execute("ANALYZE exchange_seen_item")
+
 
 class ExchangeBackend(models.Model):
     _name = 'exchange.backend'
@@ -68,155 +155,1005 @@ class ExchangeBackend(models.Model):
     default_tz = fields.Selection(_tz_get,
                                   string='Default timezone',
                                   default='UTC')
+    calendar_export_delay = fields.Integer(
+        string='Calendar Export Delay',
+        default=10,
+        help="Delay (in seconds) before the events created in Odoo are "
+             "exported to Exchange. The events created by a user during "
+             "this delay are exported by the same job.",
+    )
+    sync_lease_timeout = fields.Integer(
+        string='Sync Lease Timeout',
+        default=10,
+        help="Delay (in minutes) after which a synchronization run which "
+             "did not report any activity is considered as dead. Until "
+             "then, the next runs of the same synchronization are "
+             "skipped.",
+    )
+    sync_run_retention_days = fields.Integer(
+        string='Runs Retention',
+        default=7,
+        help="Number of days the synchronization runs are kept. 0 keeps "
+             "them forever.",
+    )
+    enumeration_page_size = fields.Integer(
+        string='Enumeration Page Size',
+        default=100,
+        help="Number of Exchange items read by request when a folder is "
+             "enumerated. The progress of the enumeration is saved after "
+             "each page.",
+    )
+    enumeration_time_budget = fields.Integer(
+        string='Enumeration Time Budget',
+        default=600,
+        help="Time (in seconds) after which the enumeration of a folder "
+             "stops. The next run continues where it stopped.",
+    )
+    initial_sync_window_months = fields.Integer(
+        string='Initial Calendar Sync Window',
+        default=0,
+        help="Number of months of the windows in which the first calendar "
+             "synchronization of a user is split. The windows are "
+             "enumerated in parallel by jobs on the "
+             "root.exchange.initial_sync channel. 0 enumerates the whole "
+             "period at once.",
+    )
+    calendar_excluded_sensitivities = fields.Char(
+        string='Excluded Sensitivities',
+        default='Private,Personal',
+        help="Comma-separated sensitivities of the calendar events which "
+             "are not imported: %s." % ', '.join(SENSITIVITIES),
+    )
+    sync_categories = fields.Char(
+        string='Required Categories',
+        help="Comma-separated categories: only the contacts and events "
+             "having at least one of them are imported. Empty to import "
+             "all of them.",
+    )
+    calendar_past_days = fields.Integer(
+        string='Calendar Days in the Past',
+        help="Number of days before today of the events to synchronize. "
+             "0 uses the system parameter "
+             "exchange_calendar_sync_past_offset.",
+    )
+    calendar_future_days = fields.Integer(
+        string='Calendar Days in the Future',
+        help="Number of days after today of the events to synchronize. "
+             "0 uses the system parameter "
+             "exchange_calendar_sync_future_offset.",
+    )
+    bulk_import = fields.Boolean(
+        string='Bulk Import',
+        help="For the first synchronization of the users: the items of "
+             "each page of the enumeration are imported by a single job, "
+             "without tracking messages, followers nor notification "
+             "emails, and the computed fields are computed once by job.",
+    )
+    listener_enabled = fields.Boolean(
+        string='Listen to Notifications',
+        help="Instead of enumerating the folders every minute, listen to "
+             "the notifications of Exchange and import only the items "
+             "created, modified or deleted.",
+    )
+    listener_group_size = fields.Integer(
+        string='Mailboxes by Listener',
+        default=50,
+        help="Number of mailboxes polled by each listener job",
+    )
+    listener_poll_interval = fields.Integer(
+        string='Listener Poll Interval',
+        default=30,
+        help="Delay (in seconds) between two polls of the subscriptions",
+    )
+    listener_duration = fields.Integer(
+        string='Listener Duration',
+        default=30,
+        help="Time (in minutes) after which a listener stops polling. "
+             "The next run of the cron starts a new one.",
+    )
+    throttle_rate = fields.Float(
+        string='Maximum Requests by Second',
+        default=10,
+        help="Maximum rate of the requests sent to Exchange by all the "
+             "workers. The rate is lowered when Exchange asks to back off "
+             "or answers slowly. 0 disables the throttling.",
+    )
+    throttle_burst = fields.Integer(
+        string='Requests Burst',
+        default=20,
+        help="Number of requests which can be sent at once before the "
+             "rate applies",
+    )
+    throttle_max_wait = fields.Integer(
+        string='Maximum Throttling Wait',
+        default=30,
+        help="Time (in seconds) a request waits at most for its turn. "
+             "Beyond, the job is postponed.",
+    )
+    breaker_threshold = fields.Integer(
+        string='Connection Errors Before Pause',
+        default=5,
+        help="Number of consecutive connection errors after which the "
+             "requests to Exchange are paused and the jobs postponed. "
+             "0 disables the pause.",
+    )
+    breaker_open_duration = fields.Integer(
+        string='Pause Duration',
+        default=300,
+        help="Time (in seconds) during which the requests are paused. "
+             "Then a single request checks if Exchange is available.",
+    )
+    unavailable_until = fields.Datetime(
+        string='Unavailable Until',
+        compute='_compute_unavailable_until',
+        help="The requests to Exchange are paused until this date",
+    )
+    sync_lease_ids = fields.One2many(comodel_name='exchange.sync.lease',
+                                     inverse_name='backend_id',
+                                     string='Synchronization Leases',
+                                     readonly=True)
+    sync_window_ids = fields.One2many(
+        comodel_name='exchange.calendar.sync.window',
+        inverse_name='backend_id',
+        string='Initial Calendar Sync Windows',
+        readonly=True,
+    )
+    sync_run_ids = fields.One2many(comodel_name='exchange.sync.run',
+                                   inverse_name='backend_id',
+                                   string='Synchronization Runs',
+                                   readonly=True)
+
+    @api.constrains('calendar_excluded_sensitivities')
+    def _check_excluded_sensitivities(self):
+        for backend in self:
+            unknown = (set(_split_list(
+                backend.calendar_excluded_sensitivities)) -
+                set(SENSITIVITIES))
+            if unknown:
+                raise ValidationError(
+                    _('Unknown sensitivities: %s. The sensitivities are: '
+                      '%s.') % (', '.join(sorted(unknown)),
+                                ', '.join(SENSITIVITIES))
+                )
+
+    @api.multi
+    def _compute_unavailable_until(self):
+        self.env.cr.execute("""
+            SELECT backend_id, open_until AT TIME ZONE 'UTC'
+            FROM exchange_circuit_breaker
+            WHERE backend_id IN %s AND open_until > now()
+        """, (tuple(self.ids) or (0,),))
+        dates = dict(self.env.cr.fetchall())
+        for backend in self:
+            backend.unavailable_until = dates.get(backend.id)
+
+    @api.model_cr
+    def init(self):
+        self.env.cr.execute("""
+            CREATE UNLOGGED TABLE IF NOT EXISTS exchange_seen_item
+            (folder_id integer NOT NULL, external_id varchar NOT NULL)
+        """)
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS exchange_seen_item_folder_idx
+            ON exchange_seen_item (folder_id, external_id)
+        """)
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS exchange_binding_snapshot
+            (model varchar NOT NULL,
+             binding_id integer NOT NULL,
+             data bytea NOT NULL,
+             PRIMARY KEY (model, binding_id))
+        """)
+        self.env.cr.execute("""
+            CREATE UNLOGGED TABLE IF NOT EXISTS exchange_circuit_breaker
+            (backend_id integer PRIMARY KEY,
+             failures integer NOT NULL,
+             open_until timestamp with time zone)
+        """)
+        self.env.cr.execute("""
+            CREATE UNLOGGED TABLE IF NOT EXISTS exchange_throttle_bucket
+            (backend_id integer PRIMARY KEY,
+             tokens double precision NOT NULL,
+             rate double precision NOT NULL,
+             updated_at timestamp with time zone NOT NULL,
+             blocked_until timestamp with time zone)
+        """)
 
     @api.model
     def cron_export_contact_partner(self):
-        for backend in self.search([]):
-            backend.export_contact_partners()
+        self.search([])._delay_user_sync('export_contact')
 
     @api.model
     def cron_import_contact_partner(self):
-        for backend in self.search([]):
-            backend.import_contact_partners()
+        # the backends listening to notifications do not poll
+        backends = self.search([('listener_enabled', '=', False)])
+        backends._delay_user_sync('import_contact')
+
+    @api.model
+    def cron_export_calendar(self):
+        self.search([])._delay_user_sync('export_calendar')
+
+    @api.model
+    def cron_import_calendar(self):
+        backends = self.search([('listener_enabled', '=', False)])
+        backends._delay_user_sync('import_calendar')
+
+    @api.model
+    def cron_listen(self):
+        self.search([('listener_enabled', '=', True)])._delay_listeners()
+
+    @api.model
+    def cron_purge_sync_runs(self):
+        self.search([('sync_run_retention_days', '>', 0)])._purge_sync_runs()
+
+    @api.multi
+    def _purge_sync_runs(self):
+        """ Delete the synchronization runs older than the retention of
+        their backend, with their lines
+        """
+        for backend in self:
+            limit = datetime.now() - timedelta(
+                days=backend.sync_run_retention_days)
+            runs = self.env['exchange.sync.run'].search(
+                [('backend_id', '=', backend.id),
+                 ('create_date', '<', fields.Datetime.to_string(limit))])
+            _logger.info('Exchange backend %s: %d synchronization runs '
+                         'purged', backend.name, len(runs))
+            runs.unlink()
+
+    @api.model
+    def _get_sync_methods(self):
+        """ Methods synchronizing one user, by kind of synchronization """
+        return {
+            'import_contact': '_import_user_contact_partners',
+            'export_contact': '_export_user_contact_partners',
+            'import_calendar': '_import_user_calendar',
+            'export_calendar': '_export_user_calendar',
+        }
+
+    @api.model
+    def _get_sync_users(self, sync_kind):
+        """ Return the users for which a kind of synchronization is enabled
+        """
+        if sync_kind in ('import_calendar', 'export_calendar'):
+            domain = [('exchange_calendar_sync', '=', True)]
+        elif sync_kind == 'listen':
+            domain = ['|', ('exchange_synch', '=', True),
+                      ('exchange_calendar_sync', '=', True)]
+        else:
+            domain = [('exchange_synch', '=', True)]
+        return self.env['res.users'].search(domain)
+
+    @api.multi
+    def _sync_user_identity_key(self, sync_kind, user=None):
+        """ Identity key of the synchronization job of a user
+
+        Without ``user``, returns the prefix shared by the keys of the jobs
+        of all the users.
+        """
+        self.ensure_one()
+        return 'exchange-sync-%d-%s-%s' % (self.id, sync_kind,
+                                           user.id if user else '')
+
+    @api.multi
+    def _delay_user_sync(self, sync_kind):
+        """ Delay one synchronization job by backend and by user
+
+        The jobs run on the ``root.exchange.enumeration`` channel, so a slow
+        mailbox or a failure does not block the other users.
+
+        The jobs hold the lease of the synchronization until they are all
+        done: the runs starting before are skipped.
+
+        Each run is recorded in an ``exchange.sync.run`` with the requests
+        sent to Exchange by the jobs.
+        """
+        leases = self.env['exchange.sync.lease']
+        users = self._get_sync_users(sync_kind)
+        description = dict(SYNC_KINDS)[sync_kind]
+        for backend in self:
+            token = leases._acquire(backend, sync_kind)
+            if not token:
+                continue
+            sync_run = self.env['exchange.sync.run'].create({
+                'backend_id': backend.id,
+                'sync_kind': sync_kind,
+                'user_count': len(users),
+            })
+            for user in users:
+                backend.with_delay(
+                    description='%s: %s' % (description, user.name),
+                    identity_key=backend._sync_user_identity_key(sync_kind,
+                                                                 user),
+                ).sync_user(sync_kind, user, lease_token=token,
+                            sync_run=sync_run)
+            leases._set_pending_jobs(token, len(users))
+
+    @job(default_channel='root.exchange.enumeration')
+    @api.multi
+    @retry_when_throttled
+    def sync_user(self, sync_kind, user, lease_token=None, sync_run=None):
+        """ Run one kind of synchronization for a user """
+        self.ensure_one()
+        leases = self.env['exchange.sync.lease']
+        if lease_token:
+            leases._heartbeat(lease_token)
+        method = self._get_sync_methods()[sync_kind]
+        with leases._release_on_failure(lease_token):
+            with collect_ews_stats() as stats:
+                result = getattr(self, method)(user)
+        store_job_stats(self.env, stats)
+        if sync_run:
+            values = stats.get_values()
+            values.update(run_id=sync_run.id,
+                          user_id=user.id,
+                          job_uuid=self.env.context.get('job_uuid'),
+                          result=result)
+            self.env['exchange.sync.run.line'].sudo().create(values)
+        if lease_token:
+            leases._release_job(lease_token)
+        return result
+
+    @api.multi
+    def _iter_item_pages(self, folder, queryset):
+        """ Enumerate the items of an Exchange folder by pages
+
+        The enumeration starts at the offset saved on the folder by the
+        previous run. Each page is yielded as a list of items; once it has
+        been processed, the offset of the next page is saved on the folder
+        and committed (except in tests), so a killed worker does not start
+        over. The enumeration stops when the time budget of the backend is
+        exhausted.
+
+        ``folder.enumeration_offset`` is back to 0 once the last page has
+        been processed.
+        """
+        self.ensure_one()
+        deadline = time.time() + self.enumeration_time_budget
+        page_size = self.enumeration_page_size
+        while True:
+            offset = folder.enumeration_offset
+            items = list(queryset[offset:offset + page_size])
+            yield items
+            if len(items) < page_size:
+                folder.enumeration_offset = 0
+                return
+            folder.enumeration_offset = offset + len(items)
+            if not tools.config['test_enable']:
+                self.env.cr.commit()
+            if time.time() > deadline:
+                _logger.info('time budget exhausted, enumeration of folder '
+                             '%s stopped at offset %d', folder.name,
+                             folder.enumeration_offset)
+                return
+
+    @api.multi
+    def _get_contact_restriction(self):
+        """ Restriction of the contacts to import, applied by Exchange
+
+        :returns: exchangelib Q, None to import all the contacts
+        """
+        self.ensure_one()
+        categories = _split_list(self.sync_categories)
+        if not categories:
+            return None
+        return Q(categories__in=categories)
+
+    @api.multi
+    def _get_calendar_restriction(self, date_from, date_to):
+        """ Restriction of the events to import, applied by Exchange
+
+        The events overlapping the period, without an excluded sensitivity
+        and with one of the required categories of the backend. The end of
+        a recurrence is not searchable: all the recurring masters started
+        before the end of the period are kept, the ones whose recurrence
+        ended before the period are dropped by
+        ``_filter_ended_recurrences``.
+
+        :param date_from: naive UTC datetime
+        :param date_to: naive UTC datetime
+        :returns: exchangelib Q
+        """
+        self.ensure_one()
+        utc = EWSTimeZone.timezone('UTC')
+        start_before = Q(
+            start__lt=utc.localize(EWSDateTime.from_datetime(date_to)))
+        restriction = (
+            (start_before & Q(
+                end__gte=utc.localize(EWSDateTime.from_datetime(date_from))
+            )) |
+            (start_before & Q(type='RecurringMaster'))
+        )
+        sensitivities = _split_list(self.calendar_excluded_sensitivities)
+        if sensitivities:
+            restriction &= ~Q(sensitivity__in=sensitivities)
+        categories = _split_list(self.sync_categories)
+        if categories:
+            restriction &= Q(categories__in=categories)
+        return restriction
+
+    @api.model
+    def _filter_ended_recurrences(self, account, ews_folder, items,
+                                  date_from):
+        """ Drop the recurring masters whose recurrence ended before
+        ``date_from``
+
+        The end of the recurrence of the masters ending before
+        ``date_from`` is read from their last occurrence, in one request.
+        A master without last occurrence recurs forever.
+
+        :param items: exchangelib items, with their type and end
+        :param date_from: naive UTC datetime
+        :returns: list of the items to import
+        """
+        utc = EWSTimeZone.timezone('UTC')
+        date_from = utc.localize(EWSDateTime.from_datetime(date_from))
+        masters = [(item.item_id, item.changekey) for item in items
+                   if item.type == 'RecurringMaster' and
+                   item.end < date_from]
+        if not masters:
+            return items
+        ended_ids = set(
+            master.item_id for master in account.fetch(
+                ids=masters, folder=ews_folder,
+                only_fields=['last_occurrence'])
+            if not isinstance(master, Exception) and
+            master.last_occurrence is not None and
+            master.last_occurrence.end < date_from
+        )
+        return [item for item in items if item.item_id not in ended_ids]
 
     @api.multi
     def export_contact_partners(self):
         """ Export partners to exchange backend """
         self.ensure_one()
         _logger.debug('export contact partners')
-        users = self.env['res.users'].search([('exchange_synch', '=', True)])
-        for backend in self:
-            for user in users:
-                # this will trigger an export for these contacts
-                user.exchange_contact_ids.try_autobind(user, backend)
+        for user in self._get_sync_users('export_contact'):
+            self._export_user_contact_partners(user)
         return True
 
+    @api.multi
+    def _export_user_contact_partners(self, user):
+        self.ensure_one()
+        contacts = user.find_exchange_contacts()
+        # this will trigger an export for these contacts
+        contacts.try_autobind(user, self)
+        return _('%d contacts exported') % len(contacts)
+
     @api.multi
     def import_contact_partners(self):
         """ Import partners from exchange backend """
         _logger.debug('import contact partners')
-        users = self.env['res.users'].search([('exchange_synch', '=', True)])
+        users = self._get_sync_users('import_contact')
         for backend in self:
             for user in users:
-                # find folder for this user. If not exists do not try to import
-                folder = user.find_folder(backend.id, create=True,
-                                          default_name="Contacts",
-                                          folder_type='contact')
-                if not folder:
-                    continue
-
-                # get all contacts for this user
-                model_name = 'exchange.res.partner'
-                with backend.get_environment(model_name) as connector_env:
-                    adapter = connector_env.get_connector_unit(
-                        PartnerBackendAdapter)
-                account = adapter.get_account(user)
-                contact_folder = account.contacts
-                # for each contact found, run import_record
-                for exchange_contact in contact_folder.all():
-                    # odoo_categ = False
-                    # if not exchange_contact.categories:
-                    #     continue
-                    # for categ in exchange_contact.categories:
-                    #     if categ == 'Odoo':
-                    #         odoo_categ = True
-                    #         break
-                    # if odoo_categ:
-                    self.env['exchange.res.partner'].with_delay(
-                        priority=30).import_record(
-                            backend,
-                            user,
-                            exchange_contact.item_id)
+                backend._import_user_contact_partners(user)
         return True
 
-    @api.model
-    def cron_export_calendar(self):
-        for backend in self.search([]):
-            backend.export_user_calendar()
+    @api.multi
+    def _import_user_contact_partners(self, user):
+        self.ensure_one()
+        # find folder for this user. If not exists do not try to import
+        folder = user.find_folder(self.id, create=True,
+                                  default_name="Contacts",
+                                  folder_type='contact')
+        if not folder:
+            return
 
-    @api.model
-    def cron_import_calendar(self):
-        for backend in self.search([]):
-            backend.import_user_calendar()
+        # get all contacts for this user
+        model_name = 'exchange.res.partner'
+        with self.get_environment(model_name) as connector_env:
+            adapter = connector_env.get_connector_unit(
+                PartnerBackendAdapter)
+        account = adapter.get_account(user)
+        contact_folder = account.contacts
+        bindings = self.env['exchange.res.partner']
+        pending_keys = bindings._get_pending_import_keys(self, user)
+        change_keys = bindings._get_synced_change_keys(self, user)
+        count = skipped = unchanged = 0
+        restriction = self._get_contact_restriction()
+        if restriction is None:
+            exchange_contacts = contact_folder.all()
+        else:
+            exchange_contacts = contact_folder.filter(restriction)
+        exchange_contacts = exchange_contacts.only('item_id', 'changekey')
+        # for each contact found, run import_record
+        for page in self._iter_item_pages(folder, exchange_contacts):
+            batch = []
+            for exchange_contact in page:
+                if (change_keys.get(exchange_contact.item_id) ==
+                        exchange_contact.changekey):
+                    # not modified since it was imported or exported
+                    unchanged += 1
+                elif self.bulk_import:
+                    batch.append(exchange_contact.item_id)
+                elif bindings._delay_import_record(
+                        self, user, exchange_contact.item_id,
+                        pending_keys=pending_keys, priority=30):
+                    count += 1
+                else:
+                    skipped += 1
+            if batch:
+                delayed = bindings._delay_import_batch(
+                    self, user, batch, pending_keys=pending_keys,
+                    priority=30)
+                count += delayed
+                skipped += len(batch) - delayed
+        _logger.info('%d contacts of %s delayed for import, %d duplicates '
+                     'suppressed, %d unchanged', count, user.login, skipped,
+                     unchanged)
+        return _('%d contacts delayed for import, %d already pending') % (
+            count, skipped)
 
     @api.multi
     def import_user_calendar(self):
         """ Import events from exchange backend """
         _logger.debug('import events')
-        users = self.env['res.users'].search(
-            [('exchange_calendar_sync', '=', True)])
-
+        users = self._get_sync_users('import_calendar')
         for backend in self:
             for user in users:
-                imported_events = []
-                existing_events = user.exchange_calendar_ids.mapped(
-                    'exchange_bind_ids')
-                existing_events = existing_events.filtered(
-                    (lambda u: lambda a: a.user_id == u)(user)
-                )
-                existing_events = existing_events.mapped('external_id')
-
-                # find folder for this user. If not exists, create one
-                folder = user.find_folder(backend.id, create=True,
-                                          default_name="Calendar",
-                                          folder_type='calendar')
-                if not folder:
-                    continue
-                tz = EWSTimeZone.localzone()
-                # get all contacts for this user
-                model_name = 'exchange.calendar.event'
-                with backend.get_environment(model_name) as connector_env:
-                    adapter = connector_env.get_connector_unit(
-                        EventBackendAdapter)
-                account = adapter.get_account(user)
-                calendar_folder = account.calendar
-                exchange_events = calendar_folder.filter(start__gt=(
-                    tz.localize(EWSDateTime(2017, 1, 1))
-                ))  # Filter by a date range
-                # for each event found, run import_record if sensitivity
-                # is not "Private" or "Personnal"
-                # and if categories contains Odoo
-                for exchange_event in exchange_events:
-                    sensitivity = exchange_event.sensitivity
-                    # odoo_categ = False
-                    # if not exchange_event.categories:
-                    #     continue
-                    # for categ in exchange_event.categories:
-                    #     if categ == 'Odoo':
-                    #         odoo_categ = True
-                    #         break
-                    # if odoo_categ and sensitivity not in \
-                    if sensitivity not in ['Private', 'Personal']:
-                        self.env['exchange.calendar.event'].with_delay(
-                            ).import_record(
-                                backend,
-                                user,
-                                exchange_event.item_id)
-                        imported_events.append(exchange_event.item_id)
-
-                to_delete = list(set(existing_events) - set(imported_events))
-                cal_ex_obj = self.env['exchange.calendar.event']
-                to_delete_ids = cal_ex_obj.search(
-                    [('external_id', 'in', to_delete),
-                     ('user_id', '=', user.id)]
-                )
-                calendar_event_ids = to_delete_ids.mapped('openerp_id')
-                calendar_event_ids.with_context(
-                    connector_no_export=True).unlink()
-                user.last_calendar_sync_date = fields.Date.today()
+                backend._import_user_calendar(user)
         return True
 
+    @api.multi
+    def _import_user_calendar(self, user):
+        self.ensure_one()
+        # find folder for this user. If not exists, create one
+        folder = user.find_folder(self.id, create=True,
+                                  default_name="Calendar",
+                                  folder_type='calendar')
+        if not folder:
+            return
+        if self.initial_sync_window_months:
+            result = self._initial_sync_calendar(user)
+            if result:
+                return result
+        imported_events = SeenItems(self.env.cr, folder)
+        if folder.enumeration_offset and imported_events.is_lost():
+            _logger.info('seen items of folder %s lost, enumeration '
+                         'restarted', folder.name)
+            folder.enumeration_offset = 0
+        if not folder.enumeration_offset:
+            # new enumeration
+            imported_events.clear()
+            folder.enumeration_date = fields.Date.today()
+        # the window stays the same until the enumeration is done
+        date_from, date_to = user._get_calendar_sync_window(
+            today=folder.enumeration_date, backend=self)
+        # get all contacts for this user
+        model_name = 'exchange.calendar.event'
+        with self.get_environment(model_name) as connector_env:
+            adapter = connector_env.get_connector_unit(
+                EventBackendAdapter)
+        account = adapter.get_account(user)
+        calendar_folder = account.calendar
+        # the events of the sync window of the user, the excluded ones
+        # are filtered out by Exchange
+        exchange_events = calendar_folder.filter(
+            self._get_calendar_restriction(date_from, date_to),
+        ).only('item_id', 'changekey', 'type', 'end')
+        bindings = self.env['exchange.calendar.event']
+        pending_keys = bindings._get_pending_import_keys(self, user)
+        change_keys = bindings._get_synced_change_keys(self, user)
+        skipped = 0
+        # for each event found, run import_record
+        for page in self._iter_item_pages(folder, exchange_events):
+            page = self._filter_ended_recurrences(
+                account, calendar_folder, page, date_from)
+            batch = []
+            for exchange_event in page:
+                if (change_keys.get(exchange_event.item_id) ==
+                        exchange_event.changekey):
+                    # not modified since it was imported or exported
+                    skipped += 1
+                elif self.bulk_import:
+                    batch.append(exchange_event.item_id)
+                elif not bindings._delay_import_record(
+                        self, user, exchange_event.item_id,
+                        pending_keys=pending_keys):
+                    skipped += 1
+                imported_events.add(exchange_event.item_id)
+            if batch:
+                skipped += len(batch) - bindings._delay_import_batch(
+                    self, user, batch, pending_keys=pending_keys)
+            # saved with the offset of the next page
+            imported_events.flush()
+
+        if folder.enumeration_offset:
+            # the next run continues the enumeration
+            return _('%d events delayed for import, %d unchanged or pending, '
+                     'enumeration continued at offset %d') % (
+                imported_events.count - skipped, skipped,
+                folder.enumeration_offset)
+
+        # events of the period not found anymore in Exchange
+        imported_events.analyze()
+        unseen = self.env['exchange.calendar.event']._get_unseen_events(
+            self, user, folder, date_from, date_to)
+        # the offsets of the pages shift when items are created or
+        # deleted during the enumeration, so an item may be missed: only
+        # the events not found by their ID are deleted
+        deleted_ids = self._get_deleted_items(account, calendar_folder,
+                                              list(unseen))
+        to_delete_ids = list(set(unseen[item_id] for item_id in deleted_ids))
+        self.env['calendar.event'].browse(to_delete_ids).with_context(
+            connector_no_export=True).unlink()
+        imported_events.clear()
+        user.last_calendar_sync_date = fields.Date.today()
+        _logger.info('%d events of %s delayed for import, %d unchanged or '
+                     'already pending', imported_events.count - skipped,
+                     user.login, skipped)
+        return _('%d events delayed for import, %d unchanged or pending, '
+                 '%d deleted') % (imported_events.count - skipped, skipped,
+                                  len(to_delete_ids))
+
+    @api.model
+    def _get_deleted_items(self, account, ews_folder, external_ids):
+        """ Return the IDs of the items which do not exist in Exchange
+
+        :param external_ids: IDs of the items to check
+        """
+        if not external_ids:
+            return []
+        items = account.fetch(ids=[(item_id, None)
+                                   for item_id in external_ids],
+                              folder=ews_folder,
+                              only_fields=['sensitivity'])
+        deleted = []
+        for item_id, item in zip(external_ids, items):
+            if isinstance(item, ErrorItemNotFound):
+                deleted.append(item_id)
+        return deleted
+
+    @api.multi
+    def _initial_sync_calendar(self, user):
+        """ Split the first calendar synchronization of a user in windows
+
+        The windows are created and their jobs delayed when the user has no
+        event bound yet. Once none of them is still running, the usual
+        enumeration checks the whole period, mostly unchanged items: the
+        events of the failed windows are imported again by it.
+
+        :returns: the result of the synchronization job, None when the
+                  usual enumeration must run
+        """
+        self.ensure_one()
+        windows = self.env['exchange.calendar.sync.window'].search(
+            [('backend_id', '=', self.id), ('user_id', '=', user.id)])
+        if not windows:
+            if self.env['exchange.calendar.event'].search_count(
+                    [('backend_id', '=', self.id),
+                     ('user_id', '=', user.id)]):
+                return None
+            date_from, date_to = user._get_calendar_sync_window(
+                backend=self)
+            windows = windows._create_windows(self, user, date_from,
+                                              date_to)
+            windows._delay_import()
+            return _('initial synchronization split in %d windows') % (
+                len(windows))
+        # the windows whose job failed do not block the user either
+        running = windows.filtered(
+            lambda w: w.state == 'enumerated' or
+            (w.state == 'pending' and w.job_state != 'failed'))
+        if running:
+            return _('initial synchronization: %d of %d windows done') % (
+                len(windows) - len(running), len(windows))
+        return None
+
+    @job(default_channel='root.exchange.initial_sync')
+    @api.multi
+    @retry_when_throttled
+    @instrumented_job
+    def import_calendar_window(self, window):
+        """ Delay the import of the events of a window of the initial
+        calendar synchronization
+        """
+        self.ensure_one()
+        user = window.user_id
+        with self.get_environment('exchange.calendar.event') as connector_env:
+            adapter = connector_env.get_connector_unit(
+                EventBackendAdapter)
+        account = adapter.get_account(user)
+        # the overlapping events are found in several windows, their
+        # imports are deduplicated by their identity key
+        date_from = fields.Datetime.from_string(window.date_from)
+        exchange_events = account.calendar.filter(
+            self._get_calendar_restriction(
+                date_from, fields.Datetime.from_string(window.date_to)),
+        ).only('item_id', 'changekey', 'type', 'end')
+        bindings = self.env['exchange.calendar.event']
+        pending_keys = bindings._get_pending_import_keys(self, user)
+        change_keys = bindings._get_synced_change_keys(self, user)
+        count = 0
+        # the window is done once these jobs are done
+        delayed_jobs = []
+        page_size = self.enumeration_page_size
+        offset = 0
+        while True:
+            page = list(exchange_events[offset:offset + page_size])
+            offset += len(page)
+            events = self._filter_ended_recurrences(
+                account, account.calendar, page, date_from)
+            item_ids = [event.item_id for event in events
+                        if change_keys.get(event.item_id) != event.changekey]
+            if self.bulk_import:
+                if item_ids:
+                    count += bindings._delay_import_batch(
+                        self, user, item_ids, pending_keys=pending_keys,
+                        delayed_jobs=delayed_jobs)
+            else:
+                for item_id in item_ids:
+                    if bindings._delay_import_record(
+                            self, user, item_id, pending_keys=pending_keys,
+                            delayed_jobs=delayed_jobs):
+                        count += 1
+            if len(page) < page_size:
+                break
+        import_jobs = self.env['queue.job'].sudo().search(
+            [('uuid', 'in', [job_.uuid for job_ in delayed_jobs])])
+        window.write({'item_count': count,
+                      'import_job_ids': [(6, 0, import_jobs.ids)],
+                      'date_enumerated': fields.Datetime.now()})
+        return _('%d events delayed for import') % count
+
     @api.multi
     def export_user_calendar(self):
         self.ensure_one()
         _logger.debug('export calendar events')
-        users = self.env['res.users'].search(
-            [('exchange_calendar_sync', '=', True)])
+        for user in self._get_sync_users('export_calendar'):
+            self._export_user_calendar(user)
+        return True
+
+    @api.multi
+    def _export_user_calendar(self, user):
+        self.ensure_one()
+        events = user.find_exchange_calendar_events()
+        # this will trigger an export for these events
+        events.try_autobind(user, self)
+        return _('%d events exported') % len(events)
+
+    @api.multi
+    def _delay_listeners(self):
+        """ Delay the listener jobs, one by group of mailboxes
+
+        Like the synchronization jobs, the listeners hold the lease of the
+        backend until they stop.
+        """
+        leases = self.env['exchange.sync.lease']
+        users = self._get_sync_users('listen')
         for backend in self:
+            token = leases._acquire(backend, 'listen')
+            if not token:
+                continue
+            size = max(backend.listener_group_size, 1)
+            groups = [users[idx:idx + size]
+                      for idx in range(0, len(users), size)]
+            for group in groups:
+                backend.with_delay(
+                    description=_('Listen to %d mailboxes') % len(group),
+                ).listen(group, lease_token=token)
+            leases._set_pending_jobs(token, len(groups))
+
+    @job(default_channel='root.exchange.listener')
+    @api.multi
+    @retry_when_throttled
+    @instrumented_job
+    def listen(self, users, lease_token=None, deadline=None):
+        """ Poll once the subscriptions of a group of users
+
+        The job delays the next poll after ``listener_poll_interval``
+        seconds, instead of waiting in a worker, until ``listener_duration``
+        is elapsed. The next poll inherits the lease.
+
+        :param deadline: timestamp after which the listener stops, set by
+                         its first poll
+        """
+        self.ensure_one()
+        leases = self.env['exchange.sync.lease']
+        if deadline is None:
+            deadline = time.time() + self.listener_duration * 60
+        if lease_token:
+            leases._heartbeat(lease_token)
+        count = 0
+        with leases._release_on_failure(lease_token):
             for user in users:
-                # this will trigger an export for these contacts
-                user.exchange_calendar_ids.try_autobind(user, backend)
-        return True
+                if user.exchange_synch:
+                    count += self._pull_events(user, 'contact')
+                if user.exchange_calendar_sync:
+                    count += self._pull_events(user, 'calendar')
+        if time.time() + self.listener_poll_interval <= deadline:
+            self.with_delay(
+                eta=self.listener_poll_interval,
+                description=_('Listen to %d mailboxes') % len(users),
+            ).listen(users, lease_token=lease_token, deadline=deadline)
+        elif lease_token:
+            leases._release_job(lease_token)
+        return _('%d notifications processed') % count
+
+    @api.model
+    def _get_listened_folders(self):
+        """ Binding model, default folder name and Exchange folder
+        attribute of the account, by folder type """
+        return {
+            'contact': ('exchange.res.partner', 'Contacts', 'contacts'),
+            'calendar': ('exchange.calendar.event', 'Calendar', 'calendar'),
+        }
+
+    @api.multi
+    def _subscribe(self, adapter, account, ews_folder, folder):
+        """ Create or renew the pull subscription of a folder
+
+        An expired subscription is renewed from its last watermark so no
+        event is lost. Without a valid watermark, the folder is enumerated
+        again to catch up the changes made before the subscription.
+        """
+        subscription_id = None
+        if folder.subscription_watermark:
+            try:
+                subscription_id, watermark = adapter.subscribe(
+                    account, ews_folder, SUBSCRIPTION_TIMEOUT,
+                    watermark=folder.subscription_watermark,
+                )
+            except ErrorInvalidWatermark:
+                _logger.info('watermark of folder %s not valid anymore',
+                             folder.name)
+        if not subscription_id:
+            subscription_id, watermark = adapter.subscribe(
+                account, ews_folder, SUBSCRIPTION_TIMEOUT)
+            sync_kind = 'import_%s' % folder.folder_type
+            self.with_delay().sync_user(sync_kind, folder.user_id)
+        folder.write({'subscription_id': subscription_id,
+                      'subscription_watermark': watermark})
+
+    @api.multi
+    def _pull_events(self, user, folder_type):
+        """ Delay the imports of the items notified in a folder of a user
+
+        :returns: number of items notified
+        """
+        self.ensure_one()
+        model_name, default_name, folder_attr = (
+            self._get_listened_folders()[folder_type])
+        folder = user.find_folder(self.id, create=True,
+                                  default_name=default_name,
+                                  folder_type=folder_type)
+        if not folder:
+            return 0
+        with self.get_environment(model_name) as connector_env:
+            adapter = connector_env.get_connector_unit(ExchangeAdapter)
+        account = adapter.get_account(user)
+        ews_folder = getattr(account, folder_attr)
+        now = datetime.utcnow()
+        if (not folder.subscription_id or
+                fields.Datetime.from_string(
+                    folder.subscription_expire_date) < now):
+            self._subscribe(adapter, account, ews_folder, folder)
+        events = []
+        more_events = True
+        watermark = folder.subscription_watermark
+        while more_events:
+            try:
+                page, watermark, more_events = adapter.get_events(
+                    account, folder.subscription_id, watermark)
+            except (ErrorExpiredSubscription, ErrorInvalidPullSubscriptionId,
+                    ErrorInvalidSubscription, ErrorSubscriptionNotFound):
+                # renewed on the next poll, from the last watermark
+                _logger.info('subscription of folder %s expired',
+                             folder.name)
+                folder.subscription_id = False
+                break
+            events += page
+        expire_date = now + timedelta(minutes=SUBSCRIPTION_TIMEOUT)
+        folder.write({
+            'subscription_watermark': watermark,
+            'subscription_expire_date': fields.Datetime.to_string(
+                expire_date),
+        })
+        self._process_events(user, folder_type, account, ews_folder, events)
+        return len(events)
+
+    @api.multi
+    def _process_events(self, user, folder_type, account, ews_folder,
+                        events):
+        """ Import the created and modified items, remove the deleted ones
+        """
+        model_name = self._get_listened_folders()[folder_type][0]
+        bindings = self.env[model_name]
+        changed = {}
+        removed = set()
+        for event in events:
+            if event.event_type == 'DeletedEvent':
+                removed.add(event.item_id)
+                changed.pop(event.item_id, None)
+                continue
+            if event.old_item_id and event.old_folder_id != event.folder_id:
+                # moved out of the folder (to the deleted items for
+                # instance) or into the folder
+                if event.old_folder_id == ews_folder.folder_id:
+                    removed.add(event.old_item_id)
+                    changed.pop(event.old_item_id, None)
+            if event.folder_id == ews_folder.folder_id:
+                changed[event.item_id] = event.changekey
+                removed.discard(event.item_id)
+        if removed:
+            bindings._remove_exchange_items(self, user, removed)
+        # our own exports are notified as well
+        change_keys = bindings._get_synced_change_keys(self, user,
+                                                       list(changed))
+        for item_id, change_key in change_keys.items():
+            if changed[item_id] == change_key:
+                del changed[item_id]
+        item_ids = self._filter_notified_items(folder_type, account,
+                                               ews_folder, changed)
+        pending_keys = bindings._get_pending_import_keys(self, user)
+        for item_id in item_ids:
+            bindings._delay_import_record(self, user, item_id,
+                                          pending_keys=pending_keys)
+
+    @api.multi
+    def _filter_notified_items(self, folder_type, account, ews_folder,
+                               changekeys):
+        """ Return the notified items to import
+
+        Same rules as the restrictions of the enumerations: the excluded
+        sensitivities and the required categories of the backend. Only
+        these fields of the items are read.
+
+        :param changekeys: dict {item id: changekey}
+        """
+        self.ensure_one()
+        sensitivities = set()
+        if folder_type == 'calendar':
+            sensitivities = set(
+                _split_list(self.calendar_excluded_sensitivities))
+        categories = set(_split_list(self.sync_categories))
+        if not (sensitivities or categories) or not changekeys:
+            return list(changekeys)
+        only_fields = []
+        if sensitivities:
+            only_fields.append('sensitivity')
+        if categories:
+            only_fields.append('categories')
+        items = account.fetch(ids=changekeys.items(), folder=ews_folder,
+                              only_fields=only_fields)
+        # the categories are compared case-insensitively, as by Exchange
+        categories = set(category.lower() for category in categories)
+        return [item.item_id for item in items
+                if not isinstance(item, Exception) and
+                item.sensitivity not in sensitivities and
+                (not categories or
+                 categories & set(category.lower() for category
+                                  in item.categories or []))]
+
+    @api.multi
+    def delay_export_calendar_batch(self, user):
+        """ Delay the export of the events of ``user`` not yet exported
+
+        Only one pending job is kept by user and backend, it exports all
+        the bindings created until it starts.
+        """
+        self.ensure_one()
+        self.with_delay(
+            eta=self.calendar_export_delay,
+            identity_key=identity_exact,
+        ).export_calendar_batch(user)
+
+    @job
+    @api.multi
+    @retry_when_throttled
+    @instrumented_job
+    def export_calendar_batch(self, user):
+        """ Export the calendar events of a user never exported yet """
+        self.ensure_one()
+        bindings = self.env['exchange.calendar.event'].search(
+            [('backend_id', '=', self.id),
+             ('user_id', '=', user.id),
+             ('external_id', '=', False)]
+        )
+        for binding in bindings:
+            binding.export_record()
+        return _('%d calendar events exported') % len(bindings)
 
     @contextmanager
     @api.multi
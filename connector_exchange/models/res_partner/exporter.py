@@ -8,6 +8,7 @@ from odoo import _
 from ...unit.exporter import (ExchangeExporter,
                               ExchangeDisabler)
 from ...backend import exchange_2010
+from .mapping import PARTNER_MAPPING
 
 _logger = logging.getLogger(__name__)
 
@@ -40,22 +41,6 @@ def _construct_street(rec, sep=' '):
         return sep.join(part for part in streets if part)
 
 
-SIMPLE_VALUE_FIELDS = {'firstname': 'given_name',
-                       'name': 'display_name',
-                       'lastname': 'nickname',
-                       'website': 'business_homepage',
-                       'function': 'job_title',
-                       # 'email': ['email_addresses'],
-                       # 'phone': ['phone_numbers'],
-                       # 'fax': ['phone_numbers'],
-                       # 'mobile': ['phone_numbers']
-                       }
-
-RELATIONAL_VALUE_FIELDS = {'title': ['complete_name', 'title'],
-                           'parent_id': 'company_name',
-                           # 'position_id': 'profession',
-                           }
-
 PHONE_VALUE_FIELDS = {'phone': 'BusinessPhone',
                       'fax': 'BusinessFax',
                       'mobile': 'MobilePhone'}
@@ -63,6 +48,12 @@ PHONE_VALUE_FIELDS = {'phone': 'BusinessPhone',
 ADDRESS_FIELDS = ['street', 'street2', 'street3', 'zip', 'city', 'state_id',
                   'country_id']
 
+EXPORTED_FIELDS = frozenset(
+    [field.odoo for field in PARTNER_MAPPING.fields
+     if field.direction != 'import'] +
+    ADDRESS_FIELDS + PHONE_VALUE_FIELDS.keys() + ['email']
+)
+
 ADDRESS_DICT = {'physical_addresses': {
     'street': "%(street_computed)s",
     'city': "%(city)s",
@@ -78,46 +69,15 @@ class PartnerExporter(ExchangeExporter):
 
     def fill_contact(self, contact, fields):
         contact.file_as_mapping = 'FirstSpaceLast'
-        if fields is None or fields == []:
-            fields = (
-                SIMPLE_VALUE_FIELDS.keys() + RELATIONAL_VALUE_FIELDS.keys() +
-                ADDRESS_FIELDS + PHONE_VALUE_FIELDS.keys() + ['email']
-                )
-
-        if 'lastname' in fields or 'firstname' in fields:
-            fields.append('name')
-        for f, v in SIMPLE_VALUE_FIELDS.iteritems():
-            if fields is not None and f not in fields:
-                continue
-            odoo_value = getattr(self.binding, f)
-            if not odoo_value:
-                continue
-
-            if isinstance(v, list):
-                if hasattr(contact, v[0]):
-                    for elem in v[1:]:
-                        contact.__setattr__(elem, odoo_value)
-            else:
-                contact.__setattr__(v, odoo_value)
-
-        for f, v in RELATIONAL_VALUE_FIELDS.iteritems():
-            if fields is not None and f not in fields:
-                continue
-            odoo_value = getattr(self.binding, f)
-            if not odoo_value:
-                continue
-
-            if isinstance(v, list):
-                if hasattr(contact, v[0]):
-                    ff = contact.__getattribute__(v[0])
-                    for elem in v[1:]:
-                        if hasattr(contact, elem):
-                            ff = contact.__getattribute__(elem)
-                        ff.__setattr__(elem, odoo_value.name)
-            else:
-                contact.__setattr__(v, odoo_value.name)
+        if fields:
+            fields = set(fields)
+            if 'lastname' in fields or 'firstname' in fields:
+                fields.add('name')
+        else:
+            fields = EXPORTED_FIELDS
+        PARTNER_MAPPING.map_export(self.binding, contact, fields=fields)
 
-        if set(ADDRESS_FIELDS) & set(fields):
+        if set(ADDRESS_FIELDS) & fields:
             # sync only Business address
             not_found = True
             if contact.physical_addresses:
@@ -155,7 +115,7 @@ class PartnerExporter(ExchangeExporter):
         if 'email' in fields:
             contact.email_addresses = [EmailAddress(label='EmailAddress1',
                                                     email=self.binding.email)]
-        phones_to_update = set(PHONE_VALUE_FIELDS.keys()) & set(fields)
+        phones_to_update = set(PHONE_VALUE_FIELDS.keys()) & fields
         if phones_to_update:
             not_found = True
             for f in list(phones_to_update):
@@ -213,11 +173,11 @@ class PartnerExporter(ExchangeExporter):
             run a delayed job for the exchange record
         """
         user = self.env['res.users'].browse(user_id)
-        return self.env['exchange.res.partner'].with_delay(
-            priority=30).import_record(
-                self.backend_record,
-                user,
-                contact_instance.itemid)
+        return self.env['exchange.res.partner']._delay_import_record(
+            self.backend_record,
+            user,
+            contact_instance.item_id,
+            priority=30)
 
     def create_exchange_contact(self, fields):
         record = self._create_data(fields=fields)
@@ -228,9 +188,14 @@ class PartnerExporter(ExchangeExporter):
         if not record:
             return _('Nothing to export.')
         response = self._update(record)
-        self.binding.with_context(
-            connector_no_export=True).write(
-            {'change_key': response.changekey})
+        self._set_synced(response)
+
+    def update_merged(self, contact, fields):
+        """ Export fields on a contact already read from Exchange """
+        self.fill_contact(contact, fields)
+        contact.categories = ['Odoo']
+        response = self._update(contact)
+        self._set_synced(response)
 
     def change_key_equals(self, exchange_record):
         return (
@@ -246,8 +211,7 @@ class PartnerExporter(ExchangeExporter):
         if not self.binding.external_id:
             # create contact in exchange
             exchange_record = self.create_exchange_contact(fields)
-            self.binding.external_id = exchange_record.id
-            self.binding.change_key = exchange_record.changekey
+            self._set_synced(exchange_record)
         else:
             # we have a binding
             # try to find an exchange contact with this binding ID
@@ -260,15 +224,24 @@ class PartnerExporter(ExchangeExporter):
                     # update contact
                     self.update_existing(fields)
                 else:
-                    # run a delayed import of this Exchange contact
-                    # self.run_delayed_import_of_exchange_contact(
-                    #     user.id,
-                    #     exchange_record)
-                    #  todo uncomment delay part
-                    self.env['exchange.res.partner'].import_record(
-                        self.backend_record,
-                        user,
-                        exchange_record.item_id)
+                    merge = self._merge(exchange_record)
+                    if merge is None:
+                        # no snapshot to merge, import this Exchange
+                        # contact
+                        # self.run_delayed_import_of_exchange_contact(
+                        #     user.id,
+                        #     exchange_record)
+                        #  todo uncomment delay part
+                        self.env['exchange.res.partner'].import_record(
+                            self.backend_record,
+                            user,
+                            exchange_record.item_id)
+                    elif merge.to_exchange:
+                        # export the fields changed only in Odoo
+                        self.update_merged(exchange_record,
+                                           merge.to_exchange)
+                    else:
+                        self._set_synced(exchange_record)
             else:
                 # if not self.external_id:
                 #     _logger.debug('deleted --> UNLINK')
@@ -279,8 +252,7 @@ class PartnerExporter(ExchangeExporter):
                 # else:
                 # create contact in exchange and update its `external_id`
                 exchange_record = self.create_exchange_contact(fields)
-                self.binding.external_id = exchange_record.id
-                self.binding.change_key = exchange_record.changekey
+                self._set_synced(exchange_record)
         return _("Record exported with ID %s on Exchange") % (
             self.binding.external_id)
 
@@ -4,31 +4,14 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
 
 import logging
-from odoo.addons.queue_job.exception import FailedJobError
-from odoo import _
 from ...backend import exchange_2010
 from ...unit.importer import ExchangeImporter
 from .exporter import EXCHANGE_STREET_SEPARATOR
+from .mapping import PARTNER_MAPPING
 
 _logger = logging.getLogger(__name__)
 
 
-SIMPLE_VALUE_FIELDS = {'given_name': 'firstname',
-                       'display_name': 'name',
-                       'complete_name': 'lastname',
-                       'surname': 'lastname',
-                       'business_homepage': 'website',
-                       'company_name': 'company_name',
-                       'job_title': 'function',
-                       }
-
-RELATIONAL_VALUE_FIELDS = {
-    'display_name': {'title': {'partner_field': 'title',
-                               'relation': 'res.partner.title',
-                               'search_operator': '=',
-                               'relation_field': 'name'}},
-    }
-
 PARTNER_DEFAULT_VALUES = {
     'customer': True
 }
@@ -86,50 +69,7 @@ class PartnerExchangeImporter(ExchangeImporter):
         return addr
 
     def map_exchange_instance(self, contact_instance):
-        vals = {}
-
-        for ex_field, odoo_mapping in SIMPLE_VALUE_FIELDS.iteritems():
-            if isinstance(odoo_mapping, basestring):
-                if hasattr(contact_instance, ex_field):
-                    vals[odoo_mapping] = getattr(contact_instance, ex_field)
-
-            elif isinstance(odoo_mapping, dict):
-                exchange_obj = getattr(contact_instance, ex_field)
-                for k, v in odoo_mapping.iteritems():
-                    vals[v] = getattr(exchange_obj, k)
-            else:
-                # not supported
-                raise FailedJobError(
-                    _('odoo_mapping must be string or dict type')
-                    )
-
-        for ex_field, map_dict in RELATIONAL_VALUE_FIELDS.iteritems():
-            # try search relation object with name = contact.ex_field.value
-            # if found: fill partner's field with id found
-            # else: leave this field empty and log something
-            keys = map_dict.keys()
-            if keys and isinstance(map_dict[keys[0]], dict):
-                for k, v in map_dict.iteritems():
-                    obj = self.env[map_dict[k]['relation']]
-                    obj_search = obj.search(
-                        [(map_dict[k]['relation_field'],
-                          map_dict[k]['search_operator'], ex_field)])
-                    if obj_search:
-                        vals[map_dict[k]['partner_field']] = obj_search.id
-            elif keys and isinstance(map_dict[keys[0]], basestring):
-                obj = self.env[map_dict['relation']]
-                obj_search = obj.search(
-                    [(map_dict['relation_field'],
-                      map_dict['search_operator'],
-                      ex_field)])
-                if obj_search:
-                    vals[map_dict['partner_field']] = obj_search.id
-                # else:
-                #     if ex_field == 'company_name':
-                #         vals[map_dict['partner_field']] = (
-                #             self.env.ref(
-                #                 'connector_exchange.res_partner_GENERIC').id)
-
+        vals = PARTNER_MAPPING.map_import(contact_instance, self.env)
         vals.update(self.map_email(contact_instance))
         vals.update(self.map_phones(contact_instance))
         vals.update(self.map_business_address(contact_instance))
@@ -173,16 +113,12 @@ class PartnerExchangeImporter(ExchangeImporter):
             from exchange record, create an odoo dict than can be user
             both in write and create methods
         """
-        contact_id = self.external_id
-        adapter = self.backend_adapter
-        account = adapter.get_account(self.openerp_user)
-        # contact is an exchangelib.Contact instance
-        contact = account.contacts.get(id=contact_id)
-
-        # contact is an exchangelib.Contact instance
-        vals = self.map_exchange_instance(contact)
-        vals['external_record'] = self.external_record
-        return vals
+        # external_record is an exchangelib.Contact instance
+        return self.map_exchange_instance(self.external_record)
+
+    def _get_exchange_record(self):
+        account = self.backend_adapter.get_account(self.openerp_user)
+        return account.contacts.get(id=self.external_id)
 
     def _update(self, binding, data, context_keys=None):
         """ Update an Odoo record """
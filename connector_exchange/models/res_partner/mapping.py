@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
+
+""" Mapping of the partners and the Exchange contacts
+
+The addresses, the email and the phones are indexed properties of the
+contacts, they are mapped by the importer and the exporter.
+"""
+
+from ...unit.mapper import MappedField, MappingSpec
+
+PARTNER_MAPPING = MappingSpec([
+    MappedField('firstname', 'given_name'),
+    MappedField('name', 'display_name'),
+    MappedField('lastname', 'surname', direction='import'),
+    MappedField('lastname', 'nickname', direction='export'),
+    MappedField('website', 'business_homepage'),
+    MappedField('function', 'job_title'),
+    # the importer links the partner to its company
+    MappedField('company_name', 'company_name', direction='import'),
+    MappedField('parent_id', 'company_name', relation='res.partner',
+                direction='export'),
+    MappedField('title', 'complete_name.title',
+                relation='res.partner.title'),
+])
@@ -7,6 +7,8 @@ import logging
 
 from odoo import models, fields, api
 
+from .exporter import EXPORTED_FIELDS
+
 _logger = logging.getLogger(__name__)
 
 
@@ -44,13 +46,30 @@ class ResPartner(models.Model):
                 b.export_record()
         return True
 
+    @api.model
+    def create(self, vals):
+        partner = super(ResPartner, self).create(vals)
+        if partner.user_id:
+            self.env['exchange.sync.membership']._refresh_contacts(
+                partner.ids)
+        return partner
+
+    @api.multi
+    def write(self, vals):
+        result = super(ResPartner, self).write(vals)
+        if set(vals) & set(['user_id', 'is_company', 'active']):
+            self.env['exchange.sync.membership']._refresh_contacts(self.ids)
+        return result
+
     @api.multi
     def unlink(self):
         for rec in self:
             for binding in rec.exchange_bind_ids:
                 binding.export_delete_record(
                     binding.external_id, binding.user_id)
+        partner_ids = self.ids
         super(ResPartner, self).unlink()
+        self.env['exchange.sync.membership']._refresh_contacts(partner_ids)
 
 
 class ExchangeResPartner(models.Model):
@@ -59,6 +78,8 @@ class ExchangeResPartner(models.Model):
     _inherits = {'res.partner': 'openerp_id'}
     _description = 'Exchange Contact'
 
+    _exchange_fields = sorted(EXPORTED_FIELDS)
+
     openerp_id = fields.Many2one(comodel_name='res.partner',
                                  string='Partner',
                                  required=True,
@@ -4,7 +4,8 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import logging
-from datetime import timedelta
+from collections import defaultdict
+from datetime import datetime, time, timedelta
 from odoo import models, fields, api, _
 
 _logger = logging.getLogger(__name__)
@@ -20,6 +21,18 @@ class ResCompany(models.Model):
         )
 
 
+def _get_folder_cache(env):
+    """ Return the folders resolved in the current environments
+
+    The cache is kept on the environments of the request (or job), by
+    database, and is keyed by (backend id, user id, folder type).
+    """
+    caches = getattr(env.all, 'exchange_folder_cache', None)
+    if caches is None:
+        caches = env.all.exchange_folder_cache = {}
+    return caches.setdefault(env.cr.dbname, {})
+
+
 class ResUserBackendFolder(models.Model):
     _name = 'res.users.backend.folder'
 
@@ -36,31 +49,115 @@ class ResUserBackendFolder(models.Model):
                                     ('contact', 'Contact'),
                                     ('calendar', 'Calendar')],
                                    default='create')
+    enumeration_offset = fields.Integer(
+        readonly=True,
+        help="Position of the next page to read when the enumeration "
+             "of the folder is resumed",
+    )
+    enumeration_date = fields.Date(
+        readonly=True,
+        help="Date on which the current enumeration of the folder started",
+    )
+    subscription_id = fields.Char(
+        string='Subscription ID',
+        readonly=True,
+        help="Exchange pull subscription listening to the folder",
+    )
+    subscription_watermark = fields.Char(
+        readonly=True,
+        help="Position of the last event read from the subscription",
+    )
+    subscription_expire_date = fields.Datetime(
+        readonly=True,
+        help="The subscription expires on Exchange if it is not polled "
+             "before this date",
+    )
 
     _sql_constraints = [
         ('unique_folder', "unique(backend_id, user_id, folder_type)",
          _('Only one folder by user, by backend and by folder type')),
     ]
 
+    @api.multi
+    def _uncache(self):
+        """ Remove the folders from the cache of ``find_folders`` """
+        cache = _get_folder_cache(self.env)
+        for folder in self:
+            cache.pop((folder.backend_id.id, folder.user_id.id,
+                       folder.folder_type), None)
+
+    @api.model
+    def create(self, vals):
+        folder = super(ResUserBackendFolder, self).create(vals)
+        folder._uncache()
+        return folder
+
+    @api.multi
+    def write(self, vals):
+        # the offsets and watermarks are written on every page and poll,
+        # the cache is only invalidated when the key of a folder changes
+        if set(vals) & set(['backend_id', 'user_id', 'folder_type']):
+            self._uncache()
+            result = super(ResUserBackendFolder, self).write(vals)
+            self._uncache()
+            return result
+        return super(ResUserBackendFolder, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._uncache()
+        return super(ResUserBackendFolder, self).unlink()
+
 
 class ResUsers(models.Model):
     _inherit = 'res.users'
 
     @api.model
-    def _get_last_calendar_sync_date(self):
-        today = fields.Date.from_string(fields.Date.today())
+    def _get_exchange_days_param(self, key, default):
+        """ Read a number of days from the system parameters """
         days_offset_str = self.env['ir.config_parameter'].get_param(
-            'exchange_calendar_sync_past_offset', '30')
+            key, str(default))
         try:
-            days_offset = int(days_offset_str)
+            return int(days_offset_str)
         except ValueError as err:
             _logger.warning(err.message)
-            _logger.warning('Cannot convert %s to integer. Using 30',
-                            days_offset_str)
-            days_offset = 30
+            _logger.warning('Cannot convert %s to integer. Using %s',
+                            days_offset_str, default)
+            return default
+
+    @api.model
+    def _get_last_calendar_sync_date(self):
+        today = fields.Date.from_string(fields.Date.today())
+        days_offset = self._get_exchange_days_param(
+            'exchange_calendar_sync_past_offset', 60)
         last_calendar_sync_date = today - timedelta(days=days_offset)
         return fields.Date.to_string(last_calendar_sync_date)
 
+    @api.model
+    def _get_calendar_sync_window(self, today=None, backend=None):
+        """ Return the period of the events to synchronize
+
+        It starts ``exchange_calendar_sync_past_offset`` days before today
+        and ends ``exchange_calendar_sync_future_offset`` days after, unless
+        the backend sets its own numbers of days.
+
+        :param today: date (string) to use instead of today
+        :param backend: exchange.backend whose period is used
+        :returns: tuple (start, stop) of naive UTC datetimes
+        """
+        today = datetime.combine(
+            fields.Date.from_string(today or fields.Date.today()), time.min)
+        past_offset = backend and backend.calendar_past_days
+        if not past_offset:
+            past_offset = self._get_exchange_days_param(
+                'exchange_calendar_sync_past_offset', 60)
+        future_offset = backend and backend.calendar_future_days
+        if not future_offset:
+            future_offset = self._get_exchange_days_param(
+                'exchange_calendar_sync_future_offset', 365)
+        return (today - timedelta(days=past_offset),
+                today + timedelta(days=future_offset + 1))
+
     @api.model
     @api.returns('exchange.backend')
     def _get_default_backend(self):
@@ -90,6 +187,38 @@ class ResUsers(models.Model):
         default=_get_last_calendar_sync_date
     )
 
+    @api.multi
+    def find_folders(self, backend_id, folder_type):
+        """ Return the folders of the users for a backend and a type
+
+        The folders missing from the cache are read in one query. The
+        cache lives as long as the environments of the transaction, the
+        folders created or deleted meanwhile are removed from it.
+
+        :returns: dict {user_id: res.users.backend.folder}
+        """
+        cache = _get_folder_cache(self.env)
+        missing = [user_id for user_id in self.ids
+                   if (backend_id, user_id, folder_type) not in cache]
+        if missing:
+            for user_id in missing:
+                cache[(backend_id, user_id, folder_type)] = None
+            folders = self.env['res.users.backend.folder'].search(
+                [('backend_id', '=', backend_id),
+                 ('user_id', 'in', missing),
+                 ('folder_type', '=', folder_type)]
+            )
+            for folder in folders:
+                key = (backend_id, folder.user_id.id, folder_type)
+                if cache[key] is None:
+                    cache[key] = folder.id
+        folder_model = self.env['res.users.backend.folder']
+        return dict(
+            (user_id,
+             folder_model.browse(cache[(backend_id, user_id, folder_type)]))
+            for user_id in self.ids
+        )
+
     @api.multi
     def find_folder(self, backend_id, create=True,
                     default_name='Contacts',
@@ -98,21 +227,14 @@ class ResUsers(models.Model):
         self.ensure_one()
         if user is None:
             user = self
-        folders = user.backend_folder_ids.filtered(
-            lambda a: a.backend_id.id == backend_id and
-            a.folder_type == folder_type and
-            a.user_id == user
-            )
+        folder = user.find_folders(backend_id, folder_type)[user.id]
 
-        if not folders and create:
+        if not folder and create:
             return self.backend_folder_ids.create({'user_id': self.id,
                                                    'backend_id': backend_id,
                                                    'name': default_name,
                                                    'folder_type': folder_type})
-        elif not folders and not create:
-            return self.env['res.users.backend.folder']
-        else:
-            return folders[0]
+        return folder
 
     @api.depends()
     def _compute_exchange_contacts(self):
@@ -121,33 +243,89 @@ class ResUsers(models.Model):
 
     @api.depends()
     def _compute_exchange_calendar_events(self):
+        date_from, date_to = self._get_calendar_sync_window()
+        events = self.env['exchange.sync.membership']._get_event_ids(
+            self.ids, date_from, date_to)
         for user in self:
-            user.exchange_calendar_ids = user.find_exchange_calendar_events()
+            user.exchange_calendar_ids = list(events[user.id])
+
+    @api.model
+    def create(self, vals):
+        user = super(ResUsers, self).create(vals)
+        # the user follows the contacts its partner follows
+        self.env['exchange.sync.membership']._refresh_followed_contacts(
+            user.partner_id.ids)
+        return user
+
+    @api.multi
+    def write(self, vals):
+        if 'partner_id' not in vals:
+            return super(ResUsers, self).write(vals)
+        partner_ids = self.mapped('partner_id').ids
+        result = super(ResUsers, self).write(vals)
+        partner_ids += self.mapped('partner_id').ids
+        self.env['exchange.sync.membership']._refresh_followed_contacts(
+            partner_ids)
+        return result
+
+    @api.model
+    def _get_contacts_queries(self):
+        """ SQL queries returning the contacts of the users
+
+        Each query selects the ``user_id`` and ``partner_id`` columns, the
+        keys are the reasons stored in ``exchange.sync.membership``.
+        Can be inherited to add sources of contacts (with a ``selection_add``
+        on the ``reason`` field of the membership).
+        """
+        return {
+            'salesperson': """
+                SELECT p.user_id, p.id AS partner_id
+                FROM res_partner p
+                WHERE p.active
+            """,
+            'lead': """
+                SELECT l.user_id, l.partner_id
+                FROM crm_lead l
+                WHERE l.active
+                AND l.partner_id IS NOT NULL
+            """,
+            'follower': """
+                SELECT u.id AS user_id, f.res_id AS partner_id
+                FROM mail_followers f
+                JOIN res_users u ON u.partner_id = f.partner_id
+                WHERE f.res_model = 'res.partner'
+            """,
+        }
+
+    @api.multi
+    def _get_contacts_by_user(self):
+        """ Return the ids of the contacts of the users
+
+        The contacts are read from the ``exchange.sync.membership`` table,
+        maintained from the queries of :meth:`_get_contacts_queries`.
+
+        :returns: dict {user_id: set of res.partner ids}
+        """
+        contacts = defaultdict(set)
+        contacts.update(self.env['exchange.sync.membership']._get_res_ids(
+            self.ids, 'res.partner'))
+        return contacts
 
     @api.multi
     @api.returns('res.partner')
     def _get_contacts(self):
-        partners = self.env['res.partner']
-        res = partners.search([('user_id', '=', self.id),
-                               ('is_company', '=', False)])
-
-        leads_partners = self.env['crm.lead'].search(
-            [('user_id', '=', self.id)]
-            ).mapped('partner_id')
-        res |= leads_partners
-
-        # Following
-        # ---------
-        mail_follow_obj = self.env['mail.followers']
-        mail_followers = mail_follow_obj.search(
-            [('res_model', '=', 'res.partner'),
-             ('partner_id', '=', self.partner_id.id)]
-            )
-        mail_followers_res_ids = mail_followers.mapped('res_id')
-        followed_partners = partners.browse(mail_followers_res_ids).exists()
-        res |= followed_partners
+        """ Contacts of the user, can be inherited to add contacts
 
-        return res
+        The contacts of :meth:`_get_contacts_queries` are read with
+        :meth:`_get_contacts_by_user`, then searched so the record rules
+        apply.
+        """
+        self.ensure_one()
+        contact_ids = self._get_contacts_by_user()[self.id]
+        if not contact_ids:
+            return self.env['res.partner'].browse()
+        return self.env['res.partner'].search(
+            [('id', 'in', list(contact_ids))])
 
     @api.multi
     @api.returns('res.partner')
@@ -179,5 +357,7 @@ class ResUsers(models.Model):
     @api.multi
     @api.returns('calendar.event')
     def find_exchange_calendar_events(self):
-        return self.env['calendar.event'].search(
-            [('user_id', '=', self.id)])
+        date_from, date_to = self._get_calendar_sync_window()
+        events = self.env['exchange.sync.membership']._get_event_ids(
+            self.ids, date_from, date_to)
+        return self.env['calendar.event'].browse(list(events[self.id]))
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+from contextlib import closing, contextmanager
+from uuid import uuid4
+
+import odoo
+from odoo import models, fields, api, tools
+
+from ..exchange_backend.common import SYNC_KINDS
+from ...unit.throttle import is_postponed
+
+_logger = logging.getLogger(__name__)
+
+
+class ExchangeSyncLease(models.Model):
+    """ Lease on a kind of synchronization of a backend
+
+    A cron run takes the lease before it delays the synchronization jobs
+    of the users, in the same transaction: if the run fails, neither the
+    lease nor the jobs are kept. The jobs release it when they are all
+    done or failed. A run finding a live lease is skipped. The jobs
+    refresh the lease with a heartbeat; when they stop doing so (crashed
+    worker), the lease expires and the next run takes it. A lease does not
+    expire while jobs of its synchronization are still waiting in the
+    queue.
+    """
+    _name = 'exchange.sync.lease'
+    _description = 'Exchange Sync Lease'
+    _log_access = False
+    _rec_name = 'sync_kind'
+
+    backend_id = fields.Many2one(comodel_name='exchange.backend',
+                                 string='Backend',
+                                 required=True,
+                                 readonly=True,
+                                 ondelete='cascade')
+    sync_kind = fields.Selection(SYNC_KINDS,
+                                 string='Synchronization',
+                                 required=True,
+                                 readonly=True)
+    token = fields.Char(readonly=True)
+    pending_jobs = fields.Integer(readonly=True)
+    heartbeat_date = fields.Datetime(string='Last Heartbeat', readonly=True)
+    expire_date = fields.Datetime(string='Expires On', readonly=True)
+    skipped_runs = fields.Integer(readonly=True)
+    last_skip_date = fields.Datetime(string='Last Skipped Run',
+                                     readonly=True)
+
+    _sql_constraints = [
+        ('lease_uniq', 'unique(backend_id, sync_kind)',
+         'A backend can have only one lease by kind of synchronization.'),
+    ]
+
+    @contextmanager
+    def _lease_cursor(self):
+        """ Yield a cursor committed as soon as the lease is changed
+
+        Used by the jobs: their heartbeats must be seen by the other runs
+        before the end of the job, and the release of a failed job must
+        survive the rollback of its transaction. In tests, the current
+        cursor is used because we can't commit.
+        """
+        if tools.config['test_enable']:
+            yield self.env.cr
+            return
+        with odoo.api.Environment.manage():
+            registry = odoo.modules.registry.RegistryManager.get(
+                self.env.cr.dbname
+            )
+            with closing(registry.cursor()) as cr:
+                try:
+                    yield cr
+                except Exception:
+                    cr.rollback()
+                    raise
+                else:
+                    cr.commit()
+
+    @api.model
+    def _acquire(self, backend, sync_kind):
+        """ Take the lease of a kind of synchronization of a backend
+
+        The lease is written in the transaction of the run. A concurrent
+        run waits on the row until this transaction ends, then sees the
+        lease taken. An expired lease is only taken when no job of the
+        synchronization is pending or enqueued: the jobs waiting longer
+        than the timeout in a busy channel do not send heartbeats.
+
+        :returns: the token of the lease, None if another run holds it
+        """
+        token = uuid4().hex
+        job_prefix = backend._sync_user_identity_key(sync_kind)
+        cr = self.env.cr
+        cr.execute("""
+            INSERT INTO exchange_sync_lease
+                (backend_id, sync_kind, token, pending_jobs,
+                 heartbeat_date, expire_date, skipped_runs)
+            SELECT b.id, %(sync_kind)s, %(token)s, 0,
+                   now() AT TIME ZONE 'UTC',
+                   now() AT TIME ZONE 'UTC'
+                   + b.sync_lease_timeout * interval '1 minute',
+                   0
+            FROM exchange_backend b
+            WHERE b.id = %(backend_id)s
+            ON CONFLICT (backend_id, sync_kind) DO UPDATE
+            SET token = EXCLUDED.token,
+                pending_jobs = 0,
+                heartbeat_date = EXCLUDED.heartbeat_date,
+                expire_date = EXCLUDED.expire_date
+            WHERE exchange_sync_lease.token IS NULL
+            OR (exchange_sync_lease.expire_date < EXCLUDED.heartbeat_date
+                AND NOT EXISTS (
+                    SELECT 1 FROM queue_job j
+                    WHERE j.identity_key LIKE %(job_prefix)s
+                    AND j.state IN ('pending', 'enqueued')
+                ))
+            RETURNING id
+        """, {'backend_id': backend.id,
+              'sync_kind': sync_kind,
+              'token': token,
+              'job_prefix': job_prefix + '%'})
+        if cr.fetchone():
+            return token
+        cr.execute("""
+            UPDATE exchange_sync_lease
+            SET skipped_runs = skipped_runs + 1,
+                last_skip_date = now() AT TIME ZONE 'UTC'
+            WHERE backend_id = %s AND sync_kind = %s
+        """, (backend.id, sync_kind))
+        _logger.info('%s of backend %s still running, run skipped',
+                     sync_kind, backend.name)
+        return None
+
+    @api.model
+    def _set_pending_jobs(self, token, count):
+        """ Record the number of jobs holding the lease
+
+        The lease is released right away when there is no job. Like
+        :meth:`_acquire`, it is called in the transaction of the run.
+        """
+        self.env.cr.execute("""
+            UPDATE exchange_sync_lease
+            SET pending_jobs = %(count)s,
+                token = CASE WHEN %(count)s > 0 THEN token END
+            WHERE token = %(token)s
+        """, {'count': count, 'token': token})
+
+    @api.model
+    def _heartbeat(self, token):
+        """ Extend the expiration of the lease held by a running job """
+        with self._lease_cursor() as cr:
+            cr.execute("""
+                UPDATE exchange_sync_lease l
+                SET heartbeat_date = now() AT TIME ZONE 'UTC',
+                    expire_date = now() AT TIME ZONE 'UTC'
+                                  + b.sync_lease_timeout * interval '1 minute'
+                FROM exchange_backend b
+                WHERE b.id = l.backend_id
+                AND l.token = %s
+            """, (token,))
+
+    @contextmanager
+    def _release_on_failure(self, token):
+        """ Release the lease held by a job when it fails
+
+        A job postponed (throttled, retryable error) still holds it.
+        """
+        try:
+            yield
+        except Exception as err:
+            if token and not is_postponed(err):
+                self._release_job(token)
+            raise
+
+    @api.model
+    def _release_job(self, token):
+        """ Called by a job when done or failed, the last job releases the
+        lease
+        """
+        with self._lease_cursor() as cr:
+            cr.execute("""
+                UPDATE exchange_sync_lease
+                SET pending_jobs = pending_jobs - 1,
+                    heartbeat_date = now() AT TIME ZONE 'UTC',
+                    token = CASE WHEN pending_jobs > 1 THEN token END
+                WHERE token = %s
+            """, (token,))
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+
+class ExchangeSyncMembership(models.Model):
+    """ Records synchronized with Exchange for each user
+
+    Materialization of the contacts (``res.partner``) and events
+    (``calendar.event``) of the users, with the reason why they are synced.
+    The rows are refreshed by the hooks on the source models so the sync
+    runs only have to read them.
+    """
+    _name = 'exchange.sync.membership'
+    _description = 'Exchange Sync Membership'
+    _log_access = False
+
+    user_id = fields.Many2one(comodel_name='res.users',
+                              string='User',
+                              required=True,
+                              ondelete='cascade')
+    res_model = fields.Selection([('res.partner', 'Contact'),
+                                  ('calendar.event', 'Event')],
+                                 string='Model',
+                                 required=True)
+    res_id = fields.Integer(string='Record ID', required=True)
+    reason = fields.Selection([('salesperson', 'Salesperson'),
+                               ('lead', 'Lead'),
+                               ('follower', 'Follower'),
+                               ('organizer', 'Organizer')],
+                              required=True)
+
+    _sql_constraints = [
+        ('membership_uniq', 'unique(user_id, res_model, res_id, reason)',
+         'A record can be synced only once by user for the same reason.'),
+    ]
+
+    @api.model_cr
+    def init(self):
+        self.env.cr.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE indexname = 'exchange_sync_membership_res_idx'
+        """)
+        if not self.env.cr.fetchone():
+            self.env.cr.execute("""
+                CREATE INDEX exchange_sync_membership_res_idx
+                ON exchange_sync_membership (res_model, res_id)
+            """)
+        # the rows are maintained by the hooks, they are only computed
+        # when the module is installed
+        self.env.cr.execute("SELECT 1 FROM exchange_sync_membership LIMIT 1")
+        if not self.env.cr.fetchone():
+            self._rebuild()
+
+    @api.model
+    def _rebuild(self):
+        """ Compute again all the rows from the source models """
+        self.env.cr.execute("DELETE FROM exchange_sync_membership")
+        self._insert_contacts()
+        self._insert_events()
+
+    @api.model
+    def _insert_contacts(self, partner_ids=None):
+        queries = self.env['res.users']._get_contacts_queries()
+        for reason, query in queries.iteritems():
+            sql = """
+                INSERT INTO exchange_sync_membership
+                    (user_id, res_model, res_id, reason)
+                SELECT DISTINCT c.user_id, 'res.partner', c.partner_id, %%s
+                FROM (%s) AS c
+                JOIN res_partner p ON p.id = c.partner_id
+                WHERE c.user_id IS NOT NULL
+                AND NOT COALESCE(p.is_company, false)
+            """ % query
+            params = [reason]
+            if partner_ids is not None:
+                sql += " AND c.partner_id IN %s"
+                params.append(tuple(partner_ids))
+            # the rows can be inserted by a concurrent transaction
+            sql += " ON CONFLICT DO NOTHING"
+            self.env.cr.execute(sql, params)
+
+    @api.model
+    def _insert_events(self, event_ids=None):
+        sql = """
+            INSERT INTO exchange_sync_membership
+                (user_id, res_model, res_id, reason)
+            SELECT e.user_id, 'calendar.event', e.id, 'organizer'
+            FROM calendar_event e
+            WHERE e.user_id IS NOT NULL
+            AND e.active
+        """
+        params = []
+        if event_ids is not None:
+            sql += " AND e.id IN %s"
+            params.append(tuple(event_ids))
+        sql += " ON CONFLICT DO NOTHING"
+        self.env.cr.execute(sql, params)
+
+    @api.model
+    def _refresh_contacts(self, partner_ids):
+        """ Compute again the rows of the given partners """
+        partner_ids = [pid for pid in set(partner_ids) if pid]
+        if not partner_ids:
+            return
+        self.env.cr.execute("""
+            DELETE FROM exchange_sync_membership
+            WHERE res_model = 'res.partner'
+            AND res_id IN %s
+        """, (tuple(partner_ids),))
+        self._insert_contacts(partner_ids=partner_ids)
+
+    @api.model
+    def _refresh_followed_contacts(self, follower_partner_ids):
+        """ Compute again the rows of the contacts followed by partners,
+        when they become or stop being the partners of users
+        """
+        follower_partner_ids = [pid for pid in set(follower_partner_ids)
+                                if pid]
+        if not follower_partner_ids:
+            return
+        self.env.cr.execute("""
+            SELECT DISTINCT res_id
+            FROM mail_followers
+            WHERE res_model = 'res.partner'
+            AND partner_id IN %s
+        """, (tuple(follower_partner_ids),))
+        self._refresh_contacts([row[0] for row in self.env.cr.fetchall()])
+
+    @api.model
+    def _refresh_events(self, event_ids):
+        """ Compute again the rows of the given (real) events """
+        event_ids = [eid for eid in set(event_ids) if eid]
+        if not event_ids:
+            return
+        self.env.cr.execute("""
+            DELETE FROM exchange_sync_membership
+            WHERE res_model = 'calendar.event'
+            AND res_id IN %s
+        """, (tuple(event_ids),))
+        self._insert_events(event_ids=event_ids)
+
+    @api.model
+    def _get_res_ids(self, user_ids, res_model):
+        """ Return the synced records of the users
+
+        :returns: dict {user_id: set of record ids}
+        """
+        res_ids = dict((user_id, set()) for user_id in user_ids)
+        if not user_ids:
+            return res_ids
+        self.env.cr.execute("""
+            SELECT user_id, res_id
+            FROM exchange_sync_membership
+            WHERE res_model = %s
+            AND user_id IN %s
+        """, (res_model, tuple(user_ids)))
+        for user_id, res_id in self.env.cr.fetchall():
+            res_ids[user_id].add(res_id)
+        return res_ids
+
+    @api.model
+    def _get_event_ids(self, user_ids, date_from, date_to):
+        """ Return the synced events of the users in a period
+
+        Recurrent events are kept until their final date.
+
+        :returns: dict {user_id: set of calendar.event ids}
+        """
+        event_ids = dict((user_id, set()) for user_id in user_ids)
+        if not user_ids:
+            return event_ids
+        self.env.cr.execute("""
+            SELECT m.user_id, m.res_id
+            FROM exchange_sync_membership m
+            JOIN calendar_event e ON e.id = m.res_id
+            WHERE m.res_model = 'calendar.event'
+            AND m.user_id IN %s
+            AND e.start <= %s
+            AND (e.stop >= %s
+                 OR (e.recurrency AND (e.final_date IS NULL
+                                       OR e.final_date >= %s)))
+        """, (tuple(user_ids), date_to, date_from, date_from.date()))
+        for user_id, event_id in self.env.cr.fetchall():
+            event_ids[user_id].add(event_id)
+        return event_ids
+
+
+class CrmLead(models.Model):
+    _inherit = 'crm.lead'
+
+    _exchange_membership_fields = ('user_id', 'partner_id', 'active')
+
+    @api.model
+    def create(self, vals):
+        lead = super(CrmLead, self).create(vals)
+        if lead.user_id and lead.partner_id:
+            self.env['exchange.sync.membership']._refresh_contacts(
+                lead.partner_id.ids)
+        return lead
+
+    @api.multi
+    def write(self, vals):
+        if not set(vals) & set(self._exchange_membership_fields):
+            return super(CrmLead, self).write(vals)
+        partner_ids = self.with_context(active_test=False).mapped(
+            'partner_id').ids
+        result = super(CrmLead, self).write(vals)
+        partner_ids += self.with_context(active_test=False).mapped(
+            'partner_id').ids
+        self.env['exchange.sync.membership']._refresh_contacts(partner_ids)
+        return result
+
+    @api.multi
+    def unlink(self):
+        partner_ids = self.with_context(active_test=False).mapped(
+            'partner_id').ids
+        result = super(CrmLead, self).unlink()
+        self.env['exchange.sync.membership']._refresh_contacts(partner_ids)
+        return result
+
+
+class MailFollowers(models.Model):
+    _inherit = 'mail.followers'
+
+    @api.multi
+    def _exchange_followed_partner_ids(self):
+        return [follower.res_id for follower in self
+                if follower.res_model == 'res.partner']
+
+    @api.model
+    def create(self, vals):
+        follower = super(MailFollowers, self).create(vals)
+        self.env['exchange.sync.membership']._refresh_contacts(
+            follower._exchange_followed_partner_ids())
+        return follower
+
+    @api.multi
+    def write(self, vals):
+        partner_ids = self._exchange_followed_partner_ids()
+        result = super(MailFollowers, self).write(vals)
+        partner_ids += self._exchange_followed_partner_ids()
+        self.env['exchange.sync.membership']._refresh_contacts(partner_ids)
+        return result
+
+    @api.multi
+    def unlink(self):
+        partner_ids = self._exchange_followed_partner_ids()
+        result = super(MailFollowers, self).unlink()
+        self.env['exchange.sync.membership']._refresh_contacts(partner_ids)
+        return result
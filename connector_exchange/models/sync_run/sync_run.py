@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, fields, api
+
+from ..exchange_backend.common import SYNC_KINDS
+
+EWS_STATS_FIELDS = ['ews_request_count',
+                    'ews_request_time',
+                    'ews_bytes_sent',
+                    'ews_bytes_received',
+                    'ews_throttled_count',
+                    ]
+
+
+class ExchangeEWSStatsMixin(models.AbstractModel):
+    """ Totals of the requests sent to Exchange
+
+    The values are given by ``EWSStats.get_values()``.
+    """
+    _name = 'exchange.ews.stats.mixin'
+    _description = 'Exchange Requests Totals'
+
+    ews_request_count = fields.Integer(string='Exchange Requests',
+                                       readonly=True)
+    ews_request_time = fields.Float(string='Exchange Time (s)',
+                                    readonly=True)
+    ews_bytes_sent = fields.Integer(string='Bytes Sent', readonly=True)
+    ews_bytes_received = fields.Integer(string='Bytes Received',
+                                        readonly=True)
+    ews_throttled_count = fields.Integer(string='Throttled Requests',
+                                         readonly=True)
+    ews_operations = fields.Text(string='Requests by Operation',
+                                 readonly=True,
+                                 help="Totals by EWS operation (JSON)")
+
+
+class QueueJob(models.Model):
+    _name = 'queue.job'
+    _inherit = ['queue.job', 'exchange.ews.stats.mixin']
+
+
+class ExchangeSyncRun(models.Model):
+    """ A cron run of a kind of synchronization
+
+    Each synchronization job adds a line with the requests it sent to
+    Exchange for its user.
+    """
+    _name = 'exchange.sync.run'
+    _description = 'Exchange Sync Run'
+    _order = 'id desc'
+    _rec_name = 'sync_kind'
+
+    backend_id = fields.Many2one(comodel_name='exchange.backend',
+                                 string='Backend',
+                                 required=True,
+                                 readonly=True,
+                                 ondelete='cascade')
+    sync_kind = fields.Selection(SYNC_KINDS,
+                                 string='Synchronization',
+                                 required=True,
+                                 readonly=True)
+    user_count = fields.Integer(string='Users', readonly=True)
+    line_ids = fields.One2many(comodel_name='exchange.sync.run.line',
+                               inverse_name='run_id',
+                               string='Users',
+                               readonly=True)
+    done_count = fields.Integer(string='Users Done',
+                                compute='_compute_totals')
+    ews_request_count = fields.Integer(string='Exchange Requests',
+                                       compute='_compute_totals')
+    ews_request_time = fields.Float(string='Exchange Time (s)',
+                                    compute='_compute_totals')
+    ews_bytes_sent = fields.Integer(string='Bytes Sent',
+                                    compute='_compute_totals')
+    ews_bytes_received = fields.Integer(string='Bytes Received',
+                                        compute='_compute_totals')
+    ews_throttled_count = fields.Integer(string='Throttled Requests',
+                                         compute='_compute_totals')
+
+    @api.depends('line_ids')
+    def _compute_totals(self):
+        groups = self.env['exchange.sync.run.line'].read_group(
+            [('run_id', 'in', self.ids)],
+            ['run_id'] + EWS_STATS_FIELDS,
+            ['run_id'],
+        )
+        totals = dict((group['run_id'][0], group) for group in groups)
+        for run in self:
+            group = totals.get(run.id, {})
+            run.done_count = group.get('run_id_count', 0)
+            for field_name in EWS_STATS_FIELDS:
+                run[field_name] = group.get(field_name) or 0
+
+
+class ExchangeSyncRunLine(models.Model):
+    _name = 'exchange.sync.run.line'
+    _inherit = 'exchange.ews.stats.mixin'
+    _description = 'Exchange Sync Run by User'
+    _order = 'ews_request_time desc'
+
+    run_id = fields.Many2one(comodel_name='exchange.sync.run',
+                             string='Run',
+                             required=True,
+                             readonly=True,
+                             index=True,
+                             ondelete='cascade')
+    user_id = fields.Many2one(comodel_name='res.users',
+                              string='User',
+                              required=True,
+                              readonly=True)
+    job_uuid = fields.Char(string='Job UUID', readonly=True)
+    result = fields.Char(readonly=True)
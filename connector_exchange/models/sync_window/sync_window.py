@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import models, fields, api
+
+
+class ExchangeCalendarSyncWindow(models.Model):
+    """ Period of the initial calendar synchronization of a user
+
+    The first synchronization of a calendar is split in windows of
+    ``initial_sync_window_months`` months, each one enumerated by its own
+    job on the ``root.exchange.initial_sync`` channel. A window is
+    enumerated once its job has delayed the import of its events, and done
+    once these import jobs are done. The windows whose job or one of whose
+    import jobs failed can be retried alone.
+
+    The events overlapping several windows are imported by the jobs of
+    the first window enumerating them.
+    """
+    _name = 'exchange.calendar.sync.window'
+    _description = 'Exchange Initial Calendar Sync Window'
+    _order = 'backend_id, user_id, date_from'
+
+    backend_id = fields.Many2one(comodel_name='exchange.backend',
+                                 string='Backend',
+                                 required=True,
+                                 readonly=True,
+                                 ondelete='cascade')
+    user_id = fields.Many2one(comodel_name='res.users',
+                              string='User',
+                              required=True,
+                              readonly=True,
+                              ondelete='cascade')
+    date_from = fields.Datetime(string='From', required=True, readonly=True)
+    date_to = fields.Datetime(string='To', required=True, readonly=True)
+    state = fields.Selection([('pending', 'Pending'),
+                              ('enumerated', 'Enumerated'),
+                              ('done', 'Done'),
+                              ('failed', 'Failed')],
+                             compute='_compute_state',
+                             store=True)
+    job_uuid = fields.Char(string='Job UUID', readonly=True)
+    job_state = fields.Char(compute='_compute_job_state')
+    import_job_ids = fields.Many2many(
+        comodel_name='queue.job',
+        relation='exchange_calendar_sync_window_queue_job_rel',
+        column1='window_id',
+        column2='job_id',
+        string='Import Jobs',
+        readonly=True,
+    )
+    item_count = fields.Integer(string='Events', readonly=True)
+    date_enumerated = fields.Datetime(string='Enumerated On', readonly=True)
+    date_done = fields.Datetime(string='Done On',
+                                compute='_compute_state',
+                                store=True)
+
+    @api.depends('date_enumerated', 'import_job_ids.state')
+    def _compute_state(self):
+        for window in self:
+            jobs = window.import_job_ids.sudo()
+            states = set(jobs.mapped('state'))
+            window.date_done = False
+            if not window.date_enumerated:
+                window.state = 'pending'
+            elif 'failed' in states:
+                window.state = 'failed'
+            elif states - set(['done']):
+                window.state = 'enumerated'
+            else:
+                window.state = 'done'
+                window.date_done = max(
+                    [window.date_enumerated] +
+                    [date for date in jobs.mapped('date_done') if date])
+
+    @api.depends('job_uuid')
+    def _compute_job_state(self):
+        jobs = self.env['queue.job'].sudo().search_read(
+            [('uuid', 'in', self.mapped('job_uuid'))], ['uuid', 'state'])
+        states = dict((job_['uuid'], job_['state']) for job_ in jobs)
+        for window in self:
+            window.job_state = states.get(window.job_uuid)
+
+    @api.model
+    def _create_windows(self, backend, user, date_from, date_to):
+        """ Split a period in windows of the size configured on the backend
+
+        :param date_from: naive UTC datetime
+        :param date_to: naive UTC datetime
+        """
+        windows = self.browse()
+        step = relativedelta(months=backend.initial_sync_window_months)
+        start = date_from
+        while start < date_to:
+            stop = min(start + step, date_to)
+            windows |= self.create({
+                'backend_id': backend.id,
+                'user_id': user.id,
+                'date_from': fields.Datetime.to_string(start),
+                'date_to': fields.Datetime.to_string(stop),
+            })
+            start = stop
+        return windows
+
+    @api.multi
+    def _delay_import(self):
+        for window in self:
+            job = window.backend_id.with_delay(
+                description='Initial calendar sync: %s, %s - %s' % (
+                    window.user_id.name, window.date_from, window.date_to),
+            ).import_calendar_window(window)
+            window.job_uuid = job.uuid
+
+    @api.multi
+    def action_retry(self):
+        """ Import again the windows pending or failed, and not running
+
+        The events already imported are skipped by the new enumeration.
+        """
+        windows = self.filtered(
+            lambda w: w.state in ('pending', 'failed') and
+            w.job_state not in ('pending', 'enqueued', 'started')
+        )
+        windows.write({'date_enumerated': False,
+                       'import_job_ids': [(5,)]})
+        windows._delay_import()
+        return True
@@ -1,3 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from . import test_exchange_backend
+from . import test_calendar_event
+from . import test_res_users
+from . import test_mock_ews
+from . import test_mapper
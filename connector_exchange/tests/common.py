@@ -12,6 +12,10 @@ from vcr import VCR
 from odoo import SUPERUSER_ID
 from odoo.tests.common import TransactionCase
 
+from ..unit.breaker import CircuitBreaker
+from ..unit.throttle import TokenBucket
+from .mock_ews import MockEWSServer
+
 
 # This is the true URL. Please be sure to record the calls made to it
 # with vcr so that the tests don't hit the service.
@@ -97,3 +101,46 @@ class ExchangeBackendTransactionCase(TransactionCase):
 
     # def _get_environment(self, model_name):
         # return self.lefac_backend.get_environment(model_name)
+
+
+class ExchangeMockServerCase(ExchangeBackendTransactionCase):
+    """ Tests against a local mock of Exchange (see ``mock_ews``)
+
+    The server is shared by the tests of the class, each test uses its own
+    mailbox.
+    """
+
+    mailbox_email = 'jdoe@example.com'
+
+    @classmethod
+    def setUpClass(cls):
+        super(ExchangeMockServerCase, cls).setUpClass()
+        cls.server = MockEWSServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super(ExchangeMockServerCase, cls).tearDownClass()
+
+    def setUp(self):
+        super(ExchangeMockServerCase, self).setUp()
+        self.exchange_backend.write({
+            'disable_autodiscover': True,
+            'location': self.server.url,
+        })
+        self.user.email = '%s-%s' % (self.id().split('.')[-1],
+                                     self.mailbox_email)
+        self.mailbox = self.server.add_mailbox(self.user.email)
+        self.server.reset_counters()
+        # the bucket and the breaker are shared by the tests, outside of
+        # their transaction
+        self.bucket = TokenBucket(self.env.cr.dbname, self.exchange_backend.id,
+                                  self.exchange_backend.throttle_rate,
+                                  self.exchange_backend.throttle_burst,
+                                  self.exchange_backend.throttle_max_wait)
+        self.bucket.reset()
+        self.breaker = CircuitBreaker(
+            self.env.cr.dbname, self.exchange_backend.id,
+            self.exchange_backend.breaker_threshold,
+            self.exchange_backend.breaker_open_duration)
+        self.breaker.reset()
@@ -0,0 +1,1093 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+""" Local mock of an Exchange Web Services server
+
+Serves synthetic mailboxes over HTTP, speaking enough of the EWS SOAP
+protocol for exchangelib and the connector: GetFolder, FindFolder, FindItem,
+GetItem, CreateItem, UpdateItem, DeleteItem, MoveItem, ResolveNames,
+Subscribe and GetEvents.
+
+The items are kept as the XML elements sent or generated, so what is
+created through the connector is returned as is by the next requests.
+Latency and throttling (``ErrorServerBusy`` with a back off) can be
+injected, and the requests are counted by operation.
+
+Usage::
+
+    with MockEWSServer() as server:
+        server.populate(['jdoe@example.com'], contacts=100, events=500)
+        backend.write({'disable_autodiscover': True,
+                       'location': server.url})
+        ...
+        server.requests['FindItem']
+
+It can also be started from the command line for load tests::
+
+    python mock_ews.py --port 8088 --users 50 --events 1000
+"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import copy
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from xml.etree import ElementTree
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:  # python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+_logger = logging.getLogger(__name__)
+
+SOAPNS = 'http://schemas.xmlsoap.org/soap/envelope/'
+MNS = 'http://schemas.microsoft.com/exchange/services/2006/messages'
+TNS = 'http://schemas.microsoft.com/exchange/services/2006/types'
+ENS = 'http://schemas.microsoft.com/exchange/services/2006/errors'
+
+for _prefix, _uri in (('s', SOAPNS), ('m', MNS), ('t', TNS), ('e', ENS)):
+    ElementTree.register_namespace(_prefix, _uri)
+
+SERVER_VERSION = {'MajorVersion': '14',
+                  'MinorVersion': '3',
+                  'MajorBuildNumber': '123',
+                  'MinorBuildNumber': '3',
+                  'Version': 'Exchange2010_SP2'}
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# exchangelib only parses the faults sent with an HTTP 500 when they have
+# an XML declaration
+XML_DECLARATION = b'<?xml version="1.0" encoding="utf-8"?>'
+
+# tags of the indexed fields, by the FieldURI of their entries
+INDEXED_FIELDS = {'contacts:EmailAddress': 'EmailAddresses',
+                  'contacts:PhoneNumber': 'PhoneNumbers',
+                  'contacts:ImAddress': 'ImAddresses'}
+
+FOLDERS = [
+    # distinguished id, display name, element, folder class
+    ('root', 'Root', 'Folder', None),
+    ('msgfolderroot', 'Top of Information Store', 'Folder', 'IPF.Note'),
+    ('calendar', 'Calendar', 'CalendarFolder', 'IPF.Appointment'),
+    ('contacts', 'Contacts', 'ContactsFolder', 'IPF.Contact'),
+    ('deleteditems', 'Deleted Items', 'Folder', 'IPF.Note'),
+    ('inbox', 'Inbox', 'Folder', 'IPF.Note'),
+]
+
+INDEXED_CONTAINERS = set(INDEXED_FIELDS.values()) | {'PhysicalAddresses'}
+
+# at most this number of events are returned by GetEvents
+EVENTS_PAGE_SIZE = 50
+
+FIRST_NAMES = ['Anna', 'Bruno', u'Chloé', 'David', 'Emma', 'Felix', 'Gina',
+               'Hugo', 'Iris', 'Jules', 'Karl', 'Laura', 'Marc', 'Nina']
+LAST_NAMES = ['Muller', 'Favre', 'Rossi', 'Martin', 'Keller', 'Bernard',
+              'Weber', 'Dubois', 'Meier', 'Blanc']
+CITIES = ['Lausanne', 'Zurich', u'Chambéry', 'Geneva', 'Bern', 'Lyon']
+
+
+def _tag(ns, name):
+    return '{%s}%s' % (ns, name)
+
+
+def _local(tag):
+    return tag.split('}')[-1]
+
+
+def _sub(parent, ns, name, text=None, **attrs):
+    elem = ElementTree.SubElement(parent, _tag(ns, name), **attrs)
+    if text is not None:
+        elem.text = text
+    return elem
+
+
+def _extended_key(uri):
+    """ Key of an extended property, from its ExtendedFieldURI """
+    name = (uri.get('PropertyName') or uri.get('PropertyTag') or
+            uri.get('PropertyId'))
+    return 'ExtendedProperty:%s' % name
+
+
+def _field_key(field):
+    """ Key of a field of an item: its tag, or the URI of an extended
+    property as an item can have several of them
+    """
+    name = _local(field.tag)
+    if name == 'ExtendedProperty':
+        return _extended_key(field.find(_tag(TNS, 'ExtendedFieldURI')))
+    return name
+
+
+def _path_key(path):
+    """ Return (key, index, subfield) for a FieldURI, IndexedFieldURI or
+    ExtendedFieldURI element
+
+    The index is the key of an entry of an indexed field, the subfield is
+    set for the physical addresses, which are updated by parts.
+    """
+    name = _local(path.tag)
+    if name == 'ExtendedFieldURI':
+        return _extended_key(path), None, None
+    uri = path.get('FieldURI')
+    if uri.startswith('contacts:PhysicalAddress:'):
+        return 'PhysicalAddresses', path.get('FieldIndex'), uri.split(':')[2]
+    if name == 'IndexedFieldURI':
+        return (INDEXED_FIELDS.get(uri, uri.split(':')[-1]),
+                path.get('FieldIndex'), None)
+    return uri.split(':')[1], None, None
+
+
+def _new_id(prefix, counter):
+    raw = ('%s-%010d' % (prefix, next(counter))).encode('ascii')
+    return base64.b64encode(raw).decode('ascii')
+
+
+class EWSError(Exception):
+    """ Error returned in the response message of an operation """
+
+    def __init__(self, code, message=None):
+        super(EWSError, self).__init__(code)
+        self.code = code
+        self.message = message or code
+
+
+class MockFolder(object):
+
+    def __init__(self, mailbox, distinguished_id, name, element, folder_class):
+        self.mailbox = mailbox
+        self.distinguished_id = distinguished_id
+        self.id = _new_id('folder', mailbox.server.ids)
+        self.changekey = 'CK-1'
+        self.name = name
+        self.element = element
+        self.folder_class = folder_class
+
+    def to_xml(self, parent):
+        elem = _sub(parent, TNS, self.element)
+        _sub(elem, TNS, 'FolderId', Id=self.id, ChangeKey=self.changekey)
+        if self.folder_class:
+            _sub(elem, TNS, 'FolderClass', self.folder_class)
+        _sub(elem, TNS, 'DisplayName', self.name)
+        count = len(self.mailbox.items_of(self))
+        _sub(elem, TNS, 'TotalCount', str(count))
+        _sub(elem, TNS, 'ChildFolderCount', '0')
+        _sub(elem, TNS, 'UnreadCount', '0')
+        return elem
+
+
+class MockItem(object):
+    """ An item stored as the XML elements of its fields, by tag """
+
+    def __init__(self, mailbox, folder, element, fields):
+        self.mailbox = mailbox
+        self.folder = folder
+        self.element = element
+        self.id = _new_id('item', mailbox.server.ids)
+        self.version = 1
+        self.fields = OrderedDict()
+        for field in fields:
+            if _local(field.tag) in ('ItemId', 'ParentFolderId'):
+                continue
+            self.fields[_field_key(field)] = field
+
+    @property
+    def changekey(self):
+        return 'CK-%d' % self.version
+
+    def value(self, name):
+        field = self.fields.get(name)
+        if field is None:
+            return None
+        if len(field):
+            return [child.text for child in field]
+        return field.text
+
+    def to_xml(self, parent, field_names=None):
+        """ Add the item to ``parent``
+
+        :param field_names: tags of the fields to include, all when None
+        """
+        elem = _sub(parent, TNS, self.element)
+        _sub(elem, TNS, 'ItemId', Id=self.id, ChangeKey=self.changekey)
+        _sub(elem, TNS, 'ParentFolderId', Id=self.folder.id,
+             ChangeKey=self.folder.changekey)
+        for name, field in self.fields.items():
+            if field_names is None or name in field_names:
+                elem.append(copy.deepcopy(field))
+        return elem
+
+    def set_field(self, field):
+        key = _field_key(field)
+        current = self.fields.get(key)
+        if current is None or key not in INDEXED_CONTAINERS:
+            self.fields[key] = field
+            return
+        # entries are updated one by one, by key, and the physical
+        # addresses part by part
+        entries = OrderedDict((entry.get('Key'), entry) for entry in current)
+        for entry in field:
+            existing = entries.get(entry.get('Key'))
+            if existing is not None and len(entry):
+                parts = OrderedDict((part.tag, part) for part in existing)
+                parts.update((part.tag, part) for part in entry)
+                existing[:] = list(parts.values())
+            else:
+                entries[entry.get('Key')] = entry
+        current[:] = list(entries.values())
+
+    def delete_field(self, key, index=None, subfield=None):
+        if index is None:
+            self.fields.pop(key, None)
+            return
+        current = self.fields.get(key)
+        if current is None:
+            return
+        for entry in list(current):
+            if entry.get('Key') != index:
+                continue
+            if subfield:
+                for part in entry.findall(_tag(TNS, subfield)):
+                    entry.remove(part)
+            if not subfield or not len(entry):
+                current.remove(entry)
+        if not len(current):
+            del self.fields[key]
+
+
+class MockMailbox(object):
+
+    def __init__(self, server, email):
+        self.server = server
+        self.email = email
+        self.folders = OrderedDict()
+        for distinguished_id, name, element, folder_class in FOLDERS:
+            self.folders[distinguished_id] = MockFolder(
+                self, distinguished_id, name, element, folder_class)
+        self.items = OrderedDict()
+
+    def get_folder(self, folder_id=None, distinguished_id=None):
+        if distinguished_id:
+            folder = self.folders.get(distinguished_id)
+        else:
+            folder = next((f for f in self.folders.values()
+                           if f.id == folder_id), None)
+        if folder is None:
+            raise EWSError('ErrorFolderNotFound')
+        return folder
+
+    def get_item(self, item_id):
+        try:
+            return self.items[item_id]
+        except KeyError:
+            raise EWSError('ErrorItemNotFound',
+                           'The specified object was not found in the '
+                           'store.')
+
+    def items_of(self, folder):
+        return [item for item in self.items.values()
+                if item.folder is folder]
+
+    # public API, used by the tests to change the mailbox "on Exchange"
+
+    def create_item(self, folder, element, fields):
+        if not isinstance(folder, MockFolder):
+            folder = self.folders[folder]
+        item = MockItem(self, folder, element, fields)
+        self.items[item.id] = item
+        self.server.notify(self, 'CreatedEvent', item)
+        return item
+
+    def update_item(self, item, fields=(), deleted_fields=()):
+        """ Update an item
+
+        :param fields: XML elements of the new values of fields
+        :param deleted_fields: keys of the fields to delete, or tuples
+                               (key, index, subfield), see ``_path_key``
+        """
+        for field in fields:
+            item.set_field(field)
+        for deleted in deleted_fields:
+            if not isinstance(deleted, tuple):
+                deleted = (deleted,)
+            item.delete_field(*deleted)
+        item.version += 1
+        self.server.notify(self, 'ModifiedEvent', item)
+        return item
+
+    def move_item(self, item, folder):
+        if not isinstance(folder, MockFolder):
+            folder = self.folders[folder]
+        old_id, old_folder = item.id, item.folder
+        # an item moved gets a new ID
+        del self.items[item.id]
+        item.id = _new_id('item', self.server.ids)
+        item.folder = folder
+        self.items[item.id] = item
+        self.server.notify(self, 'MovedEvent', item, old_item_id=old_id,
+                           old_folder=old_folder)
+        return item
+
+    def delete_item(self, item):
+        del self.items[item.id]
+        self.server.notify(self, 'DeletedEvent', item)
+
+
+class Subscription(object):
+
+    def __init__(self, mailbox, folder_ids, timeout, watermark):
+        self.id = _new_id('subscription', mailbox.server.ids)
+        self.mailbox = mailbox
+        self.folder_ids = folder_ids
+        self.timeout = timeout
+        self.watermark = watermark
+        self.last_poll = time.time()
+
+    @property
+    def expired(self):
+        return time.time() > self.last_poll + self.timeout * 60
+
+
+class MockEWSServer(object):
+    """ Mock EWS server running in a thread
+
+    :param latency: seconds added to each response
+    :param jitter: random seconds added to the latency, up to this value
+    :param throttle_every: every n-th request fails with ErrorServerBusy
+    :param throttle_rate: probability of a request to fail with
+                          ErrorServerBusy
+    :param backoff_ms: BackOffMilliseconds sent with ErrorServerBusy
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 throttle_every=0, throttle_rate=0.0, backoff_ms=1000,
+                 seed=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_every = throttle_every
+        self.throttle_rate = throttle_rate
+        self.backoff_ms = backoff_ms
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.mailboxes = OrderedDict()
+        self.subscriptions = {}
+        self.events = []
+        self.watermarks = itertools.count(1)
+        self.requests = Counter()
+        self.throttled = Counter()
+        self.lock = threading.RLock()
+        self._httpd = None
+        self._thread = None
+
+    # server
+
+    @property
+    def url(self):
+        return 'http://%s:%d/EWS/Exchange.asmx' % (self.host, self.port)
+
+    def start(self):
+        server = self
+
+        class Handler(MockEWSHandler):
+            mock = server
+
+        self._httpd = ThreadedHTTPServer((self.host, self.port), Handler)
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_counters(self):
+        self.requests.clear()
+        self.throttled.clear()
+
+    @property
+    def request_count(self):
+        return sum(self.requests.values())
+
+    # mailboxes
+
+    def add_mailbox(self, email):
+        with self.lock:
+            if email not in self.mailboxes:
+                self.mailboxes[email] = MockMailbox(self, email)
+            return self.mailboxes[email]
+
+    def mailbox(self, email):
+        try:
+            return self.mailboxes[email]
+        except KeyError:
+            raise EWSError('ErrorNonExistentMailbox',
+                           'The SMTP address has no mailbox associated '
+                           'with it.')
+
+    def populate(self, emails, contacts=0, events=0, attendees=0,
+                 recurring=0.0, attachments=0.0, private=0.0,
+                 start=None, days=365):
+        """ Generate synthetic items in mailboxes
+
+        :param emails: addresses of the mailboxes, created if needed
+        :param contacts: number of contacts by mailbox
+        :param events: number of calendar events by mailbox, spread over
+                       ``days`` days from ``start`` (default: 30 days ago)
+        :param attendees: number of required attendees by event
+        :param recurring: ratio of weekly recurring events
+        :param attachments: ratio of events with a file attachment
+        :param private: ratio of private events
+        """
+        if start is None:
+            start = datetime.utcnow().replace(
+                hour=8, minute=0, second=0, microsecond=0,
+            ) - timedelta(days=30)
+        with self.lock:
+            for email in emails:
+                mailbox = self.add_mailbox(email)
+                for idx in range(contacts):
+                    mailbox.create_item('contacts', 'Contact',
+                                        self._contact_fields(idx))
+                for idx in range(events):
+                    event_start = start + timedelta(
+                        days=self.random.randint(0, days - 1),
+                        hours=self.random.randint(0, 9),
+                    )
+                    mailbox.create_item(
+                        'calendar', 'CalendarItem',
+                        self._event_fields(
+                            mailbox, idx, event_start,
+                            attendees=attendees,
+                            recurring=self.random.random() < recurring,
+                            attachment=self.random.random() < attachments,
+                            private=self.random.random() < private,
+                        ))
+
+    def _contact_fields(self, idx):
+        root = ElementTree.Element('fields')
+        first = self.random.choice(FIRST_NAMES)
+        last = self.random.choice(LAST_NAMES)
+        _sub(root, TNS, 'ItemClass', 'IPM.Contact')
+        _sub(root, TNS, 'Subject', '%s %s' % (first, last))
+        _sub(root, TNS, 'Categories')
+        _sub(root, TNS, 'FileAs', '%s %s' % (last, first))
+        _sub(root, TNS, 'DisplayName', '%s %s' % (first, last))
+        _sub(root, TNS, 'GivenName', first)
+        _sub(root, TNS, 'CompanyName', 'Company %d' % (idx % 20))
+        emails = _sub(root, TNS, 'EmailAddresses')
+        _sub(emails, TNS, 'Entry', '%s.%s.%d@example.com' % (
+            first.lower(), last.lower(), idx), Key='EmailAddress1')
+        addresses = _sub(root, TNS, 'PhysicalAddresses')
+        address = _sub(addresses, TNS, 'Entry', Key='Business')
+        _sub(address, TNS, 'Street', '%d Main Street' % idx)
+        _sub(address, TNS, 'City', self.random.choice(CITIES))
+        _sub(address, TNS, 'CountryOrRegion', 'Switzerland')
+        _sub(address, TNS, 'PostalCode', str(1000 + idx % 8999))
+        phones = _sub(root, TNS, 'PhoneNumbers')
+        _sub(phones, TNS, 'Entry', '+41 21 %07d' % idx, Key='BusinessPhone')
+        _sub(root, TNS, 'JobTitle', 'Engineer')
+        _sub(root, TNS, 'Surname', last)
+        return list(root)
+
+    def _event_fields(self, mailbox, idx, start, attendees=0,
+                      recurring=False, attachment=False, private=False):
+        root = ElementTree.Element('fields')
+        end = start + timedelta(hours=1)
+        _sub(root, TNS, 'ItemClass', 'IPM.Appointment')
+        _sub(root, TNS, 'Subject', 'Meeting %d' % idx)
+        _sub(root, TNS, 'Sensitivity', 'Private' if private else 'Normal')
+        _sub(root, TNS, 'Body', 'Agenda of the meeting %d' % idx,
+             BodyType='Text')
+        if attachment:
+            attachments = _sub(root, TNS, 'Attachments')
+            file_attachment = _sub(attachments, TNS, 'FileAttachment')
+            _sub(file_attachment, TNS, 'AttachmentId',
+                 Id=_new_id('attachment', self.ids))
+            _sub(file_attachment, TNS, 'Name', 'agenda-%d.pdf' % idx)
+            _sub(file_attachment, TNS, 'ContentType', 'application/pdf')
+            _sub(file_attachment, TNS, 'Size', '20480')
+        categories = _sub(root, TNS, 'Categories')
+        _sub(categories, TNS, 'String', 'Odoo')
+        _sub(root, TNS, 'HasAttachments', 'true' if attachment else 'false')
+        _sub(root, TNS, 'Start', start.strftime(DATETIME_FORMAT))
+        _sub(root, TNS, 'End', end.strftime(DATETIME_FORMAT))
+        _sub(root, TNS, 'IsAllDayEvent', 'false')
+        _sub(root, TNS, 'LegacyFreeBusyStatus', 'Busy')
+        _sub(root, TNS, 'Location', 'Room %d' % (idx % 10))
+        _sub(root, TNS, 'CalendarItemType',
+             'RecurringMaster' if recurring else 'Single')
+        organizer = _sub(root, TNS, 'Organizer')
+        _sub(_sub(organizer, TNS, 'Mailbox'), TNS, 'EmailAddress',
+             mailbox.email)
+        if attendees:
+            required = _sub(root, TNS, 'RequiredAttendees')
+            for number in range(attendees):
+                attendee = _sub(required, TNS, 'Attendee')
+                attendee_mailbox = _sub(attendee, TNS, 'Mailbox')
+                _sub(attendee_mailbox, TNS, 'Name',
+                     'Attendee %d' % number)
+                _sub(attendee_mailbox, TNS, 'EmailAddress',
+                     'attendee%d@example.com' % number)
+                _sub(attendee, TNS, 'ResponseType', 'Unknown')
+        if recurring:
+            recurrence = _sub(root, TNS, 'Recurrence')
+            weekly = _sub(recurrence, TNS, 'WeeklyRecurrence')
+            _sub(weekly, TNS, 'Interval', '1')
+            _sub(weekly, TNS, 'DaysOfWeek', start.strftime('%A'))
+            numbered = _sub(recurrence, TNS, 'NumberedRecurrence')
+            _sub(numbered, TNS, 'StartDate', start.strftime('%Y-%m-%d'))
+            _sub(numbered, TNS, 'NumberOfOccurrences', '10')
+            last_start = start + timedelta(weeks=9)
+            last = _sub(root, TNS, 'LastOccurrence')
+            _sub(last, TNS, 'ItemId', Id=_new_id('occurrence', self.ids),
+                 ChangeKey='1')
+            _sub(last, TNS, 'Start', last_start.strftime(DATETIME_FORMAT))
+            _sub(last, TNS, 'End', (last_start + timedelta(hours=1)).strftime(
+                DATETIME_FORMAT))
+            _sub(last, TNS, 'OriginalStart',
+                 last_start.strftime(DATETIME_FORMAT))
+        return list(root)
+
+    # notifications
+
+    def notify(self, mailbox, event_type, item, old_item_id=None,
+               old_folder=None):
+        with self.lock:
+            self.events.append({
+                'watermark': next(self.watermarks),
+                'mailbox': mailbox,
+                'event_type': event_type,
+                'item_id': item.id,
+                'changekey': item.changekey,
+                'folder_id': item.folder.id,
+                'old_item_id': old_item_id,
+                'old_folder_id': old_folder.id if old_folder else None,
+                'timestamp': datetime.utcnow().strftime(DATETIME_FORMAT),
+            })
+
+    def expire_subscriptions(self):
+        """ Simulate the expiration of all the subscriptions """
+        self.subscriptions.clear()
+
+    @property
+    def last_watermark(self):
+        return self.events[-1]['watermark'] if self.events else 0
+
+    # requests
+
+    def should_throttle(self):
+        if self.throttle_every and (
+                self.request_count % self.throttle_every == 0):
+            return True
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            return True
+        return False
+
+    def wait(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _encode_watermark(value):
+    return base64.b64encode(('watermark-%d' % value).encode('ascii')).decode(
+        'ascii')
+
+
+def _decode_watermark(watermark):
+    try:
+        return int(base64.b64decode(watermark).decode('ascii').split('-')[1])
+    except (TypeError, ValueError, IndexError):
+        raise EWSError('ErrorInvalidWatermark')
+
+
+class MockEWSHandler(BaseHTTPRequestHandler):
+    """ Handle the SOAP requests for a MockEWSServer (``mock``) """
+
+    mock = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # types.xsd, used by exchangelib to guess the version
+        self._send(404, b'')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if not self.headers.get('Authorization'):
+            # lets exchangelib guess the authentication type
+            self._send(401, b'', {'WWW-Authenticate': 'Basic realm="EWS"'})
+            return
+        envelope = ElementTree.fromstring(body)
+        operation = envelope.find(_tag(SOAPNS, 'Body'))[0]
+        name = _local(operation.tag)
+        mock = self.mock
+        with mock.lock:
+            mock.requests[name] += 1
+            throttle = mock.should_throttle()
+            if throttle:
+                mock.throttled[name] += 1
+        mock.wait()
+        if throttle:
+            self._send(500, self._fault('ErrorServerBusy',
+                                        'The server cannot service this '
+                                        'request right now.',
+                                        back_off=mock.backoff_ms))
+            return
+        handler = getattr(self, 'op_%s' % name, None)
+        if handler is None:
+            self._send(500, self._fault('ErrorInvalidRequest',
+                                        'Operation %s not supported by the '
+                                        'mock' % name))
+            return
+        try:
+            with mock.lock:
+                mailbox = self._get_mailbox(envelope)
+                messages = handler(operation, mailbox)
+        except EWSError as err:
+            messages = [self._error_message(name, err)]
+        except Exception as err:
+            _logger.exception('Mock EWS: error in %s', name)
+            self._send(500, self._fault('ErrorInternalServerError',
+                                        str(err)))
+            return
+        self._send(200, self._response(name, messages))
+
+    # protocol helpers
+
+    def _send(self, status, payload, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _get_mailbox(self, envelope):
+        address = envelope.find('%s/%s/%s/%s' % (
+            _tag(SOAPNS, 'Header'), _tag(TNS, 'ExchangeImpersonation'),
+            _tag(TNS, 'ConnectingSID'), _tag(TNS, 'PrimarySmtpAddress')))
+        if address is None:
+            return None
+        return self.mock.mailbox(address.text)
+
+    def _envelope(self):
+        envelope = ElementTree.Element(_tag(SOAPNS, 'Envelope'))
+        header = _sub(envelope, SOAPNS, 'Header')
+        _sub(header, TNS, 'ServerVersionInfo', **SERVER_VERSION)
+        return envelope, _sub(envelope, SOAPNS, 'Body')
+
+    def _response(self, name, messages):
+        envelope, body = self._envelope()
+        response = _sub(body, MNS, '%sResponse' % name)
+        container = _sub(response, MNS, 'ResponseMessages')
+        for message in messages:
+            container.append(message)
+        return XML_DECLARATION + ElementTree.tostring(envelope,
+                                                      encoding='utf-8')
+
+    def _fault(self, code, message, back_off=None):
+        envelope, body = self._envelope()
+        fault = _sub(body, SOAPNS, 'Fault')
+        fault_code = ElementTree.SubElement(fault, 'faultcode')
+        fault_code.text = 'a:%s' % code
+        fault_string = ElementTree.SubElement(fault, 'faultstring')
+        fault_string.text = message
+        detail = ElementTree.SubElement(fault, 'detail')
+        _sub(detail, ENS, 'ResponseCode', code)
+        _sub(detail, ENS, 'Message', message)
+        if back_off is not None:
+            message_xml = _sub(detail, TNS, 'MessageXml')
+            _sub(message_xml, TNS, 'Value', str(back_off),
+                 Name='BackOffMilliseconds')
+        return XML_DECLARATION + ElementTree.tostring(envelope,
+                                                      encoding='utf-8')
+
+    @staticmethod
+    def _message(name, response_class='Success', code='NoError'):
+        message = ElementTree.Element(_tag(MNS, '%sResponseMessage' % name),
+                                      ResponseClass=response_class)
+        if code != 'NoError':
+            _sub(message, MNS, 'MessageText', code)
+        _sub(message, MNS, 'ResponseCode', code)
+        return message
+
+    def _error_message(self, name, err):
+        message = ElementTree.Element(_tag(MNS, '%sResponseMessage' % name),
+                                      ResponseClass='Error')
+        _sub(message, MNS, 'MessageText', err.message)
+        _sub(message, MNS, 'ResponseCode', err.code)
+        _sub(message, MNS, 'DescriptiveLinkKey', '0')
+        return message
+
+    @staticmethod
+    def _requested_folders(mailbox, container):
+        folders = []
+        for elem in container:
+            if _local(elem.tag) == 'DistinguishedFolderId':
+                folders.append(mailbox.get_folder(
+                    distinguished_id=elem.get('Id')))
+            else:
+                folders.append(mailbox.get_folder(folder_id=elem.get('Id')))
+        return folders
+
+    @staticmethod
+    def _field_names(shape):
+        """ Tags of the fields requested by an ItemShape, None for all """
+        if shape is None:
+            return None
+        base_shape = shape.find(_tag(TNS, 'BaseShape'))
+        names = set()
+        if base_shape is not None and base_shape.text != 'IdOnly':
+            return None
+        properties = shape.find(_tag(TNS, 'AdditionalProperties'))
+        for prop in properties if properties is not None else []:
+            names.add(_path_key(prop)[0])
+        return names
+
+    # restrictions
+
+    def _match(self, item, restriction):
+        name = _local(restriction.tag)
+        if name in ('Restriction',):
+            return all(self._match(item, child) for child in restriction)
+        if name == 'And':
+            return all(self._match(item, child) for child in restriction)
+        if name == 'Or':
+            return any(self._match(item, child) for child in restriction)
+        if name == 'Not':
+            return not self._match(item, restriction[0])
+        field = restriction.find(_tag(TNS, 'FieldURI'))
+        if field is None:
+            field = restriction.find(_tag(TNS, 'IndexedFieldURI'))
+        field_name = field.get('FieldURI').split(':')[1]
+        value = item.value(field_name)
+        if name == 'Exists':
+            return value is not None
+        constant = restriction.find('.//%s' % _tag(TNS, 'Constant'))
+        expected = constant.get('Value') if constant is not None else None
+        if name == 'Contains':
+            values = value if isinstance(value, list) else [value or '']
+            return any(expected.lower() in (v or '').lower()
+                       for v in values)
+        if isinstance(value, list):
+            # multi-valued fields (categories) match on any value
+            return any(self._compare(name, v, expected) for v in value)
+        return self._compare(name, value, expected)
+
+    @staticmethod
+    def _compare(name, value, expected):
+        if value is None:
+            return name == 'IsNotEqualTo'
+        return {
+            'IsEqualTo': lambda: value == expected,
+            'IsNotEqualTo': lambda: value != expected,
+            'IsLessThan': lambda: value < expected,
+            'IsLessThanOrEqualTo': lambda: value <= expected,
+            'IsGreaterThan': lambda: value > expected,
+            'IsGreaterThanOrEqualTo': lambda: value >= expected,
+        }[name]()
+
+    # operations
+
+    def op_ResolveNames(self, operation, mailbox):
+        message = self._message('ResolveNames')
+        _sub(message, MNS, 'ResolutionSet', TotalItemsInView='0',
+             IncludesLastItemInRange='true')
+        return [message]
+
+    def op_GetFolder(self, operation, mailbox):
+        messages = []
+        ids = operation.find(_tag(MNS, 'FolderIds'))
+        for folder_id in ids:
+            try:
+                folder, = self._requested_folders(mailbox, [folder_id])
+            except EWSError as err:
+                messages.append(self._error_message('GetFolder', err))
+                continue
+            message = self._message('GetFolder')
+            folder.to_xml(_sub(message, MNS, 'Folders'))
+            messages.append(message)
+        return messages
+
+    def op_FindFolder(self, operation, mailbox):
+        message = self._message('FindFolder')
+        folders = [folder for folder in mailbox.folders.values()
+                   if folder.distinguished_id not in ('root',
+                                                      'msgfolderroot')]
+        root = _sub(message, MNS, 'RootFolder',
+                    TotalItemsInView=str(len(folders)),
+                    IncludesLastItemInRange='true',
+                    IndexedPagingOffset=str(len(folders)))
+        container = _sub(root, TNS, 'Folders')
+        for folder in folders:
+            folder.to_xml(container)
+        return [message]
+
+    def op_FindItem(self, operation, mailbox):
+        folders = self._requested_folders(
+            mailbox, operation.find(_tag(MNS, 'ParentFolderIds')))
+        items = [item for folder in folders
+                 for item in mailbox.items_of(folder)]
+        restriction = operation.find(_tag(MNS, 'Restriction'))
+        if restriction is not None:
+            items = [item for item in items
+                     if self._match(item, restriction)]
+        sort_order = operation.find(_tag(MNS, 'SortOrder'))
+        if sort_order is not None:
+            for order in reversed(list(sort_order)):
+                name = order.find(_tag(TNS, 'FieldURI')).get(
+                    'FieldURI').split(':')[1]
+                items.sort(key=lambda i: i.value(name) or '',
+                           reverse=order.get('Order') == 'Descending')
+        view = operation.find(_tag(MNS, 'IndexedPageItemView'))
+        offset = int(view.get('Offset', 0)) if view is not None else 0
+        max_entries = (int(view.get('MaxEntriesReturned', 1000))
+                       if view is not None else 1000)
+        page = items[offset:offset + max_entries]
+        next_offset = offset + len(page)
+        message = self._message('FindItem')
+        root = _sub(message, MNS, 'RootFolder',
+                    TotalItemsInView=str(len(items)),
+                    IncludesLastItemInRange=(
+                        'true' if next_offset >= len(items) else 'false'),
+                    IndexedPagingOffset=str(next_offset))
+        container = _sub(root, TNS, 'Items')
+        field_names = self._field_names(
+            operation.find(_tag(MNS, 'ItemShape')))
+        for item in page:
+            item.to_xml(container, field_names=field_names or set())
+        return [message]
+
+    def op_GetItem(self, operation, mailbox):
+        field_names = self._field_names(
+            operation.find(_tag(MNS, 'ItemShape')))
+        messages = []
+        for item_id in operation.find(_tag(MNS, 'ItemIds')):
+            try:
+                item = mailbox.get_item(item_id.get('Id'))
+            except EWSError as err:
+                messages.append(self._error_message('GetItem', err))
+                continue
+            message = self._message('GetItem')
+            item.to_xml(_sub(message, MNS, 'Items'), field_names=field_names)
+            messages.append(message)
+        return messages
+
+    def op_CreateItem(self, operation, mailbox):
+        saved = operation.find(_tag(MNS, 'SavedItemFolderId'))
+        if saved is not None:
+            folder, = self._requested_folders(mailbox, saved)
+        else:
+            folder = None
+        messages = []
+        for elem in operation.find(_tag(MNS, 'Items')):
+            element = _local(elem.tag)
+            target = folder or mailbox.folders[
+                'contacts' if element == 'Contact' else 'calendar']
+            item = mailbox.create_item(target, element, list(elem))
+            message = self._message('CreateItem')
+            items = _sub(message, MNS, 'Items')
+            created = _sub(items, TNS, element)
+            _sub(created, TNS, 'ItemId', Id=item.id,
+                 ChangeKey=item.changekey)
+            messages.append(message)
+        return messages
+
+    def op_UpdateItem(self, operation, mailbox):
+        messages = []
+        for change in operation.find(_tag(MNS, 'ItemChanges')):
+            item_id = change.find(_tag(TNS, 'ItemId'))
+            try:
+                item = mailbox.get_item(item_id.get('Id'))
+            except EWSError as err:
+                messages.append(self._error_message('UpdateItem', err))
+                continue
+            fields = []
+            deleted = []
+            for update in change.find(_tag(TNS, 'Updates')):
+                if _local(update.tag) == 'DeleteItemField':
+                    deleted.append(_path_key(update[0]))
+                    continue
+                # SetItemField / AppendToItemField: the path then the item
+                # with the new value of the field
+                fields.extend(list(update[1]))
+            mailbox.update_item(item, fields=fields, deleted_fields=deleted)
+            message = self._message('UpdateItem')
+            items = _sub(message, MNS, 'Items')
+            updated = _sub(items, TNS, item.element)
+            _sub(updated, TNS, 'ItemId', Id=item.id,
+                 ChangeKey=item.changekey)
+            conflicts = _sub(message, MNS, 'ConflictResults')
+            _sub(conflicts, TNS, 'Count', '0')
+            messages.append(message)
+        return messages
+
+    def op_DeleteItem(self, operation, mailbox):
+        messages = []
+        move_to_trash = operation.get('DeleteType') == 'MoveToDeletedItems'
+        for item_id in operation.find(_tag(MNS, 'ItemIds')):
+            try:
+                item = mailbox.get_item(item_id.get('Id'))
+            except EWSError as err:
+                messages.append(self._error_message('DeleteItem', err))
+                continue
+            if move_to_trash:
+                mailbox.move_item(item, 'deleteditems')
+            else:
+                mailbox.delete_item(item)
+            messages.append(self._message('DeleteItem'))
+        return messages
+
+    def op_MoveItem(self, operation, mailbox):
+        folder, = self._requested_folders(
+            mailbox, operation.find(_tag(MNS, 'ToFolderId')))
+        messages = []
+        for item_id in operation.find(_tag(MNS, 'ItemIds')):
+            try:
+                item = mailbox.get_item(item_id.get('Id'))
+            except EWSError as err:
+                messages.append(self._error_message('MoveItem', err))
+                continue
+            mailbox.move_item(item, folder)
+            message = self._message('MoveItem')
+            items = _sub(message, MNS, 'Items')
+            moved = _sub(items, TNS, item.element)
+            _sub(moved, TNS, 'ItemId', Id=item.id, ChangeKey=item.changekey)
+            messages.append(message)
+        return messages
+
+    def op_Subscribe(self, operation, mailbox):
+        request = operation.find(_tag(MNS, 'PullSubscriptionRequest'))
+        if request is None:
+            raise EWSError('ErrorInvalidSubscriptionRequest',
+                           'Only the pull subscriptions are supported by '
+                           'the mock')
+        folders = self._requested_folders(
+            mailbox, request.find(_tag(TNS, 'FolderIds')))
+        watermark = request.find(_tag(TNS, 'Watermark'))
+        if watermark is not None:
+            position = _decode_watermark(watermark.text)
+        else:
+            position = self.mock.last_watermark
+        timeout = int(request.find(_tag(TNS, 'Timeout')).text)
+        subscription = Subscription(mailbox,
+                                    set(folder.id for folder in folders),
+                                    timeout, position)
+        self.mock.subscriptions[subscription.id] = subscription
+        message = self._message('Subscribe')
+        _sub(message, MNS, 'SubscriptionId', subscription.id)
+        _sub(message, MNS, 'Watermark', _encode_watermark(position))
+        return [message]
+
+    def op_GetEvents(self, operation, mailbox):
+        subscription_id = operation.find(_tag(MNS, 'SubscriptionId')).text
+        subscription = self.mock.subscriptions.get(subscription_id)
+        if subscription is None or subscription.expired:
+            self.mock.subscriptions.pop(subscription_id, None)
+            raise EWSError('ErrorSubscriptionNotFound')
+        position = _decode_watermark(
+            operation.find(_tag(MNS, 'Watermark')).text)
+        subscription.last_poll = time.time()
+        events = [
+            event for event in self.mock.events
+            if event['watermark'] > position and
+            event['mailbox'] is subscription.mailbox and
+            (event['folder_id'] in subscription.folder_ids or
+             event['old_folder_id'] in subscription.folder_ids)
+        ]
+        page = events[:EVENTS_PAGE_SIZE]
+        message = self._message('GetEvents')
+        notification = _sub(message, MNS, 'Notification')
+        _sub(notification, TNS, 'SubscriptionId', subscription_id)
+        _sub(notification, TNS, 'PreviousWatermark',
+             _encode_watermark(position))
+        _sub(notification, TNS, 'MoreEvents',
+             'true' if len(events) > len(page) else 'false')
+        if not page:
+            status = _sub(notification, TNS, 'StatusEvent')
+            _sub(status, TNS, 'Watermark',
+                 _encode_watermark(max(position, self.mock.last_watermark)))
+        for event in page:
+            elem = _sub(notification, TNS, event['event_type'])
+            _sub(elem, TNS, 'Watermark',
+                 _encode_watermark(event['watermark']))
+            _sub(elem, TNS, 'TimeStamp', event['timestamp'])
+            _sub(elem, TNS, 'ItemId', Id=event['item_id'],
+                 ChangeKey=event['changekey'])
+            _sub(elem, TNS, 'ParentFolderId', Id=event['folder_id'],
+                 ChangeKey='CK-1')
+            if event['old_item_id']:
+                _sub(elem, TNS, 'OldItemId', Id=event['old_item_id'])
+                _sub(elem, TNS, 'OldParentFolderId',
+                     Id=event['old_folder_id'], ChangeKey='CK-1')
+        return [message]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--users', type=int, default=10,
+                        help="number of mailboxes, user<n>@example.com")
+    parser.add_argument('--contacts', type=int, default=100)
+    parser.add_argument('--events', type=int, default=500)
+    parser.add_argument('--attendees', type=int, default=2)
+    parser.add_argument('--recurring', type=float, default=0.1)
+    parser.add_argument('--attachments', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    server = MockEWSServer(host=args.host, port=args.port,
+                           latency=args.latency,
+                           throttle_rate=args.throttle_rate)
+    server.populate(['user%d@example.com' % idx
+                     for idx in range(args.users)],
+                    contacts=args.contacts, events=args.events,
+                    attendees=args.attendees, recurring=args.recurring,
+                    attachments=args.attachments)
+    server.start()
+    print('Mock EWS server listening on %s' % server.url)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from .common import ExchangeBackendTransactionCase
+
+
+class TestCalendarEventExport(ExchangeBackendTransactionCase):
+
+    def setUp(self):
+        super(TestCalendarEventExport, self).setUp()
+        self.user.default_backend = self.exchange_backend
+
+    def _create_event(self, name):
+        return self.env['calendar.event'].create(
+            {'name': name,
+             'start': '2017-06-01 10:00:00',
+             'stop': '2017-06-01 11:00:00',
+             'user_id': self.user.id,
+             }
+        )
+
+    def test_create_event_delays_batch_export(self):
+        events = self.env['calendar.event']
+        for idx in range(3):
+            events |= self._create_event('Meeting %d' % idx)
+
+        bindings = events.mapped('exchange_bind_ids')
+        self.assertEqual(len(bindings), 3)
+        self.assertFalse(any(bindings.mapped('external_id')))
+
+        jobs = self.env['queue.job'].search(
+            [('method_name', '=', 'export_calendar_batch')])
+        # one single job exports the events of the user
+        self.assertEqual(len(jobs), 1)
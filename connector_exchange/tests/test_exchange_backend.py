@@ -8,6 +8,7 @@ from contextlib2 import ExitStack
 
 from odoo.addons.queue_job import job
 
+from ..unit.subscription import ItemEvent
 from .common import (
     my_vcr,
     ExchangeBackendTransactionCase,
@@ -206,3 +207,158 @@ class TestExchangeBackendSyncContactRecordDelete(
                 self.env.user
             )
             self.assertTrue(len(cassette.requests))
+
+
+class TestExchangeBackendSyncCron(ExchangeBackendTransactionCase):
+
+    def test_cron_delays_one_job_by_user(self):
+        users = self.env['res.users'].search([('exchange_synch', '=', True)])
+        self.env['exchange.backend'].cron_import_contact_partner()
+        jobs = self.env['queue.job'].search(
+            [('method_name', '=', 'sync_user')])
+        self.assertEqual(len(jobs), len(users) * len(
+            self.env['exchange.backend'].search([])))
+        self.assertEqual(set(jobs.mapped('channel')),
+                         set(['root.exchange.enumeration']))
+
+    def test_cron_skipped_while_running(self):
+        backend_model = self.env['exchange.backend']
+        backend_model.cron_import_contact_partner()
+        jobs = self.env['queue.job'].search(
+            [('method_name', '=', 'sync_user')])
+        # the jobs of the first run are not done yet
+        backend_model.cron_import_contact_partner()
+        self.assertEqual(
+            self.env['queue.job'].search_count(
+                [('method_name', '=', 'sync_user')]),
+            len(jobs))
+        # the lease is written in SQL
+        self.env.invalidate_all()
+        lease = self.exchange_backend.sync_lease_ids.filtered(
+            lambda l: l.sync_kind == 'import_contact')
+        self.assertEqual(lease.skipped_runs, 1)
+        users = self.env['res.users'].search([('exchange_synch', '=', True)])
+        self.assertEqual(lease.pending_jobs, len(users))
+
+    def test_lease_kept_while_jobs_queued(self):
+        backend_model = self.env['exchange.backend']
+        backend_model.cron_import_contact_partner()
+        jobs = self.env['queue.job'].search(
+            [('method_name', '=', 'sync_user')])
+        # the jobs wait in the queue longer than the timeout
+        self.env.cr.execute("""
+            UPDATE exchange_sync_lease
+            SET expire_date = now() AT TIME ZONE 'UTC' - interval '1 hour'
+        """)
+        backend_model.cron_import_contact_partner()
+        self.assertEqual(
+            self.env['queue.job'].search_count(
+                [('method_name', '=', 'sync_user')]),
+            len(jobs))
+        # once they are done, an expired lease is taken again
+        jobs.write({'state': 'done'})
+        backend_model.cron_import_contact_partner()
+        self.assertEqual(
+            self.env['queue.job'].search_count(
+                [('method_name', '=', 'sync_user'),
+                 ('state', '=', 'pending')]),
+            len(jobs))
+
+    def test_failed_job_releases_lease(self):
+        backend = self.exchange_backend
+        backend.cron_import_contact_partner()
+        lease = backend.sync_lease_ids.filtered(
+            lambda l: l.sync_kind == 'import_contact')
+        token = lease.token
+        pending = lease.pending_jobs
+        with mock.patch.object(type(backend),
+                               '_import_user_contact_partners',
+                               side_effect=ValueError('Broken')):
+            with self.assertRaises(ValueError):
+                backend.sync_user('import_contact', self.user,
+                                  lease_token=token)
+        self.env.invalidate_all()
+        self.assertEqual(lease.pending_jobs, pending - 1)
+
+    def test_import_job_not_delayed_twice(self):
+        bindings = self.env['exchange.res.partner']
+        pending_keys = bindings._get_pending_import_keys(
+            self.exchange_backend, self.user)
+        self.assertFalse(pending_keys)
+        self.assertTrue(bindings._delay_import_record(
+            self.exchange_backend, self.user, 'AAMkAD1'))
+        # next run, the job is still pending
+        pending_keys = bindings._get_pending_import_keys(
+            self.exchange_backend, self.user)
+        self.assertEqual(len(pending_keys), 1)
+        self.assertFalse(bindings._delay_import_record(
+            self.exchange_backend, self.user, 'AAMkAD1',
+            pending_keys=pending_keys))
+        self.assertTrue(bindings._delay_import_record(
+            self.exchange_backend, self.user, 'AAMkAD2',
+            pending_keys=pending_keys))
+        self.assertEqual(
+            self.env['queue.job'].search_count(
+                [('method_name', '=', 'import_record')]),
+            2)
+
+
+class TestExchangeBackendEnumeration(ExchangeBackendTransactionCase):
+
+    def setUp(self):
+        super(TestExchangeBackendEnumeration, self).setUp()
+        self.exchange_backend.enumeration_page_size = 100
+        self.folder = self.user.find_folder(self.exchange_backend.id,
+                                            create=True,
+                                            default_name="Contacts",
+                                            folder_type='contact')
+        # slicing a list works like slicing an exchangelib QuerySet
+        self.items = range(250)
+
+    def test_enumeration_by_pages(self):
+        pages = list(self.exchange_backend._iter_item_pages(self.folder,
+                                                            self.items))
+        self.assertEqual([len(page) for page in pages], [100, 100, 50])
+        self.assertEqual(self.folder.enumeration_offset, 0)
+
+    def test_enumeration_resumed(self):
+        # no time left after the first page
+        self.exchange_backend.enumeration_time_budget = -1
+        pages = list(self.exchange_backend._iter_item_pages(self.folder,
+                                                            self.items))
+        self.assertEqual(pages, [range(100)])
+        self.assertEqual(self.folder.enumeration_offset, 100)
+        self.exchange_backend.enumeration_time_budget = 600
+        pages = list(self.exchange_backend._iter_item_pages(self.folder,
+                                                            self.items))
+        self.assertEqual(pages, [range(100, 200), range(200, 250)])
+        self.assertEqual(self.folder.enumeration_offset, 0)
+
+
+class TestExchangeBackendListener(ExchangeBackendTransactionCase):
+
+    def test_process_events(self):
+        binding = self.created_user.exchange_bind_ids.create(
+            {'backend_id': self.exchange_backend.id,
+             'user_id': self.user.id,
+             'openerp_id': self.created_user.id,
+             'external_id': 'AAMkDELETED'}
+        )
+        ews_folder = mock.Mock(folder_id='CONTACTS')
+        events = [
+            ItemEvent('DeletedEvent', 'AAMkDELETED', 'CK1', 'CONTACTS',
+                      None, None),
+            ItemEvent('CreatedEvent', 'AAMkCREATED', 'CK2', 'CONTACTS',
+                      None, None),
+            ItemEvent('ModifiedEvent', 'AAMkCREATED', 'CK3', 'CONTACTS',
+                      None, None),
+        ]
+        self.exchange_backend._process_events(self.user, 'contact', None,
+                                              ews_folder, events)
+        self.assertFalse(binding.exists())
+        # the partner is kept
+        self.assertTrue(self.created_user.exists())
+        jobs = self.env['queue.job'].search(
+            [('method_name', '=', 'import_record')])
+        self.assertEqual(len(jobs), 1)
+        self.assertTrue(jobs.identity_key.endswith('-AAMkCREATED'))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from exchangelib import Contact
+
+from odoo.tests.common import TransactionCase
+
+from ..models.res_partner.mapping import PARTNER_MAPPING
+
+
+class TestMapper(TransactionCase):
+
+    def test_import_contact(self):
+        contact = Contact(given_name='Ringo', surname='Starr',
+                          display_name='Ringo Starr', job_title='Drummer',
+                          company_name='Apple Corps')
+        vals = PARTNER_MAPPING.map_import(contact, self.env)
+        self.assertEqual(vals['firstname'], 'Ringo')
+        self.assertEqual(vals['lastname'], 'Starr')
+        self.assertEqual(vals['name'], 'Ringo Starr')
+        self.assertEqual(vals['function'], 'Drummer')
+        self.assertEqual(vals['company_name'], 'Apple Corps')
+        # the export only fields are not read
+        self.assertNotIn('parent_id', vals)
+
+    def test_export_partner(self):
+        company = self.env['res.partner'].create({'name': 'Apple Corps',
+                                                  'is_company': True})
+        partner = self.env['res.partner'].create({'name': 'Ringo Starr',
+                                                  'function': 'Drummer',
+                                                  'parent_id': company.id})
+        contact = PARTNER_MAPPING.map_export(partner, Contact())
+        self.assertEqual(contact.display_name, 'Ringo Starr')
+        self.assertEqual(contact.job_title, 'Drummer')
+        self.assertEqual(contact.company_name, 'Apple Corps')
+        # empty values are not exported
+        self.assertIsNone(contact.business_homepage)
+
+    def test_export_partner_fields(self):
+        partner = self.env['res.partner'].create({'name': 'Ringo Starr',
+                                                  'function': 'Drummer'})
+        contact = PARTNER_MAPPING.map_export(partner, Contact(),
+                                             fields=['function'])
+        self.assertEqual(contact.job_title, 'Drummer')
+        self.assertIsNone(contact.display_name)
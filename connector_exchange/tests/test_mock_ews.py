@@ -0,0 +1,531 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import json
+from datetime import datetime, timedelta
+from xml.etree import ElementTree
+
+import mock
+from exchangelib.errors import ErrorServerBusy
+
+from odoo import fields
+from odoo.addons.queue_job.exception import RetryableJobError
+
+from ..models.calendar_event.adapter import EventBackendAdapter
+from ..unit.breaker import CircuitBreaker, CircuitOpenError, get_breaker
+from ..unit.importer import ExchangeImporter
+from ..unit.instrumentation import collect_ews_stats
+from ..unit.throttle import ThrottledError, TokenBucket, get_bucket
+from .common import ExchangeMockServerCase
+from .mock_ews import TNS
+
+
+class TestMockEWS(ExchangeMockServerCase):
+
+    def _import_jobs(self):
+        return self.env['queue.job'].search(
+            [('method_name', '=', 'import_record')])
+
+    def test_import_contacts(self):
+        self.server.populate([self.user.email], contacts=25)
+        self.exchange_backend._import_user_contact_partners(self.user)
+        self.assertEqual(len(self._import_jobs()), 25)
+        # only the ids are read, by pages
+        self.assertTrue(self.server.requests['FindItem'])
+        self.assertFalse(self.server.requests['GetItem'])
+
+    def test_import_contacts_required_categories(self):
+        self.server.populate([self.user.email], contacts=5)
+        item = list(self.mailbox.items.values())[0]
+        categories = ElementTree.Element('{%s}Categories' % TNS)
+        ElementTree.SubElement(categories, '{%s}String' % TNS).text = 'Odoo'
+        self.mailbox.update_item(item, fields=[categories])
+        self.exchange_backend.sync_categories = 'Odoo, Customers'
+        self.exchange_backend._import_user_contact_partners(self.user)
+        # filtered by Exchange
+        jobs = self._import_jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertIn(item.id, jobs.identity_key)
+        self.assertFalse(self.server.requests['GetItem'])
+
+    def test_bulk_import_contacts(self):
+        self.server.populate([self.user.email], contacts=25)
+        self.exchange_backend.bulk_import = True
+        self.exchange_backend._import_user_contact_partners(self.user)
+        # one job by page
+        self.assertFalse(self._import_jobs())
+        self.assertEqual(len(self.env['queue.job'].search(
+            [('method_name', '=', 'import_batch')])), 1)
+        # the items of a pending batch are not delayed again
+        self.exchange_backend._import_user_contact_partners(self.user)
+        self.assertFalse(self._import_jobs())
+        self.assertEqual(len(self.env['queue.job'].search(
+            [('method_name', '=', 'import_batch')])), 1)
+        result = self.env['exchange.res.partner'].import_batch(
+            self.exchange_backend, self.user, list(self.mailbox.items))
+        self.assertTrue(result.startswith('25 records imported'))
+        bindings = self.env['exchange.res.partner'].search(
+            [('user_id', '=', self.user.id)])
+        self.assertEqual(len(bindings), 25)
+        # no tracking messages
+        self.assertFalse(self.env['mail.message'].search_count(
+            [('model', '=', 'res.partner'),
+             ('res_id', 'in', bindings.mapped('openerp_id').ids)]))
+
+    def test_bulk_import_failed_item(self):
+        self.server.populate([self.user.email], contacts=3)
+        item_ids = list(self.mailbox.items)
+        with self.exchange_backend.get_environment(
+                'exchange.res.partner') as connector_env:
+            importer_class = type(
+                connector_env.get_connector_unit(ExchangeImporter))
+        run = importer_class.run
+
+        def run_or_fail(importer, item_id, user):
+            if item_id == item_ids[1]:
+                raise ValueError('Broken item')
+            return run(importer, item_id, user)
+
+        with mock.patch.object(importer_class, 'run', autospec=True,
+                               side_effect=run_or_fail):
+            result = self.env['exchange.res.partner'].import_batch(
+                self.exchange_backend, self.user, item_ids)
+        self.assertTrue(result.startswith('2 records imported'))
+        self.assertEqual(
+            set(self.env['exchange.res.partner'].search(
+                [('user_id', '=', self.user.id)]).mapped('external_id')),
+            set([item_ids[0], item_ids[2]]))
+        # the failed item is imported again alone
+        jobs = self._import_jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertIn(item_ids[1], jobs.identity_key)
+
+    def test_bulk_import_throttled(self):
+        self.server.populate([self.user.email], contacts=3)
+        item_ids = list(self.mailbox.items)
+        with self.exchange_backend.get_environment(
+                'exchange.res.partner') as connector_env:
+            importer_class = type(
+                connector_env.get_connector_unit(ExchangeImporter))
+        # not an error of the item: the whole batch is postponed
+        with mock.patch.object(importer_class, 'run', autospec=True,
+                               side_effect=ThrottledError(30)):
+            with self.assertRaises(RetryableJobError):
+                self.env['exchange.res.partner'].import_batch(
+                    self.exchange_backend, self.user, item_ids)
+        self.assertFalse(self._import_jobs())
+
+    def test_import_calendar(self):
+        today = datetime.utcnow()
+        self.server.populate([self.user.email], events=10, attendees=3,
+                             recurring=0.5, attachments=0.5, start=today,
+                             days=10)
+        self.server.populate([self.user.email], events=5, private=1.0,
+                             start=today, days=10)
+        self.exchange_backend._import_user_calendar(self.user)
+        # private events are not imported
+        self.assertEqual(len(self._import_jobs()), 10)
+
+    def test_import_calendar_recurring_started_before(self):
+        today = datetime.utcnow()
+        self.exchange_backend.calendar_past_days = 60
+        # 10 weekly occurrences, the last ones are in the period
+        self.server.populate([self.user.email], events=1, recurring=1.0,
+                             start=today - timedelta(days=80), days=1)
+        ongoing = list(self.mailbox.items.values())[0]
+        # recurrence ended before the period
+        self.server.populate([self.user.email], events=1, recurring=1.0,
+                             start=today - timedelta(days=200), days=1)
+        self.server.populate([self.user.email], events=1,
+                             start=today - timedelta(days=80), days=1)
+        self.exchange_backend._import_user_calendar(self.user)
+        jobs = self._import_jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertIn(ongoing.id, jobs.identity_key)
+
+    def test_import_calendar_deleted_events(self):
+        today = datetime.utcnow()
+        self.server.populate([self.user.email], events=3, start=today,
+                             days=10)
+        model = self.env['exchange.calendar.event']
+        items = list(self.mailbox.items.values())
+        for item in items:
+            model.import_record(self.exchange_backend, self.user, item.id)
+        deleted, missed = items[0], items[1]
+        deleted_event = model.search(
+            [('external_id', '=', deleted.id)]).openerp_id
+        self.mailbox.delete_item(deleted)
+        # an item missed by the enumeration still exists in Exchange
+        with self.exchange_backend.get_environment(
+                'exchange.calendar.event') as connector_env:
+            adapter = connector_env.get_connector_unit(EventBackendAdapter)
+        account = adapter.get_account(self.user)
+        self.assertEqual(
+            self.exchange_backend._get_deleted_items(
+                account, account.calendar, [deleted.id, missed.id]),
+            [deleted.id])
+        self.exchange_backend._import_user_calendar(self.user)
+        self.assertFalse(deleted_event.exists())
+        self.assertEqual(
+            set(model.search([('user_id', '=', self.user.id)]).mapped(
+                'external_id')),
+            set([missed.id, items[2].id]))
+
+    def test_initial_sync_calendar_windows(self):
+        today = datetime.utcnow()
+        self.server.populate([self.user.email], events=10, start=today,
+                             days=60)
+        self.server.populate([self.user.email], events=5, private=1.0,
+                             start=today, days=60)
+        backend = self.exchange_backend
+        backend.initial_sync_window_months = 1
+        # the windows are read by pages
+        backend.enumeration_page_size = 3
+        backend._import_user_calendar(self.user)
+        windows = backend.sync_window_ids
+        self.assertTrue(len(windows) > 1)
+        self.assertEqual(len(self.env['queue.job'].search(
+            [('method_name', '=', 'import_calendar_window')])), len(windows))
+        self.assertFalse(self._import_jobs())
+        for window in windows:
+            backend.import_calendar_window(window)
+        # each event is imported once
+        import_jobs = self._import_jobs()
+        self.assertEqual(len(import_jobs), 10)
+        self.assertEqual(windows.mapped('import_job_ids'), import_jobs)
+        self.assertEqual(sum(windows.mapped('item_count')), 10)
+        # the windows are done once their imports are done
+        self.assertEqual(
+            set(windows.filtered('import_job_ids').mapped('state')),
+            set(['enumerated']))
+        self.server.reset_counters()
+        backend._import_user_calendar(self.user)
+        self.assertFalse(self.server.requests['FindItem'])
+        failed_job = import_jobs[0]
+        failed_job.write({'state': 'failed'})
+        failed_window = windows.filtered(
+            lambda w: failed_job in w.import_job_ids)
+        self.assertEqual(failed_window.state, 'failed')
+        (import_jobs - failed_job).write(
+            {'state': 'done', 'date_done': fields.Datetime.now()})
+        self.assertEqual(set(windows.mapped('state')),
+                         set(['done', 'failed']))
+        # a failed window does not block the usual enumeration, which
+        # imports its events again
+        self.server.reset_counters()
+        backend._import_user_calendar(self.user)
+        self.assertTrue(self.server.requests['FindItem'])
+
+    def test_listen(self):
+        # the first poll subscribes
+        self.assertEqual(
+            self.exchange_backend._pull_events(self.user, 'contact'), 0)
+        self.assertEqual(self.server.requests['Subscribe'], 1)
+        self.server.populate([self.user.email], contacts=2)
+        self.assertEqual(
+            self.exchange_backend._pull_events(self.user, 'contact'), 2)
+        self.assertEqual(len(self._import_jobs()), 2)
+        # the subscription is kept between polls
+        self.assertEqual(self.server.requests['Subscribe'], 1)
+
+    def test_listen_next_poll(self):
+        backend = self.exchange_backend
+        listen_jobs = [('method_name', '=', 'listen')]
+        backend.listen(self.user)
+        # the job does not wait, it delays the next poll
+        next_poll = self.env['queue.job'].search(listen_jobs)
+        self.assertEqual(len(next_poll), 1)
+        self.assertTrue(next_poll.eta)
+        # once the duration is elapsed, the listener stops
+        backend.listen(self.user, deadline=0)
+        self.assertEqual(self.env['queue.job'].search(listen_jobs),
+                         next_poll)
+
+    def test_listen_subscription_expired(self):
+        self.exchange_backend._pull_events(self.user, 'contact')
+        self.server.expire_subscriptions()
+        self.server.populate([self.user.email], contacts=2)
+        # the subscription is lost, then resumed from the watermark
+        self.exchange_backend._pull_events(self.user, 'contact')
+        self.assertEqual(
+            self.exchange_backend._pull_events(self.user, 'contact'), 2)
+        self.assertEqual(len(self._import_jobs()), 2)
+
+    def test_throttling(self):
+        self.server.throttle_every = 1
+        self.server.backoff_ms = 10
+        try:
+            with self.assertRaises(ErrorServerBusy):
+                self.exchange_backend._import_user_contact_partners(
+                    self.user)
+        finally:
+            self.server.throttle_every = 0
+            self.server.backoff_ms = 1000
+
+    def test_throttling_job_postponed(self):
+        self.server.throttle_every = 1
+        self.server.backoff_ms = 10
+        try:
+            with self.assertRaises(RetryableJobError) as context:
+                self.exchange_backend.sync_user('import_contact', self.user)
+        finally:
+            self.server.throttle_every = 0
+            self.server.backoff_ms = 1000
+        self.assertTrue(context.exception.ignore_retry)
+        self.assertGreaterEqual(context.exception.seconds, 1)
+
+    def test_throttling_max_wait(self):
+        bucket = TokenBucket(self.env.cr.dbname, self.exchange_backend.id,
+                             rate=0.01, burst=1, max_wait=1)
+        bucket.acquire()
+        # the next token comes in 100 seconds
+        with self.assertRaises(ThrottledError):
+            bucket.acquire()
+
+    def test_throttling_bucket_by_backend(self):
+        backend = self.exchange_backend
+        other = backend.copy({'name': 'Other Exchange'})
+        other.throttle_rate = backend.throttle_rate or 10
+        dbname = self.env.cr.dbname
+        for record in (backend, other):
+            with record.get_environment(
+                    'exchange.calendar.event') as connector_env:
+                adapter = connector_env.get_connector_unit(
+                    EventBackendAdapter)
+            adapter.get_account(self.user)
+        # the same mailbox has a bucket by backend
+        self.assertEqual(
+            get_bucket(dbname, other.id, self.user.email).backend_id,
+            other.id)
+        bucket = get_bucket(dbname, backend.id, self.user.email)
+        self.assertTrue(bucket is None or bucket.backend_id == backend.id)
+
+    def test_unavailable_breaker_by_backend(self):
+        backend = self.exchange_backend
+        other = backend.copy({'name': 'Other Exchange'})
+        other.breaker_threshold = 1
+        backend.breaker_threshold = 0
+        dbname = self.env.cr.dbname
+        for record in (backend, other):
+            with record.get_environment(
+                    'exchange.calendar.event') as connector_env:
+                adapter = connector_env.get_connector_unit(
+                    EventBackendAdapter)
+            adapter.get_account(self.user)
+        # the breaker of a backend does not guard the other one
+        self.assertEqual(
+            get_breaker(dbname, other.id, self.user.email).backend_id,
+            other.id)
+        self.assertIsNone(get_breaker(dbname, backend.id, self.user.email))
+
+    def test_unavailable_job_postponed(self):
+        self.exchange_backend.breaker_threshold = 2
+        breaker = CircuitBreaker(self.env.cr.dbname, self.exchange_backend.id,
+                                 threshold=2, open_duration=300)
+        breaker.failure()
+        breaker.failure()
+        self.assertTrue(self.exchange_backend.unavailable_until)
+        with self.assertRaises(RetryableJobError):
+            self.exchange_backend.sync_user('import_contact', self.user)
+        # nothing is sent while the circuit is open
+        self.assertEqual(self.server.request_count, 0)
+
+    def test_unavailable_probe(self):
+        breaker = CircuitBreaker(self.env.cr.dbname, self.exchange_backend.id,
+                                 threshold=1, open_duration=300)
+        breaker.failure()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+        # end of the pause
+        with breaker._cursor() as cr:
+            cr.execute("UPDATE exchange_circuit_breaker "
+                       "SET open_until = now() WHERE backend_id = %s",
+                       (self.exchange_backend.id,))
+        # a single request probes the server
+        breaker.before_request()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+        breaker.success()
+        breaker.before_request()
+
+    def test_import_unchanged_contact(self):
+        self.server.populate([self.user.email], contacts=1)
+        item = list(self.mailbox.items.values())[0]
+        model = self.env['exchange.res.partner']
+        model.import_record(self.exchange_backend, self.user, item.id)
+        binding = model.search([('external_id', '=', item.id)])
+        self.assertTrue(binding.content_hash)
+        self.assertEqual(
+            model.import_record(self.exchange_backend, self.user, item.id),
+            'Already up-to-date.')
+        # only the change key changes: the values are not written
+        self.mailbox.update_item(item)
+        write = type(model).write
+        with mock.patch.object(type(model), 'write', autospec=True,
+                               side_effect=write) as mock_write:
+            self.assertEqual(
+                model.import_record(self.exchange_backend, self.user,
+                                    item.id),
+                'Already up-to-date.')
+        self.assertEqual(mock_write.call_count, 1)
+        self.assertEqual(mock_write.call_args[0][1],
+                         {'change_key': item.changekey})
+        self.assertEqual(binding.change_key, item.changekey)
+
+    def test_import_deleted_occurrence(self):
+        today = datetime.utcnow().replace(microsecond=0)
+        self.server.populate([self.user.email], events=1, recurring=1.0,
+                             start=today, days=1)
+        item = list(self.mailbox.items.values())[0]
+        model = self.env['exchange.calendar.event']
+        model.import_record(self.exchange_backend, self.user, item.id)
+        binding = model.search([('external_id', '=', item.id)])
+        content_hash = binding.content_hash
+        # only an occurrence is deleted, the mapped values are the same
+        deleted = ElementTree.Element('{%s}DeletedOccurrences' % TNS)
+        occurrence = ElementTree.SubElement(
+            deleted, '{%s}DeletedOccurrence' % TNS)
+        ElementTree.SubElement(occurrence, '{%s}Start' % TNS).text = (
+            item.value('Start'))
+        self.mailbox.update_item(item, fields=[deleted])
+        with self.exchange_backend.get_environment(
+                'exchange.calendar.event') as connector_env:
+            importer_class = type(
+                connector_env.get_connector_unit(ExchangeImporter))
+        with mock.patch.object(
+                importer_class, 'manage_modified_deleted_occurrences',
+                autospec=True) as mock_occurrences:
+            self.assertNotEqual(
+                model.import_record(self.exchange_backend, self.user,
+                                    item.id),
+                'Already up-to-date.')
+        self.assertEqual(mock_occurrences.call_count, 1)
+        self.assertNotEqual(binding.content_hash, content_hash)
+
+    def test_echo_suppressed(self):
+        self.server.populate([self.user.email], contacts=1)
+        item = list(self.mailbox.items.values())[0]
+        model = self.env['exchange.res.partner']
+        model.import_record(self.exchange_backend, self.user, item.id)
+        binding = model.search([('external_id', '=', item.id)])
+        # the imported values are not exported back
+        self.server.reset_counters()
+        self.assertEqual(binding.export_record(), 'Nothing to export.')
+        self.assertEqual(self.server.request_count, 0)
+        # our own export is not imported back
+        binding.with_context(connector_no_export=True).function = 'Drummer'
+        binding.export_record()
+        self.assertEqual(binding.change_key, item.changekey)
+        self.exchange_backend._import_user_contact_partners(self.user)
+        self.assertFalse(self._import_jobs())
+        self.assertEqual(
+            model.import_record(self.exchange_backend, self.user, item.id),
+            'Already up-to-date.')
+
+    def test_create_binding_once(self):
+        model = self.env['exchange.res.partner'].with_context(
+            connector_no_export=True)
+        vals = {'backend_id': self.exchange_backend.id,
+                'user_id': self.user.id,
+                'external_id': 'item-ringo',
+                'change_key': 'CK-1',
+                'name': 'Ringo Starr'}
+        binding, created = model._create_binding(dict(vals))
+        self.assertTrue(created)
+        self.assertEqual(binding.name, 'Ringo Starr')
+        self.assertEqual(binding.change_key, 'CK-1')
+        # a second import of the item gets the same binding, the partner
+        # it has created is rolled back
+        other, created = model._create_binding(dict(vals, name='Ringo'))
+        self.assertFalse(created)
+        self.assertEqual(other, binding)
+        self.assertEqual(
+            self.env['res.partner'].search_count([('name', '=', 'Ringo')]),
+            0)
+
+    def test_merge_changes(self):
+        self.server.populate([self.user.email], contacts=1)
+        item = list(self.mailbox.items.values())[0]
+        model = self.env['exchange.res.partner']
+        model.import_record(self.exchange_backend, self.user, item.id)
+        binding = model.search([('external_id', '=', item.id)])
+        # modified on both sides since the import
+        job_title = ElementTree.Element('{%s}JobTitle' % TNS)
+        job_title.text = 'Drummer'
+        self.mailbox.update_item(item, fields=[job_title])
+        binding.with_context(connector_no_export=True).website = (
+            'http://example.com')
+        self.server.reset_counters()
+        binding.export_record()
+        # merged in one round trip, without import
+        self.assertEqual(self.server.requests['UpdateItem'], 1)
+        self.assertFalse(self._import_jobs())
+        self.assertEqual(binding.function, 'Drummer')
+        self.assertEqual(item.value('BusinessHomePage'),
+                         'http://example.com')
+        self.assertEqual(binding.change_key, item.changekey)
+        self.assertEqual(binding.export_record(), 'Nothing to export.')
+
+    def test_merge_changes_event_imported(self):
+        today = datetime.utcnow()
+        self.server.populate([self.user.email], events=1, start=today,
+                             days=10)
+        item = list(self.mailbox.items.values())[0]
+        model = self.env['exchange.calendar.event']
+        model.import_record(self.exchange_backend, self.user, item.id)
+        binding = model.search([('external_id', '=', item.id)])
+        # modified on both sides since the import
+        location = ElementTree.Element('{%s}Location' % TNS)
+        location.text = 'Abbey Road'
+        self.mailbox.update_item(item, fields=[location])
+        binding.with_context(connector_no_export=True).name = 'Rehearsal'
+        self.server.reset_counters()
+        binding.export_record()
+        # events are not merged, the item is imported again
+        self.assertFalse(self.server.requests['UpdateItem'])
+        self.assertEqual(len(self._import_jobs()), 1)
+
+    def test_sync_run_purge(self):
+        backend = self.exchange_backend
+        backend._delay_user_sync('import_contact')
+        old_run = backend.sync_run_ids
+        self.env.cr.execute(
+            "UPDATE exchange_sync_run "
+            "SET create_date = now() - interval '10 days' WHERE id = %s",
+            (old_run.id,))
+        backend._delay_user_sync('export_contact')
+        runs = backend.sync_run_ids
+        self.assertEqual(len(runs), 2)
+        backend.sync_run_retention_days = 7
+        self.env['exchange.backend'].cron_purge_sync_runs()
+        self.assertFalse(old_run.exists())
+        self.assertEqual(len((runs - old_run).exists()), 1)
+
+    def test_sync_run_throttling_code_in_item(self):
+        self.server.populate([self.user.email], contacts=1)
+        item = list(self.mailbox.items.values())[0]
+        job_title = ElementTree.Element('{%s}JobTitle' % TNS)
+        job_title.text = 'ErrorServerBusy'
+        self.mailbox.update_item(item, fields=[job_title])
+        with collect_ews_stats() as stats:
+            self.env['exchange.res.partner'].import_record(
+                self.exchange_backend, self.user, item.id)
+        # the words of an item are not throttling responses
+        self.assertTrue(self.server.requests['GetItem'])
+        self.assertEqual(stats.get_values()['ews_throttled_count'], 0)
+
+    def test_sync_run_requests(self):
+        self.server.populate([self.user.email], contacts=5)
+        self.exchange_backend._delay_user_sync('import_contact')
+        sync_run = self.exchange_backend.sync_run_ids
+        self.assertEqual(len(sync_run), 1)
+        self.exchange_backend.sync_user('import_contact', self.user,
+                                        sync_run=sync_run)
+        self.assertEqual(sync_run.line_ids.user_id, self.user)
+        self.assertEqual(sync_run.done_count, 1)
+        self.assertEqual(sync_run.ews_request_count,
+                         self.server.request_count)
+        operations = json.loads(sync_run.line_ids.ews_operations)
+        self.assertEqual(operations['FindItem']['count'],
+                         self.server.requests['FindItem'])
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from datetime import datetime, timedelta
+
+import mock
+
+from odoo import fields
+
+from .common import ExchangeBackendTransactionCase
+
+
+class TestUserContacts(ExchangeBackendTransactionCase):
+
+    def setUp(self):
+        super(TestUserContacts, self).setUp()
+        self.other_user = self.env['res.users'].create(
+            {'name': 'Paul', 'login': 'paul'})
+
+    def test_contacts_by_user(self):
+        Partner = self.env['res.partner']
+        company = Partner.create({'name': 'Apple Corps',
+                                  'is_company': True,
+                                  'user_id': self.user.id})
+        followed = Partner.create({'name': 'Ringo'})
+        followed.message_subscribe(
+            partner_ids=self.other_user.partner_id.ids)
+        lead_partner = Partner.create({'name': 'George'})
+        self.env['crm.lead'].create({'name': 'Lead',
+                                     'user_id': self.other_user.id,
+                                     'partner_id': lead_partner.id})
+
+        users = self.user | self.other_user
+        contacts = users._get_contacts_by_user()
+
+        self.assertIn(self.created_user.id, contacts[self.user.id])
+        self.assertNotIn(company.id, contacts[self.user.id])
+        self.assertEqual(contacts[self.other_user.id],
+                         {followed.id, lead_partner.id})
+        self.assertEqual(self.other_user.find_exchange_contacts(),
+                         followed | lead_partner)
+
+    def test_export_contacts_entry_point(self):
+        # modules adding contacts (e.g. connector_exchange_sale) inherit
+        # _get_contacts
+        extra = self.env['res.partner'].create({'name': 'Brian'})
+        get_contacts = type(self.user)._get_contacts
+
+        def _get_contacts(user):
+            return get_contacts(user) | extra
+
+        Partner = type(self.env['res.partner'])
+        with mock.patch.object(type(self.user), '_get_contacts',
+                               autospec=True, side_effect=_get_contacts):
+            with mock.patch.object(Partner, 'try_autobind',
+                                   autospec=True) as try_autobind:
+                self.exchange_backend._export_user_contact_partners(
+                    self.user)
+        exported = try_autobind.call_args[0][0]
+        self.assertIn(extra, exported)
+
+    def test_membership_follows_salesperson(self):
+        partner = self.env['res.partner'].create({'name': 'Yoko'})
+        user_id = self.other_user.id
+        self.assertNotIn(partner.id,
+                         self.other_user._get_contacts_by_user()[user_id])
+        partner.user_id = self.other_user
+        self.assertIn(partner.id,
+                      self.other_user._get_contacts_by_user()[user_id])
+        partner.is_company = True
+        self.assertNotIn(partner.id,
+                         self.other_user._get_contacts_by_user()[user_id])
+
+    def test_membership_follows_user_partner(self):
+        Partner = self.env['res.partner']
+        followed = Partner.create({'name': 'Ringo'})
+        partner = Partner.create({'name': 'John'})
+        followed.message_subscribe(partner_ids=partner.ids)
+        # a user created for a partner gets the contacts it follows
+        user = self.env['res.users'].create({'name': 'John',
+                                             'login': 'john',
+                                             'partner_id': partner.id})
+        self.assertIn(followed.id, user._get_contacts_by_user()[user.id])
+        user.partner_id = Partner.create({'name': 'Lennon'})
+        self.assertNotIn(followed.id, user._get_contacts_by_user()[user.id])
+
+    def test_membership_rows_unique(self):
+        partner = self.env['res.partner'].create(
+            {'name': 'Yoko', 'user_id': self.other_user.id})
+        membership = self.env['exchange.sync.membership']
+        # inserting existing rows again does not fail
+        membership._insert_contacts(partner_ids=partner.ids)
+        self.assertEqual(membership.search_count(
+            [('res_model', '=', 'res.partner'),
+             ('res_id', '=', partner.id)]), 1)
+
+    def test_membership_follows_event_organizer(self):
+        start = datetime.now()
+        event = self.env['calendar.event'].with_context(
+            connector_no_export=True,
+        ).create(
+            {'name': 'Meeting',
+             'start': fields.Datetime.to_string(start),
+             'stop': fields.Datetime.to_string(start + timedelta(hours=1)),
+             'user_id': self.other_user.id,
+             }
+        )
+        self.assertEqual(self.other_user.find_exchange_calendar_events(),
+                         event)
+        event.user_id = self.user
+        self.assertFalse(self.other_user.find_exchange_calendar_events())
+        self.assertIn(event, self.user.find_exchange_calendar_events())
+
+    def test_find_folder(self):
+        backend_id = self.exchange_backend.id
+        self.assertFalse(self.user.find_folder(backend_id, create=False,
+                                               folder_type='calendar'))
+        folder = self.user.find_folder(backend_id, create=True,
+                                       default_name='Calendar',
+                                       folder_type='calendar')
+        self.assertTrue(folder)
+        users = self.user | self.other_user
+        folders = users.find_folders(backend_id, 'calendar')
+        self.assertEqual(folders[self.user.id], folder)
+        self.assertFalse(folders[self.other_user.id])
+
+    def test_find_folder_cache(self):
+        backend_id = self.exchange_backend.id
+        folder = self.user.find_folder(backend_id, create=True,
+                                       default_name='Calendar',
+                                       folder_type='calendar')
+        self.assertEqual(
+            self.user.find_folders(backend_id, 'calendar')[self.user.id],
+            folder)
+        # the offsets written on every page keep the cache
+        folder.enumeration_offset = 100
+        with mock.patch.object(type(folder), 'search',
+                               autospec=True) as mock_search:
+            self.assertEqual(
+                self.user.find_folders(backend_id, 'calendar')[self.user.id],
+                folder)
+        self.assertFalse(mock_search.called)
+        folder.unlink()
+        self.assertFalse(
+            self.user.find_folders(backend_id, 'calendar')[self.user.id])
@@ -4,3 +4,6 @@ from . import backend_adapter
 from . import binder
 from . import importer
 from . import exporter
+from . import subscription
+from . import instrumentation
+from . import throttle
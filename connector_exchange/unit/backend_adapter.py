@@ -6,13 +6,23 @@
 import logging
 from odoo.addons.connector.unit.backend_adapter import BackendAdapter
 
+from .instrumentation import (InstrumentedHTTPAdapter, instrumented_session,
+                              watch_mailbox)
+from .breaker import CircuitBreaker, register_breaker
+from .throttle import TokenBucket, register_bucket
+from .subscription import Subscribe, GetEvents
+
 _logger = logging.getLogger(__name__)
 
 try:
     from exchangelib import (IMPERSONATION, Account, Credentials,
-                             ServiceAccount, Configuration, NTLM, EWSTimeZone)
-    from exchangelib.protocol import BaseProtocol, NoVerifyHTTPAdapter
-    BaseProtocol.HTTP_ADAPTER_CLS = NoVerifyHTTPAdapter
+                             ServiceAccount, Configuration, NTLM, EWSTimeZone,
+                             Version)
+    from exchangelib.version import EXCHANGE_2010
+    from exchangelib.protocol import BaseProtocol
+    BaseProtocol.HTTP_ADAPTER_CLS = InstrumentedHTTPAdapter
+    BaseProtocol.create_session = instrumented_session(
+        BaseProtocol.create_session)
 except (ImportError, IOError) as err:
     _logger.debug(err)
 
@@ -24,6 +34,34 @@ class ExchangeLocation(Credentials):
         self.pwd = pwd
 
 
+class BackendServiceAccount(ServiceAccount):
+    """ Service account of a backend
+
+    exchangelib shares a protocol and its sessions between the accounts
+    having equal credentials. The database and the backend are part of
+    these credentials, so the requests of a session are throttled by the
+    bucket and the breaker of their backend.
+    """
+
+    def __init__(self, username, password, dbname, backend_id):
+        super(BackendServiceAccount, self).__init__(username, password)
+        self.dbname = dbname
+        self.backend_id = backend_id
+
+    def _key(self):
+        return (self.username, self.password, self.dbname, self.backend_id)
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __eq__(self, other):
+        return (isinstance(other, BackendServiceAccount) and
+                self._key() == other._key())
+
+    def __ne__(self, other):
+        return not self == other
+
+
 class ExchangeAdapter(BackendAdapter):
     def __init__(self, connector_env):
         """
@@ -33,15 +71,42 @@ class ExchangeAdapter(BackendAdapter):
         super(BackendAdapter, self).__init__(connector_env)
         backend = self.backend_record
         # Embed a ExchangeService instance in the backend adapter
-        self.credentials = ServiceAccount(username=backend.username,
-                                          password=backend.password)
+        self.credentials = BackendServiceAccount(
+            username=backend.username,
+            password=backend.password,
+            dbname=self.env.cr.dbname,
+            backend_id=backend.id)
 
     def get_account(self, user):
-        tz = self.env.context.get('tz', self.backend_record.default_tz)
-        if self.backend_record.disable_autodiscover:
-            config = Configuration(server=self.backend_record.location,
-                                   auth_type=NTLM,
-                                   credentials=self.credentials)
+        backend = self.backend_record
+        tz = self.env.context.get('tz', backend.default_tz)
+        watch_mailbox(user.email)
+        bucket = None
+        if backend.throttle_rate > 0:
+            bucket = TokenBucket(self.env.cr.dbname, backend.id,
+                                 backend.throttle_rate, backend.throttle_burst,
+                                 backend.throttle_max_wait)
+        register_bucket(self.env.cr.dbname, backend.id, user.email, bucket)
+        breaker = None
+        if backend.breaker_threshold > 0:
+            breaker = CircuitBreaker(self.env.cr.dbname, backend.id,
+                                     backend.breaker_threshold,
+                                     backend.breaker_open_duration)
+        register_breaker(self.env.cr.dbname, backend.id, user.email,
+                         breaker)
+        if backend.disable_autodiscover:
+            location = backend.location
+            if location.startswith(('http://', 'https://')):
+                # full URL of the EWS endpoint (e.g. the mock server of the
+                # tests): the authentication type is guessed, but not the
+                # version, exchangelib would read types.xsd over https only
+                config = Configuration(service_endpoint=location,
+                                       credentials=self.credentials,
+                                       version=Version(build=EXCHANGE_2010))
+            else:
+                config = Configuration(server=location,
+                                       auth_type=NTLM,
+                                       credentials=self.credentials)
 
             return Account(primary_smtp_address=user.email,
                            config=config,
@@ -53,3 +118,18 @@ class ExchangeAdapter(BackendAdapter):
         return Account(primary_smtp_address=user.email,
                        credentials=self.credentials,
                        autodiscover=True, access_type=IMPERSONATION)
+
+    def subscribe(self, account, folder, timeout, watermark=None):
+        """ Create a pull subscription on an Exchange folder
+
+        :returns: tuple (subscription id, watermark)
+        """
+        return Subscribe(account=account).call(folder, timeout,
+                                               watermark=watermark)
+
+    def get_events(self, account, subscription_id, watermark):
+        """ Read the events of a pull subscription
+
+        :returns: tuple (list of ItemEvent, watermark, more events)
+        """
+        return GetEvents(account=account).call(subscription_id, watermark)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+""" Circuit breaker of the Exchange backends
+
+When an Exchange server is down, each request waits for the connection
+timeout and exchangelib retries it for a long time. The connection errors
+of a backend are counted in the ``exchange_circuit_breaker`` table, shared
+by all the workers. After a number of consecutive errors the circuit
+opens: the requests to the backend are refused without any network call
+and the jobs are postponed (see :func:`.throttle.retry_when_throttled`).
+
+Once the pause is over, the circuit is half-open: a single request, the
+probe, is sent while the others are still refused. The circuit closes if
+it succeeds and opens again if it fails.
+"""
+
+import logging
+import socket
+import threading
+from contextlib import closing, contextmanager
+
+from odoo import sql_db
+
+from .throttle import ThrottledError
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import requests
+except ImportError as err:
+    _logger.debug(err)
+    CONNECTION_ERRORS = (socket.error, )
+else:
+    CONNECTION_ERRORS = (requests.exceptions.ConnectionError,
+                         requests.exceptions.Timeout,
+                         socket.error,
+                         )
+
+# responses of the proxies in front of an unavailable server
+UNAVAILABLE_STATUS = (502, 504)
+
+# breakers by (database, backend id, mailbox), registered when the account
+# of a user is created
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(ThrottledError):
+    """ The backend is unavailable, the request is not sent """
+
+    def __init__(self, seconds):
+        super(CircuitOpenError, self).__init__(seconds)
+        self.args = ('Exchange unavailable, requests paused for %d seconds'
+                     % seconds,)
+
+
+class CircuitBreaker(object):
+    """ Circuit breaker of a backend, shared through PostgreSQL
+
+    :param threshold: number of consecutive connection errors opening the
+                      circuit
+    :param open_duration: seconds during which the requests are refused
+    """
+
+    def __init__(self, dbname, backend_id, threshold, open_duration):
+        self.dbname = dbname
+        self.backend_id = backend_id
+        self.threshold = threshold
+        self.open_duration = open_duration
+        # errors counted when the state was last read, so the successful
+        # requests of a healthy backend do not write anything
+        self.failures = 0
+
+    @contextmanager
+    def _cursor(self):
+        with closing(sql_db.db_connect(self.dbname).cursor()) as cr:
+            cr.autocommit(True)
+            yield cr
+
+    def before_request(self):
+        """ Check that a request can be sent
+
+        :raises: CircuitOpenError when the circuit is open, or half-open
+                 and the probe is sent by another request
+        """
+        with self._cursor() as cr:
+            # the main query sees the row as it was before the update of
+            # the probe
+            cr.execute("""
+                WITH probe AS (
+                    UPDATE exchange_circuit_breaker
+                    SET open_until = clock_timestamp() +
+                                     %(duration)s * interval '1 second'
+                    WHERE backend_id = %(backend_id)s
+                      AND failures >= %(threshold)s
+                      AND open_until <= clock_timestamp()
+                    RETURNING backend_id
+                )
+                SELECT failures,
+                       EXTRACT(EPOCH FROM open_until - clock_timestamp()),
+                       EXISTS (SELECT 1 FROM probe)
+                FROM exchange_circuit_breaker
+                WHERE backend_id = %(backend_id)s
+            """, {'backend_id': self.backend_id,
+                  'threshold': self.threshold,
+                  'duration': self.open_duration})
+            row = cr.fetchone()
+        if not row:
+            self.failures = 0
+            return
+        self.failures, seconds, probe = row
+        if self.failures < self.threshold:
+            return
+        if probe:
+            _logger.info('Exchange backend %s: probing the server',
+                         self.backend_id)
+            return
+        if not seconds or seconds <= 0:
+            # the probe has just been taken by another request
+            seconds = self.open_duration
+        raise CircuitOpenError(seconds)
+
+    def success(self):
+        """ A request got a response, the circuit closes """
+        if not self.failures:
+            return
+        with self._cursor() as cr:
+            cr.execute("""
+                UPDATE exchange_circuit_breaker
+                SET failures = 0, open_until = NULL
+                WHERE backend_id = %s
+            """, (self.backend_id,))
+        if self.failures >= self.threshold:
+            _logger.info('Exchange backend %s is available again',
+                         self.backend_id)
+        self.failures = 0
+
+    def failure(self):
+        """ A request failed to connect, the circuit opens after
+        ``threshold`` consecutive errors
+        """
+        with self._cursor() as cr:
+            cr.execute("""
+                INSERT INTO exchange_circuit_breaker AS b
+                    (backend_id, failures)
+                VALUES (%(backend_id)s, 1)
+                ON CONFLICT (backend_id) DO UPDATE SET
+                    failures = b.failures + 1
+                RETURNING failures
+            """, {'backend_id': self.backend_id})
+            self.failures = cr.fetchone()[0]
+            if self.failures >= self.threshold:
+                cr.execute("""
+                    UPDATE exchange_circuit_breaker
+                    SET open_until = clock_timestamp() +
+                                     %s * interval '1 second'
+                    WHERE backend_id = %s
+                """, (self.open_duration, self.backend_id))
+                _logger.warning(
+                    'Exchange backend %s unavailable after %d connection '
+                    'errors, requests paused for %d seconds',
+                    self.backend_id, self.failures, self.open_duration)
+
+    def reset(self):
+        """ Close the circuit """
+        with self._cursor() as cr:
+            cr.execute("""
+                DELETE FROM exchange_circuit_breaker WHERE backend_id = %s
+            """, (self.backend_id,))
+        self.failures = 0
+
+
+def register_breaker(dbname, backend_id, mailbox, breaker):
+    """ Guard the requests of a backend for a mailbox with a breaker,
+    None to stop
+    """
+    key = (dbname, backend_id, mailbox)
+    with _breakers_lock:
+        if breaker is None:
+            _breakers.pop(key, None)
+        else:
+            _breakers[key] = breaker
+
+
+def get_breaker(dbname, backend_id, mailbox):
+    return _breakers.get((dbname, backend_id, mailbox))
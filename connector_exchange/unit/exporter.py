@@ -12,6 +12,11 @@ Exporters for Exchange.
 They should call the ``bind`` method if the binder even if the records
 are already bound, to update the last sync date.
 
+A binding whose synchronized values did not change since its last import
+or export is not exported (see :mod:`.snapshot`). When the Exchange item
+has been modified too, both sides are merged from the snapshot of the
+last synchronization, see :meth:`ExchangeExporter._merge`.
+
 """
 
 import logging
@@ -22,6 +27,9 @@ from odoo import _, tools
 from odoo.addons.connector.exception import RetryableJobError
 from odoo.addons.connector.unit.synchronizer import Deleter, Exporter
 
+from .importer import ExchangeImporter
+from .snapshot import import_values, three_way_merge
+
 _logger = logging.getLogger(__name__)
 
 
@@ -50,6 +58,8 @@ class ExchangeExporter(Exporter):
         # will be released on commit (or rollback)
         self._lock()
 
+        if self._is_synced():
+            return _('Nothing to export.')
         result = self._run(*args, **kwargs)
 
         # Commit so we keep the external ID when there are several
@@ -92,6 +102,60 @@ class ExchangeExporter(Exporter):
                 '(%s with id %s). The job will be retried later.' %
                 (self.model._name, self.binding_id))
 
+    def _is_synced(self):
+        """ The binding has the values of its last import or export """
+        return bool(self.binding.external_id and self.binding.odoo_hash and
+                    self.binding.odoo_hash == self.binding._get_odoo_hash())
+
+    def _set_synced(self, exchange_record):
+        """ Keep the ID and the changekey of the saved Exchange item, and
+        the hash and the snapshot of the values exported
+        """
+        self.binding._set_synced(change_key=exchange_record.changekey,
+                                 external_id=exchange_record.item_id)
+
+    def _merge(self, exchange_record):
+        """ Merge the changes of an Exchange item modified since the last
+        synchronization with the changes of the binding
+
+        The changes of Exchange are written on the binding, a field changed
+        on both sides takes the value of Exchange.
+
+        Only the items whose imported values are all plain values can be
+        merged: the x2many commands which do not replace all the records
+        cannot be compared with the snapshot.
+
+        :returns: a :class:`.snapshot.Merge` with the fields to export, or
+                  None when the binding has no snapshot or when the item
+                  cannot be merged: the item must be imported instead
+        """
+        snapshot = self.binding._get_snapshot()
+        if snapshot is None:
+            return None
+        importer = self.unit_for(ExchangeImporter)
+        importer.openerp_user = self.binding.user_id
+        importer.external_id = exchange_record.item_id
+        importer.external_record = exchange_record
+        data = importer._map_data()
+        exchange_fields = self.binding._exchange_fields
+        imported = dict((name, value) for name, value in data.iteritems()
+                        if name in exchange_fields)
+        remote = import_values(self.binding, imported)
+        if set(imported) - set(remote):
+            return None
+        result = three_way_merge(snapshot, self.binding._get_sync_values(),
+                                 remote)
+        if result.conflicts:
+            _logger.info('%s %d: fields %s modified in Odoo and Exchange, '
+                         'the values of Exchange are kept',
+                         self.model._name, self.binding.id,
+                         ', '.join(sorted(result.conflicts)))
+        if result.to_odoo:
+            importer._update(self.binding,
+                             dict((name, data[name])
+                                  for name in result.to_odoo))
+        return result
+
     def _after_export(self):
         """ Can do several actions after exporting a record """
         pass
@@ -13,27 +13,43 @@ the last update in Exchange.
 They should call the ``bind`` method if the binder even if the records
 are already bound, to update the last sync date.
 
+The hash of the values read from Exchange is kept on the binding: an item
+whose values did not change since the last import is not written again,
+and only the values which differ are written. An item which still has the
+changekey of the binding is not even mapped (see :mod:`.snapshot`).
+
 """
 
 import logging
 import odoo
-from odoo import SUPERUSER_ID
+from odoo import SUPERUSER_ID, _
 from odoo.addons.connector.connector import ConnectorUnit
 # from odoo.addons.queue_job.exception import FailedJobError
 from odoo.addons.connector.unit.synchronizer import Importer
 
 from ..backend import exchange_2010
+from .snapshot import content_hash
 
 from contextlib import closing, contextmanager
 
 _logger = logging.getLogger(__name__)
 
-RETRY_ON_ADVISORY_LOCK = 1  # seconds
+# base delay, jittered when the job is retried
 RETRY_WHEN_CONCURRENT_DETECTED = 1  # seconds
 
+# context of the writes of the backends in bulk import mode: no tracking
+# messages, followers nor notification emails
+BULK_IMPORT_CONTEXT = {
+    'tracking_disable': True,
+    'mail_notrack': True,
+    'mail_create_nolog': True,
+    'mail_create_nosubscribe': True,
+    'mail_auto_subscribe_no_notify': True,
+    'no_mail_to_attendees': True,
+}
 
-RETRY_ON_ADVISORY_LOCK = 1  # seconds
-RETRY_WHEN_CONCURRENT_DETECTED = 1  # seconds
+# values mapped from Exchange which are not part of the content hash
+HASH_EXCLUDED_FIELDS = ('change_key', 'external_id', 'content_hash')
 
 
 class ExchangeImporter(Importer):
@@ -152,15 +168,25 @@ class ExchangeImporter(Importer):
             )
         if self.env.user.id == SUPERUSER_ID:
             context_keys['mail_create_nosubscribe'] = True
+        if self.backend_record.bulk_import:
+            context_keys.update(BULK_IMPORT_CONTEXT)
 
         return context_keys
 
     def _create(self, data, context_keys=None):
-        """ Create the Odoo record """
+        """ Create the Odoo record
+
+        When a concurrent import has created the binding first, it is
+        updated instead.
+        """
         # special check on data before import
         self._validate_data(data)
         context_keys = self._create_context_keys(keys=context_keys)
-        binding = self.model.with_context(**context_keys).create(data)
+        binding, created = self.model.with_context(
+            **context_keys)._create_binding(data)
+        if not created:
+            self._update(binding, data)
+            return binding
 
         _logger.debug('%s %d created from %s %s',
                       self.model._name, binding.id,
@@ -177,6 +203,73 @@ class ExchangeImporter(Importer):
     def _update_data(self, map_record, **kwargs):
         return map_record.values(**kwargs)
 
+    def _content_hash(self, data):
+        """ Stable hash of the values mapped from Exchange
+
+        The changekey and the ID of the item are not part of the content,
+        they change when the item is saved or moved without any change.
+        """
+        return content_hash(
+            dict((name, value) for name, value in data.iteritems()
+                 if name not in HASH_EXCLUDED_FIELDS)
+        )
+
+    def _get_exchange_record(self):
+        """ Read the item to import from Exchange """
+        raise NotImplementedError('Must be implemented in subclasses')
+
+    def _is_echo(self, binding):
+        """ The item has not changed since the binding was synchronized,
+        it is either our own export or an item already imported
+        """
+        return self.external_record.changekey == binding.change_key
+
+    def _set_synced(self, binding):
+        """ Keep the hash and the snapshot of the Odoo values after the
+        import
+        """
+        binding._set_synced()
+
+    def _is_unchanged(self, binding, data):
+        """ Add the hash of the values to ``data`` and tell if they are
+        the values of the last import
+
+        When they are, the new changekey of the item is kept on the
+        binding so the next imports recognize it.
+        """
+        data['content_hash'] = self._content_hash(data)
+        if binding.content_hash != data['content_hash']:
+            return False
+        if data.get('change_key') and binding.change_key != data['change_key']:
+            binding.with_context(connector_no_export=True).write(
+                {'change_key': data['change_key']}
+            )
+        return True
+
+    @staticmethod
+    def _same_value(record, field, value):
+        current = record[field.name]
+        if field.type == 'many2one':
+            return (value or False) == current.id
+        if field.type in ('one2many', 'many2many'):
+            # only the replacement of all the records is compared
+            if (isinstance(value, list) and len(value) == 1 and
+                    value[0][0] == 6):
+                return set(value[0][2]) == set(current.ids)
+            return False
+        try:
+            return field.convert_to_cache(value, record,
+                                          validate=False) == current
+        except (TypeError, ValueError):
+            return False
+
+    def _changed_data(self, binding, data):
+        """ Keep only the values which differ from the binding """
+        return dict((name, value) for name, value in data.iteritems()
+                    if name not in binding._fields or
+                    not self._same_value(binding, binding._fields[name],
+                                         value))
+
     def _update_context_keys(self, keys=None):
         context_keys = dict(
             connector_no_export=True,
@@ -189,6 +282,8 @@ class ExchangeImporter(Importer):
 
         if self.env.user.id == SUPERUSER_ID:
             context_keys['tracking_disable'] = True
+        if self.backend_record.bulk_import:
+            context_keys.update(BULK_IMPORT_CONTEXT)
 
         return context_keys
 
@@ -197,6 +292,9 @@ class ExchangeImporter(Importer):
         # special check on data before import
         self._validate_data(data)
 
+        data = self._changed_data(binding, data)
+        if not data:
+            return
         context_keys = self._update_context_keys(keys=context_keys)
         binding.with_context(**context_keys).write(data)
         _logger.debug('%s %d updated from %s %s',
@@ -241,27 +339,14 @@ class ExchangeImporter(Importer):
     def _run(self, item_id, user):
         """ Beginning of the synchronization
 
-        The first thing we do is to try to acquire an advisory lock
-        on Postgresql. If it can't be acquired it means that another job
-        does the same import at the same moment.
-        The goal is to prevent 2 jobs to create the same binding because
-        they each job is not aware of the other binding.
-        It happens easily when 2 jobs import the same dependencies (such
-        as partner categories for an import of partners).
+        The jobs importing the same item at the same moment are not
+        locked: the first one creates the binding, the others update it
+        (see ``exchange.binding._create_binding``).
 
         :param item_id: item_id
         """
         self.openerp_user = user
         self.external_id = item_id
-        # lock_name = 'import({}, {}, {}, {})'.format(
-        #     self.backend_record._name,
-        #     self.backend_record.id,
-        #     self.model._name,
-        #     self.external_id,
-        # )
-        # Keep a lock on this import until the transaction is committed
-        # self.advisory_lock_or_retry(lock_name,
-        #                             retry_seconds=RETRY_ON_ADVISORY_LOCK)
 
         skip = self._must_skip()
         if skip:
@@ -274,10 +359,6 @@ class ExchangeImporter(Importer):
 
         contact_id = self.external_id
 
-        data = self._map_data()
-        data.update(user_id=self.openerp_user.id,
-                    backend_id=self.backend_record.id)
-
         # try to find a exchange.res.partner with the same
         # Id/user_id/backend_id
         # if found, update it
@@ -288,23 +369,36 @@ class ExchangeImporter(Importer):
                 ('external_id', '=', contact_id)]
         exchange_partners = self.env['exchange.res.partner'].search(args)
 
+        self.external_record = self._get_exchange_record()
+        if exchange_partners and self._is_echo(exchange_partners[0]):
+            return _('Already up-to-date.')
+
+        data = self._map_data()
+        data.update(user_id=self.openerp_user.id,
+                    backend_id=self.backend_record.id)
+
         partners = self.env['res.partner']
         if data.get('company_name'):
             partners = self.env['res.partner'].search(
                 [('name', '=', data['company_name'])])
             del data['company_name']
 
+        if exchange_partners and self._is_unchanged(exchange_partners[0],
+                                                    data):
+            return _('Already up-to-date.')
+
         if not exchange_partners:
             GENERIC = self.env.ref('connector_exchange.res_partner_GENERIC').id
             _logger.debug('does not exist --> CREATE')
+            data['content_hash'] = self._content_hash(data)
             data['active'] = False
-            binding = exchange_partners._create(data)
+            binding = self._create(data)
             write_dict = {
                 'active': True,
                 'parent_id': partners and partners[0].id or GENERIC
             }
-            binding_rs = exchange_partners.browse(binding)
-            self._update(binding_rs, write_dict)
+            self._update(binding, write_dict)
+            self._set_synced(binding)
             # self.move_contact(contact_id)
         else:
             # if not self.external_record:
@@ -315,6 +409,7 @@ class ExchangeImporter(Importer):
             _logger.debug('exists --> UPDATE')
             binding = exchange_partners[0]
             self._update(binding, data)
+            self._set_synced(binding)
 
     def _map_data(self):
         raise NotImplementedError('Must be implemented in subclasses')
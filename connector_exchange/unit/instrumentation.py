@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+""" Instrumentation of the requests sent to Exchange
+
+The HTTP adapter of the exchangelib sessions counts the requests by
+operation (FindItem, GetItem, ...) with their duration, their size and
+the throttling responses. The totals go to the collectors opened with
+:func:`collect_ews_stats` in the current thread.
+
+exchangelib sends some requests from its own threads (GetItem by chunks),
+they are attributed to the collector watching the impersonated mailbox,
+see :func:`watch_mailbox`.
+
+The adapter also applies the throttling and the circuit breaker of the
+backend of the mailbox, see :mod:`.throttle` and :mod:`.breaker`. The
+backend is known from the credentials of the protocol of the session,
+given to its adapters by :func:`instrumented_session`.
+"""
+
+import functools
+import json
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from .breaker import CONNECTION_ERRORS, UNAVAILABLE_STATUS, get_breaker
+from .throttle import DEFAULT_BACK_OFF, SLOW_LATENCY, get_bucket
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from exchangelib.protocol import NoVerifyHTTPAdapter
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+    NoVerifyHTTPAdapter = object
+
+OPERATION_RE = re.compile(br'<(?:[\w-]+:)?Body[^>]*>\s*<(?:[\w-]+:)?(\w+)')
+MAILBOX_RE = re.compile(br'<(?:[\w-]+:)?PrimarySmtpAddress>([^<]+)<')
+RESPONSE_CODE_RE = re.compile(
+    br'<(?:[\w-]+:)?ResponseCode(?:\s[^>]*)?>\s*(\w+)\s*<')
+THROTTLING_CODES = (b'ErrorServerBusy', b'ErrorTooManyObjectsOpened')
+BACK_OFF_RE = re.compile(br'BackOffMilliseconds"\s*>\s*(\d+)\s*<')
+
+_local = threading.local()
+# collectors by mailbox, for the requests sent by the exchangelib threads
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def _new_line():
+    return {'count': 0,
+            'seconds': 0.0,
+            'bytes_sent': 0,
+            'bytes_received': 0,
+            'throttled': 0,
+            }
+
+
+class EWSStats(object):
+    """ Totals of the requests sent to Exchange by mailbox and operation
+
+    The requests are also added to the parent collector, so a job run
+    inside another one (without delay) is counted in both.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.mailboxes = set()
+        self.lines = defaultdict(_new_line)
+        self._lock = threading.Lock()
+
+    def add(self, mailbox, operation, seconds, bytes_sent, bytes_received,
+            throttled):
+        with self._lock:
+            line = self.lines[(mailbox, operation)]
+            line['count'] += 1
+            line['seconds'] += seconds
+            line['bytes_sent'] += bytes_sent
+            line['bytes_received'] += bytes_received
+            line['throttled'] += int(throttled)
+        if self.parent is not None:
+            self.parent.add(mailbox, operation, seconds, bytes_sent,
+                            bytes_received, throttled)
+
+    def by_operation(self, mailbox=None):
+        """ Return the totals by operation
+
+        :param mailbox: only the requests of this mailbox
+        :returns: dict {operation: totals}
+        """
+        result = defaultdict(_new_line)
+        for (line_mailbox, operation), line in self.lines.items():
+            if mailbox and line_mailbox != mailbox:
+                continue
+            for key, value in line.items():
+                result[operation][key] += value
+        return dict(result)
+
+    def totals(self, mailbox=None):
+        result = _new_line()
+        for line in self.by_operation(mailbox=mailbox).values():
+            for key, value in line.items():
+                result[key] += value
+        return result
+
+    def get_values(self, mailbox=None):
+        """ Values of the ``ews_*`` fields of the models storing them """
+        totals = self.totals(mailbox=mailbox)
+        return {
+            'ews_request_count': totals['count'],
+            'ews_request_time': totals['seconds'],
+            'ews_bytes_sent': totals['bytes_sent'],
+            'ews_bytes_received': totals['bytes_received'],
+            'ews_throttled_count': totals['throttled'],
+            'ews_operations': json.dumps(
+                self.by_operation(mailbox=mailbox), sort_keys=True),
+        }
+
+
+@contextmanager
+def collect_ews_stats():
+    """ Count the requests sent to Exchange in the block
+
+    Yields an :class:`EWSStats`.
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stats = EWSStats(parent=stack[-1] if stack else None)
+    stack.append(stats)
+    try:
+        yield stats
+    finally:
+        stack.pop()
+        with _watchers_lock:
+            for mailbox in stats.mailboxes:
+                if _watchers.get(mailbox) is stats:
+                    if stats.parent is not None:
+                        _watchers[mailbox] = stats.parent
+                    else:
+                        del _watchers[mailbox]
+
+
+def watch_mailbox(mailbox):
+    """ Attribute to the current collector the requests of a mailbox sent
+    by the threads of exchangelib
+    """
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        return
+    stats = stack[-1]
+    stats.mailboxes.add(mailbox)
+    with _watchers_lock:
+        _watchers[mailbox] = stats
+
+
+def _get_collector(mailbox):
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    if mailbox:
+        return _watchers.get(mailbox)
+    return None
+
+
+def store_job_stats(env, stats):
+    """ Write the totals of a collector on the running queue.job """
+    uuid = env.context.get('job_uuid')
+    if not uuid or not stats.lines:
+        return
+    job = env['queue.job'].sudo().search([('uuid', '=', uuid)], limit=1)
+    job.write(stats.get_values())
+
+
+def instrumented_job(func):
+    """ Decorator storing on the queue.job the requests sent by a job
+
+    It must be the last decorator, right above the method.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with collect_ews_stats() as stats:
+            result = func(self, *args, **kwargs)
+            store_job_stats(self.env, stats)
+        return result
+    return wrapper
+
+
+def instrumented_session(create_session):
+    """ Wrap ``BaseProtocol.create_session`` to give the credentials of
+    the protocol to the HTTP adapters of its sessions
+    """
+    @functools.wraps(create_session)
+    def wrapper(protocol):
+        session = create_session(protocol)
+        for adapter in session.adapters.values():
+            adapter.credentials = protocol.credentials
+        return session
+    return wrapper
+
+
+class InstrumentedHTTPAdapter(NoVerifyHTTPAdapter):
+    """ HTTP adapter of the exchangelib sessions counting and throttling
+    the requests
+    """
+
+    credentials = None
+
+    def send(self, request, **kwargs):
+        body = request.body or b''
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        match = MAILBOX_RE.search(body)
+        mailbox = match.group(1).decode('utf-8') if match else None
+        # the protocols of the backends have their own credentials
+        dbname = getattr(self.credentials, 'dbname', None)
+        backend_id = getattr(self.credentials, 'backend_id', None)
+        breaker = bucket = None
+        if mailbox:
+            breaker = get_breaker(dbname, backend_id, mailbox)
+            bucket = get_bucket(dbname, backend_id, mailbox)
+        if breaker is not None:
+            breaker.before_request()
+        if bucket is not None:
+            bucket.acquire()
+        start = time.time()
+        try:
+            response = super(InstrumentedHTTPAdapter, self).send(request,
+                                                                 **kwargs)
+        except CONNECTION_ERRORS:
+            if breaker is not None:
+                breaker.failure()
+            raise
+        seconds = time.time() - start
+        if breaker is not None:
+            if response.status_code in UNAVAILABLE_STATUS:
+                breaker.failure()
+            else:
+                breaker.success()
+        content = response.content or b''
+        # the codes of the response messages and of the SOAP faults, the
+        # items themselves may contain the same words
+        throttled = response.status_code == 503 or any(
+            code in THROTTLING_CODES
+            for code in RESPONSE_CODE_RE.findall(content)
+        )
+        if bucket is not None:
+            if throttled:
+                match = BACK_OFF_RE.search(content)
+                bucket.back_off(int(match.group(1)) / 1000. if match
+                                else DEFAULT_BACK_OFF)
+            elif seconds > SLOW_LATENCY:
+                bucket.slow_down()
+        stats = _get_collector(mailbox)
+        if stats is None:
+            return response
+        match = OPERATION_RE.search(body)
+        operation = (match.group(1).decode('ascii') if match
+                     else request.method)
+        stats.add(mailbox, operation, seconds, len(body), len(content),
+                  throttled)
+        return response
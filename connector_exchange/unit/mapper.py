@@ -19,6 +19,8 @@
 #
 ##############################################################################
 
+import operator
+
 
 def normalize_datetime(field):
     """Change a invalid date which comes from Exchange, if
@@ -28,3 +30,141 @@ def normalize_datetime(field):
             return None
         return record[field]
     return modifier
+
+
+# Declarative mappings between the Odoo records and the exchangelib items.
+#
+# A mapping is declared once by model with a list of ``MappedField`` and
+# compiled when the module is loaded: the paths are turned into getters
+# and setters and the fields are split by direction, so mapping an item
+# is a loop over prepared functions. The export can be restricted to the
+# fields which changed, the functions for a set of fields are compiled on
+# its first use and kept.
+
+_MISSING = object()
+
+
+class MappedField(object):
+    """ Mapping of an Odoo field to an attribute of an Exchange item
+
+    :param odoo: name of the Odoo field
+    :param exchange: attribute of the item, a dotted path for an attribute
+                     of a sub-element (``complete_name.title``)
+    :param relation: model of a many2one, the record is found by the
+                     ``relation_field`` on import and this field is
+                     exported
+    :param direction: ``both``, ``import`` or ``export``
+    """
+
+    __slots__ = ('odoo', 'exchange', 'relation', 'relation_field',
+                 'direction')
+
+    def __init__(self, odoo, exchange, relation=None, relation_field='name',
+                 direction='both'):
+        assert direction in ('both', 'import', 'export')
+        self.odoo = odoo
+        self.exchange = exchange
+        self.relation = relation
+        self.relation_field = relation_field
+        self.direction = direction
+
+
+def _getter(path):
+    get = operator.attrgetter(path)
+
+    def getter(item):
+        try:
+            return get(item)
+        except AttributeError:
+            return _MISSING
+    return getter
+
+
+def _setter(path):
+    parent_path, __, name = path.rpartition('.')
+    if not parent_path:
+        return lambda item, value: setattr(item, name, value)
+    get_parent = _getter(parent_path)
+
+    def setter(item, value):
+        parent = get_parent(item)
+        # the sub-element is not created
+        if parent is not None and parent is not _MISSING:
+            setattr(parent, name, value)
+    return setter
+
+
+class MappingSpec(object):
+    """ Mapping of a model, compiled by direction
+
+    ``map_import(item, env)`` returns the values of the Odoo record,
+    ``map_export(record, item, fields=None)`` sets the non-empty values of
+    the record on the item, only for ``fields`` when given.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._exporters = {}
+        self.map_import = self._compile_import()
+        self._export_all = self._compile_export(None)
+
+    def _compile_import(self):
+        simple = []
+        relational = []
+        for field in self.fields:
+            if field.direction == 'export':
+                continue
+            getter = _getter(field.exchange)
+            if field.relation:
+                relational.append((field.odoo, getter, field.relation,
+                                   field.relation_field))
+            else:
+                simple.append((field.odoo, getter))
+
+        def map_import(item, env):
+            vals = {}
+            for name, getter in simple:
+                value = getter(item)
+                if value is not _MISSING:
+                    vals[name] = value
+            for name, getter, relation, relation_field in relational:
+                value = getter(item)
+                if value is _MISSING or not value:
+                    continue
+                record = env[relation].search([(relation_field, '=', value)],
+                                              limit=1)
+                if record:
+                    vals[name] = record.id
+            return vals
+        return map_import
+
+    def _compile_export(self, fields):
+        setters = []
+        for field in self.fields:
+            if field.direction == 'import':
+                continue
+            if fields is not None and field.odoo not in fields:
+                continue
+            setters.append((field.odoo,
+                            field.relation_field if field.relation else None,
+                            _setter(field.exchange)))
+
+        def map_export(record, item):
+            for name, relation_field, setter in setters:
+                value = record[name]
+                if not value:
+                    continue
+                if relation_field:
+                    value = value[relation_field]
+                setter(item, value)
+            return item
+        return map_export
+
+    def map_export(self, record, item, fields=None):
+        if not fields:
+            return self._export_all(record, item)
+        key = frozenset(fields)
+        exporter = self._exporters.get(key)
+        if exporter is None:
+            exporter = self._exporters[key] = self._compile_export(key)
+        return exporter(record, item)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+""" State of the records at their last synchronization
+
+A binding keeps the changekey of the Exchange item and the hash of the
+synchronized Odoo values as they were after its last import or export.
+An item whose changekey is the one of the binding is not imported again
+(it is our own export coming back), and a binding whose Odoo values still
+have the same hash is not exported again.
+
+The values themselves are kept in the ``exchange_binding_snapshot`` table,
+as compressed JSON. When an item has been modified in Exchange and the
+record in Odoo, the exporters merge both sides with
+:func:`three_way_merge` instead of discarding the Odoo changes.
+"""
+
+import hashlib
+import json
+import zlib
+from collections import namedtuple
+
+
+def content_hash(values):
+    """ Stable hash of a dict of values """
+    content = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def dump_snapshot(values):
+    content = json.dumps(values, sort_keys=True, default=str)
+    return zlib.compress(content.encode('utf-8'))
+
+
+def load_snapshot(data):
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+
+def record_values(record, field_names):
+    """ Values of fields of a record, in the form of the snapshots
+
+    The many2one are kept as ids and the x2many as sorted lists of ids.
+    """
+    values = {}
+    for name in field_names:
+        field = record._fields[name]
+        value = record[name]
+        if field.type == 'many2one':
+            value = value.id
+        elif field.type in ('one2many', 'many2many'):
+            value = sorted(value.ids)
+        values[name] = value
+    return values
+
+
+def import_values(record, data):
+    """ Values to write on a record, in the form of the snapshots
+
+    The x2many values which do not replace all the records cannot be
+    compared, they are left out.
+    """
+    values = {}
+    for name, value in data.items():
+        field = record._fields.get(name)
+        if field is None:
+            continue
+        if field.type == 'many2one':
+            value = value or False
+        elif field.type in ('one2many', 'many2many'):
+            if not (isinstance(value, list) and len(value) == 1 and
+                    value[0][0] == 6):
+                continue
+            value = sorted(value[0][2])
+        else:
+            value = field.convert_to_cache(value, record, validate=False)
+        values[name] = value
+    return values
+
+
+Merge = namedtuple('Merge', 'to_odoo to_exchange conflicts')
+
+
+def three_way_merge(base, local, remote):
+    """ Merge the changes of Odoo and Exchange since the last sync
+
+    :param base: values of the snapshot
+    :param local: current values in Odoo
+    :param remote: current values in Exchange
+    :returns: a ``Merge`` with the sets of fields to write in Odoo (the
+              value of Exchange), to export to Exchange (the value of Odoo)
+              and the fields changed differently on both sides. A
+              conflict is solved by Exchange, its field is also in
+              ``to_odoo``.
+    """
+    to_odoo = set()
+    to_exchange = set()
+    conflicts = set()
+    for name in set(base) | set(local) | set(remote):
+        base_value = base.get(name)
+        local_value = local.get(name, base_value)
+        remote_value = remote.get(name, base_value)
+        if local_value == remote_value:
+            continue
+        if local_value == base_value:
+            to_odoo.add(name)
+        elif remote_value == base_value:
+            to_exchange.add(name)
+        else:
+            conflicts.add(name)
+            to_odoo.add(name)
+    return Merge(to_odoo, to_exchange, conflicts)
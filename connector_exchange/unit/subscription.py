@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+""" EWS pull subscriptions
+
+exchangelib does not implement the notification services, they are built
+here on top of its services: ``Subscribe`` creates a pull subscription on a
+folder, ``GetEvents`` returns the events of the subscription since a
+watermark.
+"""
+
+import logging
+from collections import namedtuple
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from exchangelib.services import EWSAccountService
+    from exchangelib.transport import MNS, TNS
+    from exchangelib.util import (create_element, add_xml_child,
+                                  set_xml_value, get_xml_attr)
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+    EWSAccountService = object
+
+SUBSCRIBED_EVENT_TYPES = ('CreatedEvent', 'ModifiedEvent', 'DeletedEvent',
+                          'MovedEvent', 'CopiedEvent')
+
+# event_type is one of SUBSCRIBED_EVENT_TYPES, the old item and folder are
+# only set on the moved and copied events
+ItemEvent = namedtuple('ItemEvent', 'event_type item_id changekey folder_id '
+                                    'old_item_id old_folder_id')
+
+
+def _get_id(elem, name):
+    child = elem.find('{%s}%s' % (TNS, name))
+    if child is None:
+        return None
+    return child.get('Id')
+
+
+def _check_message(service, message):
+    """ Raise the error of a response message """
+    container = service._get_element_container(message=message)
+    if isinstance(container, Exception):
+        raise container
+
+
+class Subscribe(EWSAccountService):
+    """ Create a pull subscription on a folder
+
+    MSDN: https://msdn.microsoft.com/en-us/library/office/aa566188.aspx
+    """
+    SERVICE_NAME = 'Subscribe'
+
+    def call(self, folder, timeout, watermark=None):
+        """ Subscribe to the item events of a folder
+
+        :param folder: exchangelib folder
+        :param timeout: minutes after which the subscription expires when
+                        it is not polled
+        :param watermark: resume the events of an expired subscription
+        :returns: tuple (subscription id, watermark)
+        """
+        payload = self.get_payload(folder, timeout, watermark=watermark)
+        for message in self._get_response_xml(payload=payload):
+            _check_message(self, message)
+            return (get_xml_attr(message, '{%s}SubscriptionId' % MNS),
+                    get_xml_attr(message, '{%s}Watermark' % MNS))
+
+    def get_payload(self, folder, timeout, watermark=None):
+        subscribe = create_element('m:%s' % self.SERVICE_NAME)
+        request = create_element('m:PullSubscriptionRequest')
+        folder_ids = create_element('t:FolderIds')
+        set_xml_value(folder_ids, [folder], self.account.version)
+        request.append(folder_ids)
+        event_types = create_element('t:EventTypes')
+        for event_type in SUBSCRIBED_EVENT_TYPES:
+            add_xml_child(event_types, 't:EventType', event_type)
+        request.append(event_types)
+        if watermark:
+            add_xml_child(request, 't:Watermark', watermark)
+        add_xml_child(request, 't:Timeout', timeout)
+        subscribe.append(request)
+        return subscribe
+
+
+class GetEvents(EWSAccountService):
+    """ Read the events of a pull subscription
+
+    MSDN: https://msdn.microsoft.com/en-us/library/office/aa566199.aspx
+    """
+    SERVICE_NAME = 'GetEvents'
+
+    def call(self, subscription_id, watermark):
+        """ Return the events of a subscription after a watermark
+
+        :returns: tuple (list of ItemEvent, new watermark, more events)
+        """
+        payload = self.get_payload(subscription_id, watermark)
+        events = []
+        more_events = False
+        for message in self._get_response_xml(payload=payload):
+            _check_message(self, message)
+            notification = message.find('{%s}Notification' % MNS)
+            if notification is None:
+                continue
+            more_events = get_xml_attr(
+                notification, '{%s}MoreEvents' % TNS) == 'true'
+            for elem in notification:
+                event_watermark = get_xml_attr(elem, '{%s}Watermark' % TNS)
+                if event_watermark:
+                    watermark = event_watermark
+                event_type = elem.tag.split('}')[-1]
+                item = elem.find('{%s}ItemId' % TNS)
+                # folder events have a FolderId instead of an ItemId
+                if event_type not in SUBSCRIBED_EVENT_TYPES or item is None:
+                    continue
+                events.append(ItemEvent(
+                    event_type,
+                    item.get('Id'),
+                    item.get('ChangeKey'),
+                    _get_id(elem, 'ParentFolderId'),
+                    _get_id(elem, 'OldItemId'),
+                    _get_id(elem, 'OldParentFolderId'),
+                ))
+        return events, watermark, more_events
+
+    def get_payload(self, subscription_id, watermark):
+        getevents = create_element('m:%s' % self.SERVICE_NAME)
+        add_xml_child(getevents, 'm:SubscriptionId', subscription_id)
+        add_xml_child(getevents, 'm:Watermark', watermark)
+        return getevents
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+""" Throttling of the requests sent to Exchange
+
+The requests to an Exchange backend are limited by a token bucket stored
+in the ``exchange_throttle_bucket`` table, so it is shared by all the
+workers and job runners. Each request takes a token before it is sent,
+waiting for it if the bucket is empty.
+
+The rate adapts to the server: it grows a little with each request up to
+the rate configured on the backend, it is halved when the server answers
+with a back off (ErrorServerBusy) and reduced when the responses are slow.
+The bucket is also blocked for the back off duration reported by the
+server.
+
+A job which would wait too long, or which is refused by the server, is
+retried later with a random delay, see :func:`retry_when_throttled`.
+"""
+
+import functools
+import logging
+import random
+import threading
+import time
+from contextlib import closing, contextmanager
+
+from odoo import sql_db
+from odoo.addons.queue_job.exception import RetryableJobError
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from exchangelib.errors import ErrorServerBusy
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+
+# requests/second added to the rate by each request
+RATE_INCREASE = 0.05
+# the rate never goes below
+MIN_RATE = 0.1
+# factor applied to the rate on a back off, on a slow response
+BACK_OFF_DECREASE = 0.5
+SLOW_DECREASE = 0.9
+# seconds after which a response is slow
+SLOW_LATENCY = 5
+# seconds of back off when the server does not tell
+DEFAULT_BACK_OFF = 5
+
+# buckets by (database, backend id, mailbox), registered when the account
+# of a user is created
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def jittered(seconds):
+    """ Random delay between ``seconds`` and twice ``seconds``
+
+    Spreads the retries of the jobs postponed together.
+    """
+    return max(1, int(round(random.uniform(seconds, seconds * 2))))
+
+
+class ThrottledError(Exception):
+    """ The request would wait more than the maximum wait of the backend
+    """
+
+    def __init__(self, seconds):
+        super(ThrottledError, self).__init__(
+            'Exchange requests throttled for %d seconds' % seconds)
+        self.seconds = seconds
+
+
+class TokenBucket(object):
+    """ Token bucket of a backend, shared through PostgreSQL
+
+    The tokens are reserved: a request takes a token even when the bucket
+    is empty and waits for the time the bucket needs to refill it.
+
+    :param rate: maximum number of requests by second
+    :param burst: number of requests allowed at once
+    :param max_wait: seconds after which a request is refused instead of
+                     waiting (ThrottledError)
+    """
+
+    def __init__(self, dbname, backend_id, rate, burst, max_wait):
+        self.dbname = dbname
+        self.backend_id = backend_id
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+    @contextmanager
+    def _cursor(self):
+        """ The bucket is updated outside of the transaction of the job, so
+        the other workers see it immediately
+        """
+        with closing(sql_db.db_connect(self.dbname).cursor()) as cr:
+            cr.autocommit(True)
+            yield cr
+
+    def acquire(self):
+        """ Take a token, waiting for it if needed
+
+        :raises: ThrottledError when the wait would exceed ``max_wait``
+        """
+        with self._cursor() as cr:
+            cr.execute("""
+                INSERT INTO exchange_throttle_bucket AS b
+                    (backend_id, tokens, rate, updated_at)
+                VALUES (%(backend_id)s, %(burst)s - 1, %(rate)s,
+                        clock_timestamp())
+                ON CONFLICT (backend_id) DO UPDATE SET
+                    tokens = LEAST(
+                        %(burst)s,
+                        b.tokens + b.rate * EXTRACT(
+                            EPOCH FROM clock_timestamp() - b.updated_at
+                        )
+                    ) - 1,
+                    rate = LEAST(%(rate)s, b.rate + %(increase)s),
+                    updated_at = clock_timestamp()
+                RETURNING GREATEST(
+                    -b.tokens / b.rate,
+                    EXTRACT(EPOCH FROM b.blocked_until - clock_timestamp()),
+                    0
+                )
+            """, {'backend_id': self.backend_id,
+                  'burst': self.burst,
+                  'rate': self.rate,
+                  'increase': RATE_INCREASE})
+            wait = cr.fetchone()[0]
+            if wait > self.max_wait:
+                # the token is given back, the request is not sent
+                cr.execute("""
+                    UPDATE exchange_throttle_bucket
+                    SET tokens = tokens + 1
+                    WHERE backend_id = %s
+                """, (self.backend_id,))
+                raise ThrottledError(wait)
+        if wait > 0:
+            _logger.debug('Exchange backend %s throttled, waiting %.2f s',
+                          self.backend_id, wait)
+            time.sleep(wait)
+
+    def back_off(self, seconds):
+        """ The server asked to wait ``seconds`` before the next request """
+        _logger.info('Exchange backend %s busy, backing off for %.1f s',
+                     self.backend_id, seconds)
+        with self._cursor() as cr:
+            cr.execute("""
+                UPDATE exchange_throttle_bucket
+                SET rate = GREATEST(%(min_rate)s, rate * %(decrease)s),
+                    blocked_until = GREATEST(
+                        blocked_until,
+                        clock_timestamp() + %(seconds)s * interval '1 second'
+                    )
+                WHERE backend_id = %(backend_id)s
+            """, {'backend_id': self.backend_id,
+                  'min_rate': MIN_RATE,
+                  'decrease': BACK_OFF_DECREASE,
+                  'seconds': seconds})
+
+    def reset(self):
+        """ Forget the rate and the back off of the backend """
+        with self._cursor() as cr:
+            cr.execute("""
+                DELETE FROM exchange_throttle_bucket WHERE backend_id = %s
+            """, (self.backend_id,))
+
+    def slow_down(self):
+        """ A response was slow """
+        with self._cursor() as cr:
+            cr.execute("""
+                UPDATE exchange_throttle_bucket
+                SET rate = GREATEST(%s, rate * %s)
+                WHERE backend_id = %s
+            """, (MIN_RATE, SLOW_DECREASE, self.backend_id))
+
+
+def register_bucket(dbname, backend_id, mailbox, bucket):
+    """ Throttle the requests of a backend for a mailbox with a bucket,
+    None to stop
+    """
+    key = (dbname, backend_id, mailbox)
+    with _buckets_lock:
+        if bucket is None:
+            _buckets.pop(key, None)
+        else:
+            _buckets[key] = bucket
+
+
+def get_bucket(dbname, backend_id, mailbox):
+    return _buckets.get((dbname, backend_id, mailbox))
+
+
+def is_postponed(error):
+    """ A job failing with this error is retried later """
+    return isinstance(error, (RetryableJobError, ThrottledError,
+                              ErrorServerBusy))
+
+
+def retry_when_throttled(func):
+    """ Decorator postponing a job refused by Exchange, by the bucket or
+    by the circuit breaker (:class:`.breaker.CircuitOpenError`)
+
+    The job is retried with a random delay, without counting as a failed
+    try. It must be placed under the ``@job`` decorator.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except ThrottledError as err:
+            message, seconds = '%s' % err, err.seconds
+        except ErrorServerBusy:
+            message, seconds = 'Exchange is busy', DEFAULT_BACK_OFF
+        raise RetryableJobError('%s, job postponed' % message,
+                                seconds=jittered(seconds),
+                                ignore_retry=True)
+    return wrapper